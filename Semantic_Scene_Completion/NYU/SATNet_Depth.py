@@ -17,6 +17,15 @@ import torch.utils.data as torch_data
 from engine_depth import Engine
 sys.path.append('../../')
 import configs
+from configs import *
+import depth_mapping
+import npz_shards
+import image_cache
+import projection
+import devices
+import feature_store
+import manifest
+import checkpointing
 
 
 parser = argparse.ArgumentParser(description='NYU Depth Training')
@@ -40,22 +49,33 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--mapping-cache', dest='mapping_cache', action='store_true',
+                    help='read depth_mapping_3d from the cache built by depth_mapping.py')
+parser.add_argument('--shards', dest='shards', action='store_true',
+                    help='read labels, weights and depth_mapping_3d from the shards built by npz_shards.py')
+parser.add_argument('--image-cache', dest='image_cache', action='store_true',
+                    help='keep the resized RGB and HHA images in the image cache of configs.py')
+parser.add_argument('--manifest', dest='manifest', action='store_true',
+                    help='read the validated sample lists from the manifests of configs.py, see manifest.py')
+parser.add_argument('--revalidate-manifest', dest='revalidate_manifest', action='store_true',
+                    help='rescan the sample lists and rewrite their manifests')
+parser.add_argument('--feature-store', dest='feature_store', action='store_true',
+                    help='train the 3D part only, from the 2D features kept in the feature store of configs.py (14 MB a sample, checked against the free space first)')
+parser.add_argument('--checkpoint', default='', type=str, metavar='MODULES',
+                    help='recompute these blocks in backward instead of keeping their activations, e.g. ASPP3D, see checkpointing.py')
 
 
 class TrainDataLoader(torch_data.Dataset):
-    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12):
+    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12, mapping_path = None, shard_path = None, image_cache_path = None, manifest_file = None, revalidate_manifest = False):
 
         super(TrainDataLoader, self).__init__()
 
-        fid = open(path, "r")
-        self.colorlist = []
-        for line in fid.readlines():
-            line = line.rstrip("\n")
-            if os.path.exists(line):
-                self.colorlist.append(line)
-        fid.close()
+        entries = manifest.read(path, lambda line: (line,), manifest_file, revalidate = revalidate_manifest)
+        self.colorlist = [paths[0] for paths in entries.paths]
 
         self.npz_path = npz_path
+        self.mapping_path = mapping_path
+        self.shards = npz_shards.ShardReader(shard_path) if shard_path is not None else None
 
         self.num_classes = num_classes
         self.img_transform = img_transform
@@ -64,39 +84,55 @@ class TrainDataLoader(torch_data.Dataset):
         self.resize_size = (384, 288) # 12:9
 
         if train_or_test == 'train':
-            self.filelist = np.arange(795)
+            self.filelist = np.arange(configs.NYU_NUM_TRAIN)
         else:
-            self.filelist = np.arange(654)
+            self.filelist = np.arange(configs.NYU_NUM_TEST)
 
         self.train_or_test = train_or_test
 
+        self.color_cache = None
+        if image_cache_path is not None:
+            HHA_path = NYU_HHA_PATH_TRAIN if train_or_test == 'train' else NYU_HHA_PATH_TEST
+            self.color_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'HHA'), ['%s/%06d.png'%(HHA_path, i+1) for i in self.filelist], self.resize_size)
+
     def __len__(self):
 
         return len(self.colorlist)
 
+    def targets(self, index):
+        # label, label_weight and depth_mapping_3d of a sample, without reading its image
+        if self.shards is not None:
+            label, label_weight, mapping = self.shards.get(self.filelist[index])
+        else:
+            loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
+            label = loaddata['arr_1']
+            label_weight = loaddata['arr_2']
+            if self.mapping_path is not None:
+                mapping = depth_mapping.load(self.mapping_path, self.filelist[index])
+            else:
+                mapping = depth_mapping.compute(loaddata['arr_3'])
+
+        # shurans, sent as uint8 labels, a uint8 weight mask and int32 mappings.
+        # The engines widen them on the device, see Engine.on_adapt_batch.
+        label = torch.from_numpy(np.array(label, dtype = np.uint8))
+        label_weight = torch.from_numpy((np.asarray(label_weight) != 0).astype(np.uint8))
+        depth_mapping_3d = torch.from_numpy(np.array(mapping, dtype = np.int32))
+
+        return label, label_weight, depth_mapping_3d
+
     def __getitem__(self, index):
 
-        if self.train_or_test == 'train':
-            color = Image.open('%s/%06d.png'%(NYU_HHA_PATH_TRAIN, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+        if self.color_cache is not None:
+            color = self.color_cache.get(index)
         else:
-            color = Image.open('%s/%06d.png'%(NYU_HHA_PATH_TEST, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
-        color = color.resize(self.resize_size, Image.ANTIALIAS)
+            if self.train_or_test == 'train':
+                color = Image.open('%s/%06d.png'%(NYU_HHA_PATH_TRAIN, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+            else:
+                color = Image.open('%s/%06d.png'%(NYU_HHA_PATH_TEST, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+            color = color.resize(self.resize_size, Image.LANCZOS)
         color = self.img_transform(color)
 
-        loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
-
-        # shurans
-        label = torch.LongTensor(loaddata['arr_1'].astype(np.int64))
-        label_weight = torch.FloatTensor(loaddata['arr_2'].astype(np.float32))
-        mapping = loaddata['arr_3'].astype(np.int64)
-        mapping1 = np.ones((8294400), dtype = np.int64)
-        mapping1[:] = -1
-        ind, = np.where(mapping>=0)
-        mapping1[mapping[ind]] = ind
-        mapping2 = torch.autograd.Variable(torch.FloatTensor(mapping1.reshape((1,1,240,144,240)).astype(np.float32)))
-        mapping2 = torch.nn.MaxPool3d(4,4)(mapping2).data.view(-1).numpy()
-        mapping2[mapping2<0] = 307200
-        depth_mapping_3d = torch.LongTensor(mapping2.astype(np.int64))
+        label, label_weight, depth_mapping_3d = self.targets(index)
 
         return color, label, label_weight, depth_mapping_3d
 
@@ -108,8 +144,14 @@ class DUC(nn.Module):
         self.conv = nn.Conv2d(inplanes, planes, kernel_size=3, padding=1, bias = False)
         self.bn = nn.BatchNorm2d(planes)
         self.pixel_shuffle = nn.PixelShuffle(upscale_factor)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint DUC, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         x = self.conv(x)
         x = self.bn(x)
         x = self.relu(x)
@@ -213,8 +255,14 @@ class ASPP3D(nn.Module):
         self.conv2 = nn.ModuleList([nn.Conv3d(planes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
         self.bn2 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
         self.relu = nn.ReLU(inplace=True)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint ASPP3D, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         
         y = self.bn2[0](self.conv2[0](self.relu(self.bn1[0](self.conv1[0](x)))))
         for i in range(1, len(self.conv_list)):
@@ -259,7 +307,7 @@ class ImageGen3DNet(nn.Module):
 
         self.img_required_size = (640, 480)
         self.img_size = img_size
-        if cmp(self.img_required_size, self.img_size) != 0:
+        if self.img_required_size != self.img_size:
             x = np.array(range(self.img_required_size[0]), dtype = np.float32)
             y = np.array(range(self.img_required_size[1]), dtype = np.float32)
             scale = 1.0 * self.img_size[0] / self.img_required_size[0]
@@ -281,19 +329,28 @@ class ImageGen3DNet(nn.Module):
         self.register_buffer('image_mapping', torch.autograd.Variable(torch.LongTensor(image_mapping1), requires_grad=False))
 
         self.dim_inc_dim = 64
+        self.sparse_head = None
+        self.cached_features = False
+
+    def features(self, img):
+        # the 2D features the voxels are projected from, (bs, 64, hi, wi)
+
+        return self.seg2d(img)[0]
 
     def forward(self, img, depth_mapping_3d):
         
-        bs, ch, hi, wi = img.size()
-        
-        segres = self.seg2d(img)[0][:,:,:].contiguous().view(bs*self.dim_inc_dim, hi*wi)
-        segres = torch.index_select(segres, 1, self.image_mapping).contiguous().view(
-            bs, self.dim_inc_dim, self.img_required_size[0]*self.img_required_size[1]).permute(0, 2, 1)
-        zerosVec = Variable(torch.zeros(bs, 1, self.dim_inc_dim), requires_grad = False).cuda(img.get_device())
-        segVec = torch.cat((segres, zerosVec), 1)
+        # 'img' is the output of features() already when the model trains from a feature store
+        segres = img if self.cached_features else self.features(img)
+        bs, ch, hi, wi = segres.size()
+
+        segres = segres.contiguous().view(bs, self.dim_inc_dim, hi*wi)
         # confirm: 'depth_mapping_3d' is 640*480 when the value is less than 0
-        segres = [torch.index_select(segVec[i], 0, depth_mapping_3d[i]) for i in xrange(bs)]
-        segres = torch.stack(segres).permute(0, 2, 1).contiguous().view(bs, self.dim_inc_dim, 60, 36, 60)
+        voxel_index = projection.compose(self.image_mapping, depth_mapping_3d, hi*wi)
+        segres = projection.project(segres, voxel_index).view(bs, self.dim_inc_dim, 60, 36, 60)
+
+        if self.sparse_head is not None:
+            # sparse3d.SparseHead: evaluation on the receptive field of the observed voxels only
+            return self.sparse_head(segres)
 
         x1 = self.relu(self.seq1(segres) + segres) # different from before
         x2 = self.relu(self.seq2(x1) + x1)
@@ -325,15 +382,33 @@ def main():
         ToTensor(),
         Normalize([.5282, .3914, .4266], [.1945, .2480, .1506])
     ])
-    train_dataset = TrainDataLoader(NYU_SAMPLE_TXT_TRAIN, NYU_NPZ_PATH_TRAIN, 'train', img_transform = input_transform)
-    val_dataset = TrainDataLoader(NYU_SAMPLE_TXT_TEST, NYU_NPZ_PATH_TEST, 'test', img_transform = input_transform)
+    train_dataset = TrainDataLoader(NYU_SAMPLE_TXT_TRAIN, NYU_NPZ_PATH_TRAIN, 'train', img_transform = input_transform,
+                                    mapping_path = configs.NYU_MAPPING_PATH_TRAIN if args.mapping_cache else None,
+                                    shard_path = configs.NYU_SHARD_PATH_TRAIN if args.shards else None,
+                                    image_cache_path = configs.NYU_IMAGE_CACHE_PATH_TRAIN if args.image_cache else None,
+                                    manifest_file = configs.NYU_MANIFEST_PATH_TRAIN if args.manifest else None,
+                                    revalidate_manifest = args.revalidate_manifest)
+    val_dataset = TrainDataLoader(NYU_SAMPLE_TXT_TEST, NYU_NPZ_PATH_TEST, 'test', img_transform = input_transform,
+                                  mapping_path = configs.NYU_MAPPING_PATH_TEST if args.mapping_cache else None,
+                                  shard_path = configs.NYU_SHARD_PATH_TEST if args.shards else None,
+                                  image_cache_path = configs.NYU_IMAGE_CACHE_PATH_TEST if args.image_cache else None,
+                                  manifest_file = configs.NYU_MANIFEST_PATH_TEST if args.manifest else None,
+                                  revalidate_manifest = args.revalidate_manifest)
 
     # load model
     model = ImageGen3DNet((384, 288))
 
-    chpo = torch.load('./pretrained_models/Depth_use.pth.tar')
+    chpo = torch.load('./pretrained_models/Depth_use.pth.tar', map_location = devices.map_location)
     model.load_state_dict(chpo['state_dict'])
-    print "=> ImageGen3D loaded checkpoint '{}'".format('./pretrained_models/Depth_use.pth.tar')
+    print("=> ImageGen3D loaded checkpoint '{}'".format('./pretrained_models/Depth_use.pth.tar'))
+
+    if args.feature_store:
+        # the 2D network stays as loaded, its features are computed once
+        train_dataset = feature_store.cache_features(model, train_dataset, configs.NYU_FEATURE_PATH_TRAIN, NYU_SAMPLE_TXT_TRAIN,
+                                                     batch_size = args.batch_size, workers = args.workers)
+        val_dataset = feature_store.cache_features(model, val_dataset, configs.NYU_FEATURE_PATH_TEST, NYU_SAMPLE_TXT_TEST,
+                                                   batch_size = args.batch_size, workers = args.workers)
+        model.cached_features = True
 
     # define loss function (criterion)
     cri_weights = torch.FloatTensor([0.5, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
@@ -348,6 +423,8 @@ def main():
              'save_iter': 0, 'print_freq': args.print_freq, 'epoch_step': []}
     state['save_model_path'] = './save_models/SATNet_Depth'
 
+    checkpointing.enable(model, args.checkpoint)
+
     engine = Engine(state)
     engine.learning(model, criterion, train_dataset, val_dataset, optimizer)
 
@@ -17,6 +17,15 @@ import torch.utils.data as torch_data
 from engine_fuse import Engine
 sys.path.append('../../')
 import configs
+from configs import *
+import depth_mapping
+import npz_shards
+import image_cache
+import projection
+import devices
+import manifest
+import checkpointing
+import pca_jitter
 
 
 parser = argparse.ArgumentParser(description='NYU SeeNetFuse Training')
@@ -40,6 +49,20 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--mapping-cache', dest='mapping_cache', action='store_true',
+                    help='read depth_mapping_3d from the cache built by depth_mapping.py')
+parser.add_argument('--shards', dest='shards', action='store_true',
+                    help='read labels, weights and depth_mapping_3d from the shards built by npz_shards.py')
+parser.add_argument('--image-cache', dest='image_cache', action='store_true',
+                    help='keep the resized RGB and HHA images in the image cache of configs.py')
+parser.add_argument('--pca-cache', dest='pca_cache', action='store_true',
+                    help='jitter colours per minibatch with the eigenvectors cached in configs.py')
+parser.add_argument('--manifest', dest='manifest', action='store_true',
+                    help='read the validated sample lists from the manifests of configs.py, see manifest.py')
+parser.add_argument('--revalidate-manifest', dest='revalidate_manifest', action='store_true',
+                    help='rescan the sample lists and rewrite their manifests')
+parser.add_argument('--checkpoint', default='', type=str, metavar='MODULES',
+                    help='recompute these blocks in backward instead of keeping their activations, e.g. ASPP3D, see checkpointing.py')
 
 
 def PCA_Jittering(img):
@@ -47,7 +70,7 @@ def PCA_Jittering(img):
     img = np.asanyarray(img, dtype = 'float32')
 
     img = img / 255.0
-    img_size = img.size / 3
+    img_size = img.size // 3
     img1 = img.reshape(img_size, 3)
     img1 = np.transpose(img1)
     img_cov = np.cov([img1[0], img1[1], img1[2]])
@@ -73,19 +96,16 @@ def PCA_Jittering(img):
 
 
 class TrainDataLoader(torch_data.Dataset):
-    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12):
+    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12, mapping_path = None, shard_path = None, image_cache_path = None, pca_cache_path = None, manifest_file = None, revalidate_manifest = False):
 
         super(TrainDataLoader, self).__init__()
 
-        fid = open(path, "r")
-        self.colorlist = []
-        for line in fid.readlines():
-            line = line.rstrip("\n")
-            if os.path.exists(line):
-                self.colorlist.append(line)
-        fid.close()
+        entries = manifest.read(path, lambda line: (line,), manifest_file, revalidate = revalidate_manifest)
+        self.colorlist = [paths[0] for paths in entries.paths]
 
         self.npz_path = npz_path
+        self.mapping_path = mapping_path
+        self.shards = npz_shards.ShardReader(shard_path) if shard_path is not None else None
 
         self.num_classes = num_classes
         self.color_transform = Compose([
@@ -101,11 +121,26 @@ class TrainDataLoader(torch_data.Dataset):
         self.resize_size = (384, 288) # 12:9
 
         if train_or_test == 'train':
-            self.filelist = np.arange(795)
+            self.filelist = np.arange(configs.NYU_NUM_TRAIN)
         else:
-            self.filelist = np.arange(654)
+            self.filelist = np.arange(configs.NYU_NUM_TEST)
 
         self.train_or_test = train_or_test
+        # turned off while feature_store.py or quantize.py runs the 2D network over the images
+        self.pca_jitter = True
+
+        self.color_cache = None
+        self.depth_cache = None
+        if image_cache_path is not None:
+            HHA_path = NYU_HHA_PATH_TRAIN if train_or_test == 'train' else NYU_HHA_PATH_TEST
+            self.color_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'RGB'), self.colorlist, self.resize_size)
+            self.depth_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'HHA'), ['%s/%06d.png'%(HHA_path, i+1) for i in self.filelist], self.resize_size)
+
+        self.eigen_cache = None
+        if pca_cache_path is not None:
+            # the jitter is applied to the whole minibatch by collate_fn, see pca_jitter.py
+            self.eigen_cache = pca_jitter.EigenCache(pca_cache_path, self.colorlist)
+            self.collate_fn = pca_jitter.PCAJitterCollate([.485, .456, .406], [.229, .224, .225])
 
     def __len__(self):
 
@@ -113,33 +148,47 @@ class TrainDataLoader(torch_data.Dataset):
 
     def __getitem__(self, index):
 
-        color = Image.open(self.colorlist[index]).convert('RGB')
-        color = color.resize(self.resize_size, Image.ANTIALIAS)
+        if self.color_cache is not None:
+            color = self.color_cache.get(index)
+        else:
+            color = Image.open(self.colorlist[index]).convert('RGB')
+            color = color.resize(self.resize_size, Image.LANCZOS)
         if self.train_or_test == "train":
-            color = PCA_Jittering(color)
+            if self.eigen_cache is not None:
+                eigen = self.eigen_cache.get(index, color)
+            elif self.pca_jitter:
+                color = PCA_Jittering(color)
         color = self.color_transform(color)
 
-        if self.train_or_test == 'train':
-            depth = Image.open('%s/%06d.png'%(NYU_HHA_PATH_TRAIN, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+        if self.depth_cache is not None:
+            depth = self.depth_cache.get(index)
         else:
-            depth = Image.open('%s/%06d.png'%(NYU_HHA_PATH_TEST, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
-        depth = depth.resize(self.resize_size, Image.ANTIALIAS)
+            if self.train_or_test == 'train':
+                depth = Image.open('%s/%06d.png'%(NYU_HHA_PATH_TRAIN, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+            else:
+                depth = Image.open('%s/%06d.png'%(NYU_HHA_PATH_TEST, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+            depth = depth.resize(self.resize_size, Image.LANCZOS)
         depth = self.depth_transform(depth)
 
-        loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
-
-        # shurans
-        label = torch.LongTensor(loaddata['arr_1'].astype(np.int64))
-        label_weight = torch.FloatTensor(loaddata['arr_2'].astype(np.float32))
-        mapping = loaddata['arr_3'].astype(np.int64)
-        mapping1 = np.ones((8294400), dtype = np.int64)
-        mapping1[:] = -1
-        ind, = np.where(mapping>=0)
-        mapping1[mapping[ind]] = ind
-        mapping2 = torch.autograd.Variable(torch.FloatTensor(mapping1.reshape((1,1,240,144,240)).astype(np.float32)))
-        mapping2 = torch.nn.MaxPool3d(4,4)(mapping2).data.view(-1).numpy()
-        mapping2[mapping2<0] = 307200
-        depth_mapping_3d = torch.LongTensor(mapping2.astype(np.int64))
+        if self.shards is not None:
+            label, label_weight, mapping = self.shards.get(self.filelist[index])
+        else:
+            loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
+            label = loaddata['arr_1']
+            label_weight = loaddata['arr_2']
+            if self.mapping_path is not None:
+                mapping = depth_mapping.load(self.mapping_path, self.filelist[index])
+            else:
+                mapping = depth_mapping.compute(loaddata['arr_3'])
+
+        # shurans, sent as uint8 labels, a uint8 weight mask and int32 mappings.
+        # The engines widen them on the device, see Engine.on_adapt_batch.
+        label = torch.from_numpy(np.array(label, dtype = np.uint8))
+        label_weight = torch.from_numpy((np.asarray(label_weight) != 0).astype(np.uint8))
+        depth_mapping_3d = torch.from_numpy(np.array(mapping, dtype = np.int32))
+
+        if self.eigen_cache is not None:
+            return color, depth, label, label_weight, depth_mapping_3d, eigen
 
         return color, depth, label, label_weight, depth_mapping_3d
 
@@ -151,8 +200,14 @@ class DUC(nn.Module):
         self.conv = nn.Conv2d(inplanes, planes, kernel_size=3, padding=1, bias = False)
         self.bn = nn.BatchNorm2d(planes)
         self.pixel_shuffle = nn.PixelShuffle(upscale_factor)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint DUC, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         x = self.conv(x)
         x = self.bn(x)
         x = self.relu(x)
@@ -354,8 +409,14 @@ class ASPP3D(nn.Module):
         self.conv2 = nn.ModuleList([nn.Conv3d(planes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
         self.bn2 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
         self.relu = nn.ReLU(inplace=True)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint ASPP3D, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         
         y = self.bn2[0](self.conv2[0](self.relu(self.bn1[0](self.conv1[0](x)))))
         for i in range(1, len(self.conv_list)):
@@ -400,7 +461,7 @@ class ImageGen3DNet(nn.Module):
 
         self.img_required_size = (640, 480)
         self.img_size = img_size
-        if cmp(self.img_required_size, self.img_size) != 0:
+        if self.img_required_size != self.img_size:
             x = np.array(range(self.img_required_size[0]), dtype = np.float32)
             y = np.array(range(self.img_required_size[1]), dtype = np.float32)
             scale = 1.0 * self.img_size[0] / self.img_required_size[0]
@@ -422,19 +483,20 @@ class ImageGen3DNet(nn.Module):
         self.register_buffer('image_mapping', torch.autograd.Variable(torch.LongTensor(image_mapping1), requires_grad=False))
 
         self.dim_inc_dim = 64
+        self.sparse_head = None
 
     def forward(self, img, depth, depth_mapping_3d):
         
         bs, ch, hi, wi = img.size()
         
-        segres = self.seg2d(img, depth).contiguous().view(bs*self.dim_inc_dim, hi*wi)
-        segres = torch.index_select(segres, 1, self.image_mapping).contiguous().view(
-            bs, self.dim_inc_dim, self.img_required_size[0]*self.img_required_size[1]).permute(0, 2, 1)
-        zerosVec = Variable(torch.zeros(bs, 1, self.dim_inc_dim), requires_grad = False).cuda(img.get_device())
-        segVec = torch.cat((segres, zerosVec), 1)
+        segres = self.seg2d(img, depth).contiguous().view(bs, self.dim_inc_dim, hi*wi)
         # confirm: 'depth_mapping_3d' is 640*480 when the value is less than 0
-        segres = [torch.index_select(segVec[i], 0, depth_mapping_3d[i]) for i in xrange(bs)]
-        segres = torch.stack(segres).permute(0, 2, 1).contiguous().view(bs, self.dim_inc_dim, 60, 36, 60)
+        voxel_index = projection.compose(self.image_mapping, depth_mapping_3d, hi*wi)
+        segres = projection.project(segres, voxel_index).view(bs, self.dim_inc_dim, 60, 36, 60)
+
+        if self.sparse_head is not None:
+            # sparse3d.SparseHead: evaluation on the receptive field of the observed voxels only
+            return self.sparse_head(segres)
 
         x1 = self.relu(self.seq1(segres) + segres) # different from before
         x2 = self.relu(self.seq2(x1) + x1)
@@ -462,15 +524,26 @@ def main():
     use_gpu = torch.cuda.is_available()
 
     # define dataset
-    train_dataset = TrainDataLoader(NYU_SAMPLE_TXT_TRAIN, NYU_NPZ_PATH_TRAIN, 'train')
-    val_dataset = TrainDataLoader(NYU_SAMPLE_TXT_TEST, NYU_NPZ_PATH_TEST, 'test')
+    train_dataset = TrainDataLoader(NYU_SAMPLE_TXT_TRAIN, NYU_NPZ_PATH_TRAIN, 'train',
+                                    mapping_path = configs.NYU_MAPPING_PATH_TRAIN if args.mapping_cache else None,
+                                    shard_path = configs.NYU_SHARD_PATH_TRAIN if args.shards else None,
+                                    image_cache_path = configs.NYU_IMAGE_CACHE_PATH_TRAIN if args.image_cache else None,
+                                    pca_cache_path = configs.NYU_PCA_CACHE_PATH_TRAIN if args.pca_cache else None,
+                                    manifest_file = configs.NYU_MANIFEST_PATH_TRAIN if args.manifest else None,
+                                    revalidate_manifest = args.revalidate_manifest)
+    val_dataset = TrainDataLoader(NYU_SAMPLE_TXT_TEST, NYU_NPZ_PATH_TEST, 'test',
+                                  mapping_path = configs.NYU_MAPPING_PATH_TEST if args.mapping_cache else None,
+                                  shard_path = configs.NYU_SHARD_PATH_TEST if args.shards else None,
+                                  image_cache_path = configs.NYU_IMAGE_CACHE_PATH_TEST if args.image_cache else None,
+                                  manifest_file = configs.NYU_MANIFEST_PATH_TEST if args.manifest else None,
+                                  revalidate_manifest = args.revalidate_manifest)
 
     # load model
     model = ImageGen3DNet((384, 288))
 
-    chpo = torch.load('./pretrained_models/SeeNetFuse_use.pth.tar')
+    chpo = torch.load('./pretrained_models/SeeNetFuse_use.pth.tar', map_location = devices.map_location)
     model.load_state_dict(chpo['state_dict'])
-    print "=> ImageGen3D loaded checkpoint '{}'".format('./pretrained_models/SeeNetFuse_use.pth.tar')
+    print("=> ImageGen3D loaded checkpoint '{}'".format('./pretrained_models/SeeNetFuse_use.pth.tar'))
 
     # define loss function (criterion)
     cri_weights = torch.FloatTensor([0.5, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
@@ -485,6 +558,8 @@ def main():
              'save_iter': 0, 'print_freq': args.print_freq, 'epoch_step': []}
     state['save_model_path'] = './save_models/SATNet_SeeNetFuse'
 
+    checkpointing.enable(model, args.checkpoint)
+
     engine = Engine(state)
     engine.learning(model, criterion, train_dataset, val_dataset, optimizer)
 
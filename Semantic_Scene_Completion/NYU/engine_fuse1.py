@@ -1,4 +1,5 @@
 import os
+import sys
 import shutil
 import time
 
@@ -11,11 +12,14 @@ import torch.backends.cudnn as cudnn
 import torch.nn.parallel
 import torch.optim
 import torch.utils.data
+from torch.utils.data.dataloader import default_collate
 from torch.nn import Parameter
 import visdom
 import time
 
 import IOU
+sys.path.append('../../')
+import devices
 
 class Engine(object):
     def __init__(self, state={}):
@@ -97,10 +101,12 @@ class Engine(object):
         self.state['data_time_total'] = 0.0
         self.state['data_time_num'] = 0
 
-        self.state['accuracy_total'] = np.zeros((3, 11), dtype = np.float32)
+        # the sum of IOU.confusion() over the epoch, on the device of the outputs
+        self.state['confusion_total'] = 0
 
     def on_end_epoch(self, training, model, criterion, data_loader, optimizer=None, display=True):
         loss = self.state['meter_loss_total'] / self.state['meter_loss_num']
+        self.state['accuracy_total'] = IOU.counts(self.state['confusion_total'], 12)
         accuracy = self.state['accuracy_total'][0] / (np.sum(self.state['accuracy_total'], 0) + 0.00001)
         accuracy_mean = np.mean(accuracy)
         if display:
@@ -110,7 +116,7 @@ class Engine(object):
                       'Accuracy {accuracy:.4f}'.format(self.state['epoch'], loss=loss, accuracy=accuracy_mean))
             else:
                 print('Test: \t Loss {loss:.4f} \t Accuracy {accuracy:.4f}'.format(loss=loss, accuracy=accuracy_mean))
-            print 'Obj_class: ' + np.array_str(accuracy)
+            print('Obj_class: ' + np.array_str(accuracy))
         return loss, accuracy_mean
 
     def on_start_batch(self, training, model, criterion, data_loader, optimizer=None, display=True):
@@ -155,6 +161,15 @@ class Engine(object):
                     batch_time=batch_time, data_time_current=self.state['data_time_batch'],
                     data_time=data_time, loss_current=self.state['loss_batch'], loss=loss))
 
+    def on_adapt_batch(self, training, model, criterion, data_loader, optimizer=None):
+
+        # the datasets send uint8 labels, a uint8 weight mask and int32 mappings to keep the
+        # batches small, they are widened here once they are on the compute device
+        self.state['target'] = self.state['target'].long()
+        self.state['target_weight'] = self.state['target_weight'].float()
+        self.state['depth_mapping_3d_0'] = self.state['depth_mapping_3d_0'].long()
+        self.state['depth_mapping_3d_1'] = self.state['depth_mapping_3d_1'].long()
+
     def on_forward(self, training, model, criterion, data_loader, optimizer=None, display=True):
 
         input_var = torch.autograd.Variable(self.state['input'], requires_grad=True)
@@ -172,7 +187,7 @@ class Engine(object):
                 0,2,3,4,1).contiguous().view(-1,12), 0, self.selectindex)
             self.state['loss'] = criterion(self.filterOutput, self.filterLabel)
             
-            self.state['accuracy_total'] += IOU.computeIOU(self.state['output'].data, self.state['target'], 12)
+            self.state['confusion_total'] += IOU.confusion(self.state['output'].data, self.state['target'], 12)
 
             optimizer.zero_grad()
             self.state['loss'].backward()
@@ -186,7 +201,7 @@ class Engine(object):
                     0,2,3,4,1).contiguous().view(-1,12), 0, self.selectindex)
                 self.state['loss'] = criterion(self.filterOutput, self.filterLabel)
 
-                self.state['accuracy_total'] += IOU.computeIOU(self.state['output'].data, self.state['target'], 12)
+                self.state['confusion_total'] += IOU.confusion(self.state['output'].data, self.state['target'], 12)
 
         # draw on visdom
         # if self.state['iteration'] != 0 and self.state['iteration'] % self.state['image_visdom_iters'] == 0:
@@ -216,17 +231,19 @@ class Engine(object):
         # data loading code
         train_loader = torch.utils.data.DataLoader(train_dataset,
                                                    batch_size=self.state['batch_size'], shuffle=True,
-                                                   num_workers=self.state['workers'])
+                                                   num_workers=self.state['workers'],
+                                                   collate_fn=getattr(train_dataset, 'collate_fn', default_collate))
 
         val_loader = torch.utils.data.DataLoader(val_dataset,
                                                  batch_size=self.state['batch_size'], shuffle=False,
-                                                 num_workers=self.state['workers'])
+                                                 num_workers=self.state['workers'],
+                                                 collate_fn=getattr(val_dataset, 'collate_fn', default_collate))
 
         # optionally resume from a checkpoint
         if self._state('resume') is not None:
             if os.path.isfile(self.state['resume']):
                 print("=> loading checkpoint '{}'".format(self.state['resume']))
-                checkpoint = torch.load(self.state['resume'])
+                checkpoint = torch.load(self.state['resume'], map_location = devices.map_location)
                 self.state['start_epoch'] = checkpoint['epoch']
                 self.state['best_score'] = checkpoint['best_score']
                 model.load_state_dict(checkpoint['state_dict'], False)
@@ -240,7 +257,7 @@ class Engine(object):
         val_loader.pin_memory = True
         cudnn.benchmark = True
 
-        criterion = criterion.cuda(0)
+        criterion = criterion.to(model.device_map['fuse'])
 
         if self.state['evaluate']:
             self.validate(val_loader, model, criterion)
@@ -301,12 +318,14 @@ class Engine(object):
 
             self.on_start_batch(True, model, criterion, data_loader, optimizer)
 
-            self.state['input'] = self.state['input'].cuda(device = 0, async=True)
-            self.state['depth'] = self.state['depth'].cuda(device = 1, async=True)
-            self.state['target'] = self.state['target'].cuda(device = 0, async=True)
-            self.state['target_weight'] = self.state['target_weight'].cuda(device = 0, async=True)
-            self.state['depth_mapping_3d_0'] = self.state['depth_mapping_3d'].cuda(device = 0, async=True)
-            self.state['depth_mapping_3d_1'] = self.state['depth_mapping_3d'].cuda(device = 1, async=True)
+            self.state['input'] = self.state['input'].to(model.device_map['image'], non_blocking = True)
+            self.state['depth'] = self.state['depth'].to(model.device_map['depth'], non_blocking = True)
+            self.state['target'] = self.state['target'].to(model.device_map['fuse'], non_blocking = True)
+            self.state['target_weight'] = self.state['target_weight'].to(model.device_map['fuse'], non_blocking = True)
+            self.state['depth_mapping_3d_0'] = self.state['depth_mapping_3d'].to(model.device_map['image'], non_blocking = True)
+            self.state['depth_mapping_3d_1'] = self.state['depth_mapping_3d'].to(model.device_map['depth'], non_blocking = True)
+
+            self.on_adapt_batch(True, model, criterion, data_loader, optimizer)
 
             self.on_forward(True, model, criterion, data_loader, optimizer)
 
@@ -319,7 +338,7 @@ class Engine(object):
             self.on_end_batch(True, model, criterion, data_loader, optimizer)
 
             if self.state['save_iter'] != 0 and i != 0 and i % self.state['save_iter'] == 0:
-                print 'save checkpoint once!'
+                print('save checkpoint once!')
                 self.save_checkpoint({
                     'epoch': epoch + 1,
                     'arch': self._state('arch'),
@@ -353,12 +372,14 @@ class Engine(object):
 
             self.on_start_batch(False, model, criterion, data_loader)
 
-            self.state['input'] = self.state['input'].cuda(device = 0, async=True)
-            self.state['depth'] = self.state['depth'].cuda(device = 1, async=True)
-            self.state['target'] = self.state['target'].cuda(device = 0, async=True)
-            self.state['target_weight'] = self.state['target_weight'].cuda(device = 0, async=True)
-            self.state['depth_mapping_3d_0'] = self.state['depth_mapping_3d'].cuda(device = 0, async=True)
-            self.state['depth_mapping_3d_1'] = self.state['depth_mapping_3d'].cuda(device = 1, async=True)
+            self.state['input'] = self.state['input'].to(model.device_map['image'], non_blocking = True)
+            self.state['depth'] = self.state['depth'].to(model.device_map['depth'], non_blocking = True)
+            self.state['target'] = self.state['target'].to(model.device_map['fuse'], non_blocking = True)
+            self.state['target_weight'] = self.state['target_weight'].to(model.device_map['fuse'], non_blocking = True)
+            self.state['depth_mapping_3d_0'] = self.state['depth_mapping_3d'].to(model.device_map['image'], non_blocking = True)
+            self.state['depth_mapping_3d_1'] = self.state['depth_mapping_3d'].to(model.device_map['depth'], non_blocking = True)
+
+            self.on_adapt_batch(False, model, criterion, data_loader)
 
             self.on_forward(False, model, criterion, data_loader)
 
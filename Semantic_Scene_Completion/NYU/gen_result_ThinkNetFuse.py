@@ -1,17 +1,28 @@
 from SATNet_ThinkNetFuse import ImageGen3DNet, TrainDataLoader # HERE
-import sys, resource, os
+import argparse, sys, resource, os
 import numpy as np
 import cv2
 import torch
 from torchvision.transforms import Compose, Normalize, ToTensor
 import torch.backends.cudnn as cudnn
-import h5py
 sys.path.append('../../')
 import configs
+from configs import *
+import devices
+import h5_writer
+import inference
 
 
-# CUDA_VISIBLE_DEVICES=0,1 python gen_result_ThinkNetFuse.py
+parser = argparse.ArgumentParser(description='Write the softmax scores of the test set to an HDF5 file')
+parser.add_argument('--compression', default=None, choices=['gzip', 'lzf'],
+                    help='of the result dataset, see h5_writer.py (default: none)')
+parser.add_argument('--compression-level', default=None, type=int, metavar='N',
+                    help='of gzip, 0-9 (default: 4)')
+
+
+# CUDA_VISIBLE_DEVICES=0,1 python gen_result_ThinkNetFuse.py [--compression gzip]
 def main():
+    args = parser.parse_args()
     cudnn.benchmark = True
     resume_path = './save_models/SATNet_ThinkNetFuse/checkpoint.pth.tar' # HERE
     output_path = './results/nyu_pred.hdf5'
@@ -24,32 +35,29 @@ def main():
     # model = SceneCompletionRGBD()
     model = ImageGen3DNet()
     if not os.path.isfile(resume_path):
-        print "=> no checkpoint found at '{}'".format(resume_path)
+        print("=> no checkpoint found at '{}'".format(resume_path))
         exit()
-    checkpoint = torch.load(resume_path)
+    checkpoint = torch.load(resume_path, map_location = devices.map_location)
     model.load_state_dict(checkpoint['state_dict'])
+    model = inference.freeze_for_inference(model) # eval mode, BatchNorm folded into the convolutions
 
-    softmax_layer = torch.nn.Softmax(dim = 1).cuda()
+    softmax_layer = torch.nn.Softmax(dim = 1)
 
-    predictions = []
+    writer = h5_writer.ResultWriter(output_path, (12, 60, 36, 60), # every batch is written when it is done
+                                    compression = args.compression, compression_opts = args.compression_level)
     with torch.no_grad():
         for i, (color, depth, label, label_weight, depth_mapping_3d) in enumerate(data_loader):
-            print '{0}/{1}'.format(i, len(data_loader))
+            print('{0}/{1}'.format(i, len(data_loader)))
 
-            input_var = torch.autograd.Variable(color.cuda(0, async=True))
-            depth_var = torch.autograd.Variable(depth.cuda(1, async=True))
-            depth_mapping_3d_var0 = torch.autograd.Variable(depth_mapping_3d.cuda(0, async=True))
-            depth_mapping_3d_var1 = torch.autograd.Variable(depth_mapping_3d.cuda(1, async=True))
+            input_var = torch.autograd.Variable(color.to(model.device_map['image'], non_blocking = True))
+            depth_var = torch.autograd.Variable(depth.to(model.device_map['depth'], non_blocking = True))
+            depth_mapping_3d_var0 = torch.autograd.Variable(depth_mapping_3d.to(model.device_map['image'], non_blocking = True).long())
+            depth_mapping_3d_var1 = torch.autograd.Variable(depth_mapping_3d.to(model.device_map['depth'], non_blocking = True).long())
 
             output = model(input_var, depth_var, depth_mapping_3d_var0, depth_mapping_3d_var1)
             output = softmax_layer(output)
-            predictions.append(output.cpu().data.numpy())
-        predictions = np.vstack(predictions)
-
-    fp = h5py.File(output_path, 'w')
-    result = fp.create_dataset('result', predictions.shape, dtype='f')
-    result[...] = predictions
-    fp.close()
+            writer.append(output.cpu().data.numpy())
+    writer.close()
 
 if __name__ == '__main__':
 
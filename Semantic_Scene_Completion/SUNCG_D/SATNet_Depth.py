@@ -17,6 +17,14 @@ import torch.utils.data as torch_data
 from engine_depth import Engine
 sys.path.append('../../')
 import configs
+from configs import *
+import depth_mapping
+import npz_shards
+import image_cache
+import projection
+import devices
+import feature_store
+import checkpointing
 
 
 parser = argparse.ArgumentParser(description='SUNCGD Depth Training')
@@ -40,6 +48,16 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--mapping-cache', dest='mapping_cache', action='store_true',
+                    help='read depth_mapping_3d from the cache built by depth_mapping.py')
+parser.add_argument('--shards', dest='shards', action='store_true',
+                    help='read labels, weights and depth_mapping_3d from the shards built by npz_shards.py')
+parser.add_argument('--image-cache', dest='image_cache', action='store_true',
+                    help='keep the resized RGB and HHA images in the image cache of configs.py')
+parser.add_argument('--feature-store', dest='feature_store', action='store_true',
+                    help='train the 3D part only, from the 2D features kept in the feature store of configs.py (14 MB a sample, checked against the free space first)')
+parser.add_argument('--checkpoint', default='', type=str, metavar='MODULES',
+                    help='recompute these blocks in backward instead of keeping their activations, e.g. ASPP3D, see checkpointing.py')
 
 
 class DUC(nn.Module):
@@ -49,8 +67,14 @@ class DUC(nn.Module):
         self.conv = nn.Conv2d(inplanes, planes, kernel_size=3, padding=1, bias = False)
         self.bn = nn.BatchNorm2d(planes)
         self.pixel_shuffle = nn.PixelShuffle(upscale_factor)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint DUC, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         x = self.conv(x)
         x = self.bn(x)
         x = self.relu(x)
@@ -154,8 +178,14 @@ class ASPP3D(nn.Module):
         self.conv2 = nn.ModuleList([nn.Conv3d(planes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
         self.bn2 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
         self.relu = nn.ReLU(inplace=True)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint ASPP3D, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         
         y = self.bn2[0](self.conv2[0](self.relu(self.bn1[0](self.conv1[0](x)))))
         for i in range(1, len(self.conv_list)):
@@ -171,9 +201,9 @@ class ImageGen3DNet(nn.Module):
 
         self.seg2d = Seg2DNet(model = models.resnet101(False), num_classes = 12)
         
-        chpo = torch.load(seg2d_path)
+        chpo = torch.load(seg2d_path, map_location = devices.map_location)
         self.seg2d.load_state_dict(chpo['state_dict'], strict = False)
-        print "=> seg2d loaded checkpoint '{}'".format(seg2d_path)
+        print("=> seg2d loaded checkpoint '{}'".format(seg2d_path))
 
         self.seq1 = nn.Sequential(
             nn.Conv3d(64, 64, 3, padding = 1, bias = False),
@@ -205,7 +235,7 @@ class ImageGen3DNet(nn.Module):
 
         self.img_required_size = (640, 480)
         self.img_size = img_size
-        if cmp(self.img_required_size, self.img_size) != 0:
+        if self.img_required_size != self.img_size:
             x = np.array(range(self.img_required_size[0]), dtype = np.float32)
             y = np.array(range(self.img_required_size[1]), dtype = np.float32)
             scale = 1.0 * self.img_size[0] / self.img_required_size[0]
@@ -227,21 +257,28 @@ class ImageGen3DNet(nn.Module):
         self.register_buffer('image_mapping', torch.autograd.Variable(torch.LongTensor(image_mapping1), requires_grad=False))
 
         self.dim_inc_dim = 64
+        self.sparse_head = None
+        self.cached_features = False
+
+    def features(self, img):
+        # the 2D features the voxels are projected from, (bs, 64, hi, wi)
+
+        return self.seg2d(img)[0]
 
     def forward(self, img, depth_mapping_3d):
         
-        bs, ch, hi, wi = img.size()
-        
-        tempseg = self.seg2d(img)[0]
-        
-        segres = tempseg.contiguous().view(bs*self.dim_inc_dim, hi*wi)
-        segres = torch.index_select(segres, 1, self.image_mapping).contiguous().view(
-            bs, self.dim_inc_dim, self.img_required_size[0]*self.img_required_size[1]).permute(0, 2, 1)
-        zerosVec = Variable(torch.zeros(bs, 1, self.dim_inc_dim), requires_grad = False).cuda(img.get_device())
-        segVec = torch.cat((segres, zerosVec), 1)
+        # 'img' is the output of features() already when the model trains from a feature store
+        segres = img if self.cached_features else self.features(img)
+        bs, ch, hi, wi = segres.size()
+
+        segres = segres.contiguous().view(bs, self.dim_inc_dim, hi*wi)
         # confirm: 'depth_mapping_3d' is 640*480 when the value is less than 0
-        segres = [torch.index_select(segVec[i], 0, depth_mapping_3d[i]) for i in xrange(bs)]
-        segres = torch.stack(segres).permute(0, 2, 1).contiguous().view(bs, self.dim_inc_dim, 60, 36, 60)
+        voxel_index = projection.compose(self.image_mapping, depth_mapping_3d, hi*wi)
+        segres = projection.project(segres, voxel_index).view(bs, self.dim_inc_dim, 60, 36, 60)
+
+        if self.sparse_head is not None:
+            # sparse3d.SparseHead: evaluation on the receptive field of the observed voxels only
+            return self.sparse_head(segres)
 
         x1 = self.relu(self.seq1(segres) + segres) # different from before
         x2 = self.relu(self.seq2(x1) + x1)
@@ -265,17 +302,19 @@ class ImageGen3DNet(nn.Module):
 
 # use shurans' dataset to train, not my_selected
 class TrainDataLoader(torch_data.Dataset):
-    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12):
+    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12, mapping_path = None, shard_path = None, image_cache_path = None):
 
         super(TrainDataLoader, self).__init__()
 
         self.path = path
         self.npz_path = npz_path
+        self.mapping_path = mapping_path
+        self.shards = npz_shards.ShardReader(shard_path) if shard_path is not None else None
 
         if train_or_test == 'train':
-            self.filelist = np.arange(139368)
+            self.filelist = np.arange(configs.SUNCGD_NUM_TRAIN)
         else:
-            self.filelist = np.arange(470)
+            self.filelist = np.arange(configs.SUNCGD_NUM_TEST)
 
         self.num_classes = num_classes
         self.img_transform = img_transform
@@ -285,30 +324,45 @@ class TrainDataLoader(torch_data.Dataset):
 
         self.train_or_test = train_or_test
 
+        self.color_cache = None
+        if image_cache_path is not None:
+            self.color_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'HHA'), ['%s/%06d.png'%(self.path, i+1) for i in self.filelist], self.resize_size)
+
     def __len__(self):
 
         return self.filelist.shape[0]
 
+    def targets(self, index):
+        # label, label_weight and depth_mapping_3d of a sample, without reading its image
+        if self.shards is not None:
+            label, label_weight, mapping = self.shards.get(self.filelist[index])
+        else:
+            loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
+            label = loaddata['arr_1']
+            label_weight = loaddata['arr_2']
+            if self.mapping_path is not None:
+                mapping = depth_mapping.load(self.mapping_path, self.filelist[index])
+            else:
+                mapping = depth_mapping.compute(loaddata['arr_3'])
+
+        # shurans, sent as uint8 labels, a uint8 weight mask and int32 mappings.
+        # The engines widen them on the device, see Engine.on_adapt_batch.
+        label = torch.from_numpy(np.array(label, dtype = np.uint8))
+        label_weight = torch.from_numpy((np.asarray(label_weight) != 0).astype(np.uint8))
+        depth_mapping_3d = torch.from_numpy(np.array(mapping, dtype = np.int32))
+
+        return label, label_weight, depth_mapping_3d
+
     def __getitem__(self, index):
 
-        color = Image.open('%s/%06d.png'%(self.path, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
-        color = color.resize(self.resize_size, Image.ANTIALIAS)
+        if self.color_cache is not None:
+            color = self.color_cache.get(index)
+        else:
+            color = Image.open('%s/%06d.png'%(self.path, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+            color = color.resize(self.resize_size, Image.LANCZOS)
         color = self.img_transform(color)
 
-        loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
-
-        # shurans
-        label = torch.LongTensor(loaddata['arr_1'].astype(np.int64))
-        label_weight = torch.FloatTensor(loaddata['arr_2'].astype(np.float32))
-        mapping = loaddata['arr_3'].astype(np.int64)
-        mapping1 = np.ones((8294400), dtype = np.int64)
-        mapping1[:] = -1
-        ind, = np.where(mapping>=0)
-        mapping1[mapping[ind]] = ind
-        mapping2 = torch.autograd.Variable(torch.FloatTensor(mapping1.reshape((1,240,144,240)).astype(np.float32)))
-        mapping2 = torch.nn.MaxPool3d(4,4)(mapping2).data.view(-1).numpy()
-        mapping2[mapping2<0] = 307200
-        depth_mapping_3d = torch.LongTensor(mapping2.astype(np.int64))
+        label, label_weight, depth_mapping_3d = self.targets(index)
 
         return color, label, label_weight, depth_mapping_3d
 
@@ -324,12 +378,26 @@ def main():
         ToTensor(),
         Normalize([.5282, .3914, .4266], [.1945, .2480, .1506])
     ])
-    train_dataset = TrainDataLoader(SUNCGD_HHA_PATH_TRAIN, SUNCGD_NPZ_PATH_TRAIN, 'train', img_transform = input_transform)
-    val_dataset = TrainDataLoader(SUNCGD_HHA_PATH_TEST, SUNCGD_NPZ_PATH_TEST, 'test', img_transform = input_transform)
+    train_dataset = TrainDataLoader(SUNCGD_HHA_PATH_TRAIN, SUNCGD_NPZ_PATH_TRAIN, 'train', img_transform = input_transform,
+                                    mapping_path = configs.SUNCGD_MAPPING_PATH_TRAIN if args.mapping_cache else None,
+                                    shard_path = configs.SUNCGD_SHARD_PATH_TRAIN if args.shards else None,
+                                    image_cache_path = configs.SUNCGD_IMAGE_CACHE_PATH_TRAIN if args.image_cache else None)
+    val_dataset = TrainDataLoader(SUNCGD_HHA_PATH_TEST, SUNCGD_NPZ_PATH_TEST, 'test', img_transform = input_transform,
+                                  mapping_path = configs.SUNCGD_MAPPING_PATH_TEST if args.mapping_cache else None,
+                                  shard_path = configs.SUNCGD_SHARD_PATH_TEST if args.shards else None,
+                                  image_cache_path = configs.SUNCGD_IMAGE_CACHE_PATH_TEST if args.image_cache else None)
 
     # load model
     model = ImageGen3DNet('../../Semantic_Segmentation/save_models/seg_depth_suncg/checkpoint.pth.tar', (384, 288))
 
+    if args.feature_store:
+        # the 2D network stays as loaded, its features are computed once
+        train_dataset = feature_store.cache_features(model, train_dataset, configs.SUNCGD_FEATURE_PATH_TRAIN,
+                                                     batch_size = args.batch_size, workers = args.workers)
+        val_dataset = feature_store.cache_features(model, val_dataset, configs.SUNCGD_FEATURE_PATH_TEST,
+                                                   batch_size = args.batch_size, workers = args.workers)
+        model.cached_features = True
+
     # define loss function (criterion)
     cri_weights = torch.FloatTensor([0.5, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
     criterion = nn.CrossEntropyLoss(weight = cri_weights/torch.sum(cri_weights))
@@ -343,6 +411,8 @@ def main():
              'save_iter': 1200, 'print_freq': args.print_freq, 'epoch_step': [2]}
     state['save_model_path'] = './save_models/SATNet_Depth'
 
+    checkpointing.enable(model, args.checkpoint)
+
     engine = Engine(state)
     engine.learning(model, criterion, train_dataset, val_dataset, optimizer)
 
@@ -5,30 +5,48 @@ import numpy as np
 
 # tensor size is (batchsize, ...)
 # channel0 is void and isn't counted.
+# confusion() counts the (label, prediction) pairs of a batch with one bincount on the device
+# of the output. Labels outside [0, num_classes) get a row of their own, so they count as
+# false positives of the predicted class, like any label that is not that class. The engines
+# add the matrices up over an epoch and call counts() once at its end.
+def confusion(output, label, num_classes = 12):
+    prediction = torch.max(output, 1)[1].view(-1)
+    label = label.view(-1).long().to(prediction.device)
+    if prediction.size(0) != label.size(0):
+        raise ValueError("Tensors' sizes don't equal. The output has %d voxels, but the label has %d." % (
+            prediction.size(0), label.size(0)))
+
+    label = label.masked_fill((label < 0) | (label >= num_classes), num_classes)
+    pairs = torch.bincount(label*num_classes + prediction, minlength = (num_classes + 1)*num_classes)
+
+    return pairs.view(num_classes + 1, num_classes)
+
+
+# tp fp fn of the classes 1.. from a sum of confusion() matrices, 0 when there was no batch.
+# These are voxel counts. Before confusion() they were twice as large: the old loop took
+# nonzero().nelement() of (batch, voxel) tensors, two indices per voxel. The IoU is the same,
+# but raw tp/fp/fn from older logs or saved states are not comparable with these.
+def counts(confusion, num_classes = 12):
+    result = np.zeros((3, num_classes-1), dtype = np.float32)
+    if not torch.is_tensor(confusion):
+        return result
+
+    pairs = confusion.cpu().numpy().astype(np.float64)
+    tp = np.diag(pairs[:num_classes])
+    result[0] = tp[1:]
+    result[1] = (pairs.sum(0) - tp)[1:]
+    result[2] = (pairs[:num_classes].sum(1) - tp)[1:]
+
+    return result
+
+
+# (3, num_classes-1) tp fp fn of a batch, the voxel counts of counts() (half of what this
+# returned before confusion(), see above)
 def computeIOU(output, label, num_classes = 12):
-    output1, output2 = torch.max(output, 1)
-
-    batchsize = output2.size(0)
-    output2 = output2.view(batchsize, -1)
-    label2 = label.view(batchsize, -1)
-    
-    if output2.size(1) != label2.size(1):
-        print "Tensors' sizes don't equal. Tensor1 is (%d,%d), but tensor2 is (%d,%d)."%(
-            batchsize, output2.size(1), batchsize, label2.size(1))
+    batchsize = output.size(0)
+    if output[0, 0].nelement() != label[0].nelement():
+        print("Tensors' sizes don't equal. Tensor1 is (%d,%d), but tensor2 is (%d,%d)."%(
+            batchsize, output[0, 0].nelement(), batchsize, label[0].nelement()))
         return -1
 
-    # tp fp fn
-    result = np.zeros((3, num_classes-1), dtype = np.float32)
-    for i in range(1, num_classes):
-        a = torch.eq(output2, i)
-        b = torch.ne(output2, i)
-        c = torch.eq(label2, i)
-        d = torch.ne(label2, i)
-        tp = torch.mul(a, c)
-        fp = torch.mul(a, d)
-        fn = torch.mul(b, c)
-        result[0, i-1] += torch.nonzero(tp).nelement()
-        result[1, i-1] += torch.nonzero(fp).nelement()
-        result[2, i-1] += torch.nonzero(fn).nelement()
-
-    return result
\ No newline at end of file
+    return counts(confusion(output, label, num_classes), num_classes)
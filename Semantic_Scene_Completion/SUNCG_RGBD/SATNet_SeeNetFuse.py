@@ -14,10 +14,17 @@ from torch.nn import Parameter
 import torch.optim as optim
 import torch.utils.data as torch_data
 
-sys.path.append('../../Semantic_Segmentation/')
-from seg_fuse_suncg import PCA_Jittering
 sys.path.append('../../')
 import configs
+from configs import *
+import depth_mapping
+import npz_shards
+import image_cache
+import projection
+import devices
+import manifest
+import checkpointing
+import pca_jitter
 
 
 parser = argparse.ArgumentParser(description='SUNCGRGBD SeeNetFuse Training')
@@ -41,6 +48,20 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--mapping-cache', dest='mapping_cache', action='store_true',
+                    help='read depth_mapping_3d from the cache built by depth_mapping.py')
+parser.add_argument('--shards', dest='shards', action='store_true',
+                    help='read labels, weights and depth_mapping_3d from the shards built by npz_shards.py')
+parser.add_argument('--image-cache', dest='image_cache', action='store_true',
+                    help='keep the resized RGB and HHA images in the image cache of configs.py')
+parser.add_argument('--pca-cache', dest='pca_cache', action='store_true',
+                    help='jitter colours per minibatch with the eigenvectors cached in configs.py')
+parser.add_argument('--manifest', dest='manifest', action='store_true',
+                    help='read the validated sample lists from the manifests of configs.py, see manifest.py')
+parser.add_argument('--revalidate-manifest', dest='revalidate_manifest', action='store_true',
+                    help='rescan the sample lists and rewrite their manifests')
+parser.add_argument('--checkpoint', default='', type=str, metavar='MODULES',
+                    help='recompute these blocks in backward instead of keeping their activations, e.g. ASPP3D, see checkpointing.py')
 
 
 class DUC(nn.Module):
@@ -50,8 +71,14 @@ class DUC(nn.Module):
         self.conv = nn.Conv2d(inplanes, planes, kernel_size=3, padding=1, bias = False)
         self.bn = nn.BatchNorm2d(planes)
         self.pixel_shuffle = nn.PixelShuffle(upscale_factor)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint DUC, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         x = self.conv(x)
         x = self.bn(x)
         x = self.relu(x)
@@ -253,8 +280,14 @@ class ASPP3D(nn.Module):
         self.conv2 = nn.ModuleList([nn.Conv3d(planes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
         self.bn2 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
         self.relu = nn.ReLU(inplace=True)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint ASPP3D, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         
         y = self.bn2[0](self.conv2[0](self.relu(self.bn1[0](self.conv1[0](x)))))
         for i in range(1, len(self.conv_list)):
@@ -270,9 +303,9 @@ class ImageGen3DNet(nn.Module):
 
         self.seg2d = Seg2DNet(model=models.resnet101(False), num_classes=12)
         
-        chpo = torch.load(seg2d_path)
+        chpo = torch.load(seg2d_path, map_location = devices.map_location)
         self.seg2d.load_state_dict(chpo['state_dict'], strict = False)
-        print "=> seg2d loaded checkpoint '{}'".format(seg2d_path)
+        print("=> seg2d loaded checkpoint '{}'".format(seg2d_path))
 
         self.seq1 = nn.Sequential(
             nn.Conv3d(64, 64, 3, padding = 1, bias = False),
@@ -304,7 +337,7 @@ class ImageGen3DNet(nn.Module):
 
         self.img_required_size = (640, 480)
         self.img_size = img_size
-        if cmp(self.img_required_size, self.img_size) != 0:
+        if self.img_required_size != self.img_size:
             x = np.array(range(self.img_required_size[0]), dtype = np.float32)
             y = np.array(range(self.img_required_size[1]), dtype = np.float32)
             scale = 1.0 * self.img_size[0] / self.img_required_size[0]
@@ -326,6 +359,7 @@ class ImageGen3DNet(nn.Module):
         self.register_buffer('image_mapping', torch.autograd.Variable(torch.LongTensor(image_mapping1), requires_grad=False))
 
         self.dim_inc_dim = 64
+        self.sparse_head = None
 
     def forward(self, img, depth, depth_mapping_3d):
         
@@ -333,14 +367,14 @@ class ImageGen3DNet(nn.Module):
         
         tempseg = self.seg2d(img, depth)
         
-        segres = tempseg.contiguous().view(bs*self.dim_inc_dim, hi*wi)
-        segres = torch.index_select(segres, 1, self.image_mapping).contiguous().view(
-            bs, self.dim_inc_dim, self.img_required_size[0]*self.img_required_size[1]).permute(0, 2, 1)
-        zerosVec = Variable(torch.zeros(bs, 1, self.dim_inc_dim), requires_grad = False).cuda(img.get_device())
-        segVec = torch.cat((segres, zerosVec), 1)
+        segres = tempseg.contiguous().view(bs, self.dim_inc_dim, hi*wi)
         # confirm: 'depth_mapping_3d' is 640*480 when the value is less than 0
-        segres = [torch.index_select(segVec[i], 0, depth_mapping_3d[i]) for i in xrange(bs)]
-        segres = torch.stack(segres).permute(0, 2, 1).contiguous().view(bs, self.dim_inc_dim, 60, 36, 60)
+        voxel_index = projection.compose(self.image_mapping, depth_mapping_3d, hi*wi)
+        segres = projection.project(segres, voxel_index).view(bs, self.dim_inc_dim, 60, 36, 60)
+
+        if self.sparse_head is not None:
+            # sparse3d.SparseHead: evaluation on the receptive field of the observed voxels only
+            return self.sparse_head(segres)
 
         x1 = self.relu(self.seq1(segres) + segres) # different from before
         x2 = self.relu(self.seq2(x1) + x1)
@@ -362,8 +396,38 @@ class ImageGen3DNet(nn.Module):
                 ]
 
 
+def PCA_Jittering(img):
+
+    img = np.asanyarray(img, dtype = 'float32')
+
+    img = img / 255.0
+    img_size = img.size // 3
+    img1 = img.reshape(img_size, 3)
+    img1 = np.transpose(img1)
+    img_cov = np.cov([img1[0], img1[1], img1[2]])
+    lamda, p = np.linalg.eig(img_cov)
+
+    p = np.transpose(p)
+    alpha1 = random.normalvariate(0,1)
+    alpha2 = random.normalvariate(0,1)
+    alpha3 = random.normalvariate(0,1)
+    v = np.transpose((alpha1*lamda[0], alpha2*lamda[1], alpha3*lamda[2]))
+    add_num = np.dot(p,v)
+
+    img2 = np.array([img[:,:,0]+add_num[0], img[:,:,1]+add_num[1], img[:,:,2]+add_num[2]])
+    img2 = img2.reshape(3, img_size)
+    img2 = np.transpose(img2)
+    img2 = img2.reshape(img.shape)
+    img2 = img2 * 255.0
+    img2[img2<0] = 0
+    img2[img2>255] = 255
+    img2 = img2.astype(np.uint8)
+
+    return Image.fromarray(img2)
+
+
 class TrainDataLoader(torch_data.Dataset):
-    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12):
+    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12, mapping_path = None, shard_path = None, image_cache_path = None, pca_cache_path = None, manifest_file = None, revalidate_manifest = False):
 
         super(TrainDataLoader, self).__init__()
 
@@ -374,29 +438,24 @@ class TrainDataLoader(torch_data.Dataset):
 
         self.path = path
         self.npz_path = npz_path
+        self.mapping_path = mapping_path
+        self.shards = npz_shards.ShardReader(shard_path) if shard_path is not None else None
 
-        fid = open(path, "r")
+        # the npz of a line is its position among the lines whose image exists
+        entries = manifest.read(path, lambda line: (line,), manifest_file,
+                                npz_path = self.npz_path if self.shards is None else None, revalidate = revalidate_manifest)
+        self.filelist = []
         self.colorlist = []
         self.depthlist = []
-        ind = 1
-        for line in fid.readlines():
-            line = line.rstrip("\n")
-            if os.path.exists(line):
-                self.colorlist.append(line)
-                self.depthlist.append(HHA_path+'/%06d.png'%ind)
-            ind = ind + 1
-        fid.close()
-
-        self.filelist = range(len(self.colorlist))
-
-        dontexist = []
-        for i in xrange(len(self.colorlist)):
-            if not os.path.isfile(os.path.join(self.npz_path, '%06d.npz'%self.filelist[i])):
-                dontexist.append(i)
-        for i in dontexist[::-1]:
-            del self.filelist[i]
-            del self.colorlist[i]
-            del self.depthlist[i]
+        for i in range(len(entries)):
+            if self.shards is not None:
+                exists = entries.npz_index[i] in self.shards
+            else:
+                exists = entries.npz_exists[i]
+            if exists:
+                self.filelist.append(entries.npz_index[i])
+                self.colorlist.append(entries.paths[i][0])
+                self.depthlist.append(HHA_path+'/%06d.png'%(entries.line[i]+1))
 
         self.num_classes = num_classes
         self.color_transform = Compose([
@@ -412,6 +471,20 @@ class TrainDataLoader(torch_data.Dataset):
         self.resize_size = (384, 288) # 12:9
 
         self.train_or_test = train_or_test
+        # turned off while feature_store.py or quantize.py runs the 2D network over the images
+        self.pca_jitter = True
+
+        self.color_cache = None
+        self.depth_cache = None
+        if image_cache_path is not None:
+            self.color_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'RGB'), self.colorlist, self.resize_size)
+            self.depth_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'HHA'), self.depthlist, self.resize_size)
+
+        self.eigen_cache = None
+        if pca_cache_path is not None:
+            # the jitter is applied to the whole minibatch by collate_fn, see pca_jitter.py
+            self.eigen_cache = pca_jitter.EigenCache(pca_cache_path, self.colorlist)
+            self.collate_fn = pca_jitter.PCAJitterCollate([.485, .456, .406], [.229, .224, .225])
 
     def __len__(self):
 
@@ -419,30 +492,44 @@ class TrainDataLoader(torch_data.Dataset):
 
     def __getitem__(self, index):
 
-        color = Image.open(self.colorlist[index]).convert('RGB')
-        color = color.resize(self.resize_size, Image.ANTIALIAS)
+        if self.color_cache is not None:
+            color = self.color_cache.get(index)
+        else:
+            color = Image.open(self.colorlist[index]).convert('RGB')
+            color = color.resize(self.resize_size, Image.LANCZOS)
         if self.train_or_test == "train":
-            color = PCA_Jittering(color)
+            if self.eigen_cache is not None:
+                eigen = self.eigen_cache.get(index, color)
+            elif self.pca_jitter:
+                color = PCA_Jittering(color)
         color = self.color_transform(color)
 
-        depth = Image.open(self.depthlist[index]).convert('RGB')
-        depth = depth.resize(self.resize_size, Image.ANTIALIAS)
+        if self.depth_cache is not None:
+            depth = self.depth_cache.get(index)
+        else:
+            depth = Image.open(self.depthlist[index]).convert('RGB')
+            depth = depth.resize(self.resize_size, Image.LANCZOS)
         depth = self.depth_transform(depth)
 
-        loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
-
-        # shurans
-        label = torch.LongTensor(loaddata['arr_1'].astype(np.int64))
-        label_weight = torch.FloatTensor(loaddata['arr_2'].astype(np.float32))
-        mapping = loaddata['arr_3'].astype(np.int64)
-        mapping1 = np.ones((8294400), dtype = np.int64)
-        mapping1[:] = -1
-        ind, = np.where(mapping>=0)
-        mapping1[mapping[ind]] = ind
-        mapping2 = torch.autograd.Variable(torch.FloatTensor(mapping1.reshape((1,240,144,240)).astype(np.float32)))
-        mapping2 = torch.nn.MaxPool3d(4,4)(mapping2).data.view(-1).numpy()
-        mapping2[mapping2<0] = 307200
-        depth_mapping_3d = torch.LongTensor(mapping2.astype(np.int64))
+        if self.shards is not None:
+            label, label_weight, mapping = self.shards.get(self.filelist[index])
+        else:
+            loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
+            label = loaddata['arr_1']
+            label_weight = loaddata['arr_2']
+            if self.mapping_path is not None:
+                mapping = depth_mapping.load(self.mapping_path, self.filelist[index])
+            else:
+                mapping = depth_mapping.compute(loaddata['arr_3'])
+
+        # shurans, sent as uint8 labels, a uint8 weight mask and int32 mappings.
+        # The engines widen them on the device, see Engine.on_adapt_batch.
+        label = torch.from_numpy(np.array(label, dtype = np.uint8))
+        label_weight = torch.from_numpy((np.asarray(label_weight) != 0).astype(np.uint8))
+        depth_mapping_3d = torch.from_numpy(np.array(mapping, dtype = np.int32))
+
+        if self.eigen_cache is not None:
+            return color, depth, label, label_weight, depth_mapping_3d, eigen
 
         return color, depth, label, label_weight, depth_mapping_3d
 
@@ -454,8 +541,19 @@ def main():
     use_gpu = torch.cuda.is_available()
 
     # define dataset
-    train_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TRAIN, SUNCGRGBD_NPZ_PATH_TRAIN, "train")
-    val_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TEST, SUNCGRGBD_NPZ_PATH_TEST, "test")
+    train_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TRAIN, SUNCGRGBD_NPZ_PATH_TRAIN, "train",
+                                    mapping_path = configs.SUNCGRGBD_MAPPING_PATH_TRAIN if args.mapping_cache else None,
+                                    shard_path = configs.SUNCGRGBD_SHARD_PATH_TRAIN if args.shards else None,
+                                    image_cache_path = configs.SUNCGRGBD_IMAGE_CACHE_PATH_TRAIN if args.image_cache else None,
+                                    pca_cache_path = configs.SUNCGRGBD_PCA_CACHE_PATH_TRAIN if args.pca_cache else None,
+                                    manifest_file = configs.SUNCGRGBD_MANIFEST_PATH_TRAIN if args.manifest else None,
+                                    revalidate_manifest = args.revalidate_manifest)
+    val_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TEST, SUNCGRGBD_NPZ_PATH_TEST, "test",
+                                  mapping_path = configs.SUNCGRGBD_MAPPING_PATH_TEST if args.mapping_cache else None,
+                                  shard_path = configs.SUNCGRGBD_SHARD_PATH_TEST if args.shards else None,
+                                  image_cache_path = configs.SUNCGRGBD_IMAGE_CACHE_PATH_TEST if args.image_cache else None,
+                                  manifest_file = configs.SUNCGRGBD_MANIFEST_PATH_TEST if args.manifest else None,
+                                  revalidate_manifest = args.revalidate_manifest)
 
     # load model
     model = ImageGen3DNet('../../Semantic_Segmentation/save_models/seg_fuse_suncg/checkpoint.pth.tar', (384, 288))
@@ -473,6 +571,8 @@ def main():
              'save_iter': 1200, 'print_freq': args.print_freq, 'epoch_step': []}
     state['save_model_path'] = './save_models/SATNet_SeeNetFuse'
 
+    checkpointing.enable(model, args.checkpoint)
+
     engine = Engine(state)
     engine.learning(model, criterion, train_dataset, val_dataset, optimizer)
 
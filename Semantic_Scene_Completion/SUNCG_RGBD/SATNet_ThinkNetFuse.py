@@ -17,6 +17,16 @@ import torch.utils.data as torch_data
 from engine_fuse1 import Engine
 sys.path.append('../../')
 import configs
+from configs import *
+import depth_mapping
+import npz_shards
+import image_cache
+import projection
+import devices
+import pipeline
+import manifest
+import checkpointing
+import pca_jitter
 
 
 parser = argparse.ArgumentParser(description='SUNCGRGBD ThinkNetFuse Training')
@@ -40,6 +50,22 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--mapping-cache', dest='mapping_cache', action='store_true',
+                    help='read depth_mapping_3d from the cache built by depth_mapping.py')
+parser.add_argument('--shards', dest='shards', action='store_true',
+                    help='read labels, weights and depth_mapping_3d from the shards built by npz_shards.py')
+parser.add_argument('--image-cache', dest='image_cache', action='store_true',
+                    help='keep the resized RGB and HHA images in the image cache of configs.py')
+parser.add_argument('--pca-cache', dest='pca_cache', action='store_true',
+                    help='jitter colours per minibatch with the eigenvectors cached in configs.py')
+parser.add_argument('--manifest', dest='manifest', action='store_true',
+                    help='read the validated sample lists from the manifests of configs.py, see manifest.py')
+parser.add_argument('--revalidate-manifest', dest='revalidate_manifest', action='store_true',
+                    help='rescan the sample lists and rewrite their manifests')
+parser.add_argument('--micro-batches', default=1, type=int, metavar='N',
+                    help='split every minibatch into N micro-batches to overlap the two branches and the fusion, see pipeline.py')
+parser.add_argument('--checkpoint', default='', type=str, metavar='MODULES',
+                    help='recompute these blocks in backward instead of keeping their activations, e.g. ASPP3D, see checkpointing.py')
 
 
 class DUC(nn.Module):
@@ -49,8 +75,14 @@ class DUC(nn.Module):
         self.conv = nn.Conv2d(inplanes, planes, kernel_size=3, padding=1, bias = False)
         self.bn = nn.BatchNorm2d(planes)
         self.pixel_shuffle = nn.PixelShuffle(upscale_factor)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint DUC, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         x = self.conv(x)
         x = self.bn(x)
         x = self.relu(x)
@@ -225,8 +257,14 @@ class ASPP3D(nn.Module):
         self.conv2 = nn.ModuleList([nn.Conv3d(planes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
         self.bn2 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
         self.relu = nn.ReLU(inplace=True)
+        self.checkpointed = False
 
     def forward(self, x):
+        # recomputed in backward with --checkpoint ASPP3D, see checkpointing.py
+
+        return checkpointing.run(self, self.block, x)
+
+    def block(self, x):
         
         y = self.bn2[0](self.conv2[0](self.relu(self.bn1[0](self.conv1[0](x)))))
         for i in range(1, len(self.conv_list)):
@@ -267,7 +305,7 @@ class ImageGen(nn.Module):
 
         self.img_required_size = (640, 480)
         self.img_size = img_size
-        if cmp(self.img_required_size, self.img_size) != 0:
+        if self.img_required_size != self.img_size:
             x = np.array(range(self.img_required_size[0]), dtype = np.float32)
             y = np.array(range(self.img_required_size[1]), dtype = np.float32)
             scale = 1.0 * self.img_size[0] / self.img_required_size[0]
@@ -283,10 +321,10 @@ class ImageGen(nn.Module):
             yy = np.ones((self.img_required_size[1], self.img_required_size[0]), dtype = np.int64)
             xx[:] = x
             yy[:] = y.reshape((self.img_required_size[1], 1)) * self.img_size[0]
-            self.image_mapping = (xx + yy).reshape(-1)
+            image_mapping1 = (xx + yy).reshape(-1)
         else:
-            self.image_mapping = np.array(range(self.img_required_size[0]*self.img_required_size[1]), dtype = np.int64)
-        self.image_mapping = torch.autograd.Variable(torch.cuda.LongTensor(self.image_mapping), requires_grad = False)
+            image_mapping1 = np.array(range(self.img_required_size[0]*self.img_required_size[1]), dtype = np.int64)
+        self.register_buffer('image_mapping', torch.autograd.Variable(torch.LongTensor(image_mapping1), requires_grad=False))
 
         self.dim_inc_dim = 64
 
@@ -296,14 +334,10 @@ class ImageGen(nn.Module):
 
         tempseg = self.seg2d(img)[0]
         
-        segres = tempseg.contiguous().view(bs*self.dim_inc_dim, hi*wi)
-        segres = torch.index_select(segres, 1, self.image_mapping).contiguous().view(
-            bs, self.dim_inc_dim, self.img_required_size[0]*self.img_required_size[1]).permute(0, 2, 1)
-        zerosVec = Variable(torch.zeros(bs, 1, self.dim_inc_dim), requires_grad = False).cuda(img.get_device())
-        segVec = torch.cat((segres, zerosVec), 1)
+        segres = tempseg.contiguous().view(bs, self.dim_inc_dim, hi*wi)
         # confirm: 'depth_mapping_3d' is 640*480 when the value is less than 0
-        segres = [torch.index_select(segVec[i], 0, depth_mapping_3d[i]) for i in xrange(bs)]
-        segres = torch.stack(segres).permute(0, 2, 1).contiguous().view(bs, self.dim_inc_dim, 60, 36, 60)
+        voxel_index = projection.compose(self.image_mapping, depth_mapping_3d, hi*wi)
+        segres = projection.project(segres, voxel_index).view(bs, self.dim_inc_dim, 60, 36, 60)
 
         x1 = self.relu(self.seq1(segres) + segres)
         x2 = self.relu(self.seq2(x1) + x1)
@@ -356,7 +390,7 @@ class DepthGen(nn.Module):
 
         self.img_required_size = (640, 480)
         self.img_size = img_size
-        if cmp(self.img_required_size, self.img_size) != 0:
+        if self.img_required_size != self.img_size:
             x = np.array(range(self.img_required_size[0]), dtype = np.float32)
             y = np.array(range(self.img_required_size[1]), dtype = np.float32)
             scale = 1.0 * self.img_size[0] / self.img_required_size[0]
@@ -385,14 +419,10 @@ class DepthGen(nn.Module):
 
         tempseg = self.seg2d(img)[0]
         
-        segres = tempseg.contiguous().view(bs*self.dim_inc_dim, hi*wi)
-        segres = torch.index_select(segres, 1, self.image_mapping).contiguous().view(
-            bs, self.dim_inc_dim, self.img_required_size[0]*self.img_required_size[1]).permute(0, 2, 1)
-        zerosVec = Variable(torch.zeros(bs, 1, self.dim_inc_dim), requires_grad = False).cuda(img.get_device())
-        segVec = torch.cat((segres, zerosVec), 1)
+        segres = tempseg.contiguous().view(bs, self.dim_inc_dim, hi*wi)
         # confirm: 'depth_mapping_3d' is 640*480 when the value is less than 0
-        segres = [torch.index_select(segVec[i], 0, depth_mapping_3d[i]) for i in xrange(bs)]
-        segres = torch.stack(segres).permute(0, 2, 1).contiguous().view(bs, self.dim_inc_dim, 60, 36, 60)
+        voxel_index = projection.compose(self.image_mapping, depth_mapping_3d, hi*wi)
+        segres = projection.project(segres, voxel_index).view(bs, self.dim_inc_dim, 60, 36, 60)
 
         x1 = self.relu(self.seq1(segres) + segres) # different from before
         x2 = self.relu(self.seq2(x1) + x1)
@@ -452,18 +482,22 @@ class ASPP3DS_FUSE(nn.Module):
         return x
 
 
+# the image branch and the fusion on the first GPU, the depth branch on the second, see devices.resolve
+DEVICE_MAP = {'image': 0, 'depth': 1, 'fuse': 0}
+
+
 class ImageGen3DNet(nn.Module):
-    def __init__(self, image_path, depth_path, img_size):
+    def __init__(self, image_path, depth_path, img_size, device_map = DEVICE_MAP, micro_batches = 1):
         super(ImageGen3DNet, self).__init__()
         self.imageGen = ImageGen((384, 288))
-        chpo = torch.load(image_path)
+        chpo = torch.load(image_path, map_location = devices.map_location)
         self.imageGen.load_state_dict(chpo['state_dict'], strict = False)
-        print "=> imageGen loaded checkpoint '{}'".format(image_path)
+        print("=> imageGen loaded checkpoint '{}'".format(image_path))
 
         self.depthGen = DepthGen((384, 288))
-        chpo = torch.load(depth_path)
+        chpo = torch.load(depth_path, map_location = devices.map_location)
         self.depthGen.load_state_dict(chpo['state_dict'], strict = False)
-        print "=> depthGen loaded checkpoint '{}'".format(depth_path)
+        print("=> depthGen loaded checkpoint '{}'".format(depth_path))
 
         self.ASPP3Dout = nn.Sequential(
             ASPP3DS_FUSE(256, 128, [1, 2]),
@@ -471,22 +505,34 @@ class ImageGen3DNet(nn.Module):
             nn.Conv3d(12, 12, 3, padding = 1)
         )
 
-        self.imageGen = self.imageGen.cuda(0)
-        self.depthGen = self.depthGen.cuda(1)
-        self.ASPP3Dout = self.ASPP3Dout.cuda(0)
+        self.device_map = devices.resolve(device_map)
+        self.imageGen = self.imageGen.to(self.device_map['image'])
+        self.depthGen = self.depthGen.to(self.device_map['depth'])
+        self.ASPP3Dout = self.ASPP3Dout.to(self.device_map['fuse'])
+        self.micro_batches = micro_batches
 
-    def forward(self, img, depth, depth_mapping_3d_0, depth_mapping_3d_1):
-        
-        img = self.imageGen(img, depth_mapping_3d_0)
-        depth = self.depthGen(depth, depth_mapping_3d_1)
+    def image_branch(self, img, depth_mapping_3d):
+
+        return self.imageGen(img.to(self.device_map['image']), depth_mapping_3d.to(self.device_map['image']))
 
-        depth = depth.cuda(0)
+    def depth_branch(self, depth, depth_mapping_3d):
 
-        x = torch.cat((img, depth), dim = 1)
+        return self.depthGen(depth.to(self.device_map['depth']), depth_mapping_3d.to(self.device_map['depth']))
+
+    def fuse(self, img, depth):
+        x = torch.cat((img.to(self.device_map['fuse']), depth.to(self.device_map['fuse'])), dim = 1)
         x = self.ASPP3Dout(x)
 
         return x
 
+    def forward(self, img, depth, depth_mapping_3d_0, depth_mapping_3d_1):
+        if self.micro_batches > 1:
+            # overlap the two branches and the fusion over micro-batches, see pipeline.py
+            return pipeline.run([self.image_branch, self.depth_branch], self.fuse,
+                                [(img, depth_mapping_3d_0), (depth, depth_mapping_3d_1)], self.micro_batches)
+
+        return self.fuse(self.image_branch(img, depth_mapping_3d_0), self.depth_branch(depth, depth_mapping_3d_1))
+
     def get_config_optim(self, lr, lrp):
         return [
                 {'params': self.imageGen.parameters(), 'lr': lr * lrp},
@@ -494,13 +540,17 @@ class ImageGen3DNet(nn.Module):
                 {'params': self.ASPP3Dout.parameters()}
                 ]
 
+    def load_state_dict(self, state_dict, strict = True):
+
+        super(ImageGen3DNet, self).load_state_dict(projection.with_image_mapping(self, state_dict), strict)
+
 
 def PCA_Jittering(img):
 
     img = np.asanyarray(img, dtype = 'float32')
 
     img = img / 255.0
-    img_size = img.size / 3
+    img_size = img.size // 3
     img1 = img.reshape(img_size, 3)
     img1 = np.transpose(img1)
     img_cov = np.cov([img1[0], img1[1], img1[2]])
@@ -526,7 +576,7 @@ def PCA_Jittering(img):
 
 
 class TrainDataLoader(torch_data.Dataset):
-    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12):
+    def __init__(self, path, npz_path, train_or_test, img_transform = None, label_transform = None, num_classes = 12, mapping_path = None, shard_path = None, image_cache_path = None, pca_cache_path = None, manifest_file = None, revalidate_manifest = False):
 
         super(TrainDataLoader, self).__init__()
 
@@ -537,29 +587,24 @@ class TrainDataLoader(torch_data.Dataset):
 
         self.path = path
         self.npz_path = npz_path
+        self.mapping_path = mapping_path
+        self.shards = npz_shards.ShardReader(shard_path) if shard_path is not None else None
 
-        fid = open(path, "r")
+        # the npz of a line is its position among the lines whose image exists
+        entries = manifest.read(path, lambda line: (line,), manifest_file,
+                                npz_path = self.npz_path if self.shards is None else None, revalidate = revalidate_manifest)
+        self.filelist = []
         self.colorlist = []
         self.depthlist = []
-        ind = 1
-        for line in fid.readlines():
-            line = line.rstrip("\n")
-            if os.path.exists(line):
-                self.colorlist.append(line)
-                self.depthlist.append(HHA_path+'/%06d.png'%ind)
-            ind = ind + 1
-        fid.close()
-
-        self.filelist = range(len(self.colorlist))
-
-        dontexist = []
-        for i in xrange(len(self.colorlist)):
-            if not os.path.isfile(os.path.join(self.npz_path, '%06d.npz'%self.filelist[i])):
-                dontexist.append(i)
-        for i in dontexist[::-1]:
-            del self.filelist[i]
-            del self.colorlist[i]
-            del self.depthlist[i]
+        for i in range(len(entries)):
+            if self.shards is not None:
+                exists = entries.npz_index[i] in self.shards
+            else:
+                exists = entries.npz_exists[i]
+            if exists:
+                self.filelist.append(entries.npz_index[i])
+                self.colorlist.append(entries.paths[i][0])
+                self.depthlist.append(HHA_path+'/%06d.png'%(entries.line[i]+1))
 
         self.num_classes = num_classes
         self.color_transform = Compose([
@@ -576,36 +621,62 @@ class TrainDataLoader(torch_data.Dataset):
 
         self.train_or_test = train_or_test
 
+        self.color_cache = None
+        self.depth_cache = None
+        if image_cache_path is not None:
+            self.color_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'RGB'), self.colorlist, self.resize_size)
+            self.depth_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'HHA'), self.depthlist, self.resize_size)
+
+        self.eigen_cache = None
+        if pca_cache_path is not None:
+            # the jitter is applied to the whole minibatch by collate_fn, see pca_jitter.py
+            self.eigen_cache = pca_jitter.EigenCache(pca_cache_path, self.colorlist)
+            self.collate_fn = pca_jitter.PCAJitterCollate([.485, .456, .406], [.229, .224, .225])
+
     def __len__(self):
 
         return len(self.filelist)
 
     def __getitem__(self, index):
 
-        color = Image.open(self.colorlist[index]).convert('RGB')
-        color = color.resize(self.resize_size, Image.ANTIALIAS)
+        if self.color_cache is not None:
+            color = self.color_cache.get(index)
+        else:
+            color = Image.open(self.colorlist[index]).convert('RGB')
+            color = color.resize(self.resize_size, Image.LANCZOS)
         if self.train_or_test == "train":
-            color = PCA_Jittering(color)
+            if self.eigen_cache is not None:
+                eigen = self.eigen_cache.get(index, color)
+            else:
+                color = PCA_Jittering(color)
         color = self.color_transform(color)
 
-        depth = Image.open(self.depthlist[index]).convert('RGB')
-        depth = depth.resize(self.resize_size, Image.ANTIALIAS)
+        if self.depth_cache is not None:
+            depth = self.depth_cache.get(index)
+        else:
+            depth = Image.open(self.depthlist[index]).convert('RGB')
+            depth = depth.resize(self.resize_size, Image.LANCZOS)
         depth = self.depth_transform(depth)
 
-        loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
-
-        # shurans
-        label = torch.LongTensor(loaddata['arr_1'].astype(np.int64))
-        label_weight = torch.FloatTensor(loaddata['arr_2'].astype(np.float32))
-        mapping = loaddata['arr_3'].astype(np.int64)
-        mapping1 = np.ones((8294400), dtype = np.int64)
-        mapping1[:] = -1
-        ind, = np.where(mapping>=0)
-        mapping1[mapping[ind]] = ind
-        mapping2 = torch.autograd.Variable(torch.FloatTensor(mapping1.reshape((1,240,144,240)).astype(np.float32)))
-        mapping2 = torch.nn.MaxPool3d(4,4)(mapping2).data.view(-1).numpy()
-        mapping2[mapping2<0] = 307200
-        depth_mapping_3d = torch.LongTensor(mapping2.astype(np.int64))
+        if self.shards is not None:
+            label, label_weight, mapping = self.shards.get(self.filelist[index])
+        else:
+            loaddata = np.load(os.path.join(self.npz_path,'%06d.npz'%self.filelist[index]))
+            label = loaddata['arr_1']
+            label_weight = loaddata['arr_2']
+            if self.mapping_path is not None:
+                mapping = depth_mapping.load(self.mapping_path, self.filelist[index])
+            else:
+                mapping = depth_mapping.compute(loaddata['arr_3'])
+
+        # shurans, sent as uint8 labels, a uint8 weight mask and int32 mappings.
+        # The engines widen them on the device, see Engine.on_adapt_batch.
+        label = torch.from_numpy(np.array(label, dtype = np.uint8))
+        label_weight = torch.from_numpy((np.asarray(label_weight) != 0).astype(np.uint8))
+        depth_mapping_3d = torch.from_numpy(np.array(mapping, dtype = np.int32))
+
+        if self.eigen_cache is not None:
+            return color, depth, label, label_weight, depth_mapping_3d, eigen
 
         return color, depth, label, label_weight, depth_mapping_3d
 
@@ -617,12 +688,24 @@ def main():
     use_gpu = False
 
     # define dataset
-    train_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TRAIN, SUNCGRGBD_NPZ_PATH_TRAIN, "train")
-    val_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TEST, SUNCGRGBD_NPZ_PATH_TEST, "test")
+    train_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TRAIN, SUNCGRGBD_NPZ_PATH_TRAIN, "train",
+                                    mapping_path = configs.SUNCGRGBD_MAPPING_PATH_TRAIN if args.mapping_cache else None,
+                                    shard_path = configs.SUNCGRGBD_SHARD_PATH_TRAIN if args.shards else None,
+                                    image_cache_path = configs.SUNCGRGBD_IMAGE_CACHE_PATH_TRAIN if args.image_cache else None,
+                                    pca_cache_path = configs.SUNCGRGBD_PCA_CACHE_PATH_TRAIN if args.pca_cache else None,
+                                    manifest_file = configs.SUNCGRGBD_MANIFEST_PATH_TRAIN if args.manifest else None,
+                                    revalidate_manifest = args.revalidate_manifest)
+    val_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TEST, SUNCGRGBD_NPZ_PATH_TEST, "test",
+                                  mapping_path = configs.SUNCGRGBD_MAPPING_PATH_TEST if args.mapping_cache else None,
+                                  shard_path = configs.SUNCGRGBD_SHARD_PATH_TEST if args.shards else None,
+                                  image_cache_path = configs.SUNCGRGBD_IMAGE_CACHE_PATH_TEST if args.image_cache else None,
+                                  manifest_file = configs.SUNCGRGBD_MANIFEST_PATH_TEST if args.manifest else None,
+                                  revalidate_manifest = args.revalidate_manifest)
 
     # load model
     model = ImageGen3DNet('./save_models/SATNet_RGB/checkpoint.pth.tar',
-                          './save_models/SATNet_Depth/checkpoint.pth.tar', (384, 288))
+                          './save_models/SATNet_Depth/checkpoint.pth.tar', (384, 288),
+                          micro_batches = args.micro_batches)
 
     # define loss function (criterion)
     cri_weights = torch.FloatTensor([0.5, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
@@ -637,6 +720,8 @@ def main():
              'save_iter': 400, 'print_freq': args.print_freq, 'epoch_step': []}
     state['save_model_path'] = './save_models/SATNet_ThinkNetFuse'
 
+    checkpointing.enable(model, args.checkpoint)
+
     engine = Engine(state)
     engine.learning(model, criterion, train_dataset, val_dataset, optimizer)
 
@@ -1,16 +1,36 @@
-import sys, resource, os
+import argparse, sys, resource, os, time, copy
 import numpy as np
 import cv2
 import torch
 from torchvision.transforms import Compose, Normalize, ToTensor
-import h5py
 
 from SATNet_Depth import ImageGen3DNet, TrainDataLoader
 sys.path.append('../../')
 import configs
+from configs import *
+import devices
+import h5_writer
+import inference
+import sparse3d
+import quantize
+import IOU
 
-# CUDA_VISIBLE_DEVICES=0 python gen_result_Depth.py
+parser = argparse.ArgumentParser(description='Write the softmax scores of the test set to an HDF5 file')
+parser.add_argument('--compression', default=None, choices=['gzip', 'lzf'],
+                    help='of the result dataset, see h5_writer.py (default: none)')
+parser.add_argument('--compression-level', default=None, type=int, metavar='N',
+                    help='of gzip, 0-9 (default: 4)')
+parser.add_argument('--sparse-head', dest='sparse_head', action='store_true',
+                    help='run the 3D part on the CPU only where the observed voxels reach, see sparse3d.py')
+parser.add_argument('--quantize', default=None, choices=['fbgemm', 'qnnpack'],
+                    help='run the 2D network in INT8 on the CPU, calibrated on 200 training samples, see quantize.py (default: float)')
+parser.add_argument('--report-samples', dest='report_samples', default=100, type=int, metavar='N',
+                    help='with --quantize, compare the float and INT8 models on N test samples first, 0 to skip (default: 100)')
+
+
+# CUDA_VISIBLE_DEVICES=0 python gen_result_Depth.py [--compression gzip]
 def main():
+    args = parser.parse_args()
     resume_path = './save_models/SATNet_Depth/checkpoint.pth.tar' # HERE
     output_path = './results/result_suncg.hdf5'
 
@@ -26,32 +46,45 @@ def main():
     # model = SceneCompletionRGBD()
     model = ImageGen3DNet('../../Semantic_Segmentation/save_models/seg_depth_suncg/checkpoint.pth.tar', (384, 288)) # HERE
     if not os.path.isfile(resume_path):
-        print "=> no checkpoint found at '{}'".format(resume_path)
+        print("=> no checkpoint found at '{}'".format(resume_path))
         exit()
-    checkpoint = torch.load(resume_path)
+    checkpoint = torch.load(resume_path, map_location = devices.map_location)
     model.load_state_dict(checkpoint['state_dict'], strict = False)
-    model = torch.nn.DataParallel(model).cuda(0)
-    model.eval()
+    device = torch.device('cpu') if args.sparse_head or args.quantize else devices.default_device()
+    if device.type == 'cuda':
+        model = torch.nn.DataParallel(model)
+    model = model.to(device)
+    model = inference.freeze_for_inference(model) # eval mode, BatchNorm folded into the convolutions
+    if args.sparse_head:
+        model.sparse_head = sparse3d.SparseHead(model)
+    if args.quantize:
+        train_dataset = TrainDataLoader(SUNCGRGBD_SAMPLE_TXT_TRAIN, SUNCGRGBD_NPZ_PATH_TRAIN, 'train', img_transform = input_transform)
+        reference = copy.deepcopy(model)
+        model = quantize.quantize_model(model, train_dataset, backend = args.quantize)
+        if args.report_samples > 0:
+            quantize.report([('float', reference), ('int8 ' + args.quantize, model)], dataset, IOU.computeIOU,
+                            num_samples = args.report_samples)
+        del reference
 
-    softmax_layer = torch.nn.Softmax(dim = 1).cuda(0)
+    softmax_layer = torch.nn.Softmax(dim = 1)
 
-    predictions = []
+    writer = h5_writer.ResultWriter(output_path, (12, 60, 36, 60), # every batch is written when it is done
+                                    compression = args.compression, compression_opts = args.compression_level)
+    elapsed = 0.
     with torch.no_grad():
         for i, (color, label, label_weight, depth_mapping_3d) in enumerate(data_loader):
-            print '{0}/{1}'.format(i, len(data_loader))
+            print('{0}/{1}'.format(i, len(data_loader)))
 
-            input_var = torch.autograd.Variable(color.cuda(async=True))
-            depth_mapping_3d_var = torch.autograd.Variable(depth_mapping_3d.cuda(async=True))
+            input_var = torch.autograd.Variable(color.to(device, non_blocking = True))
+            depth_mapping_3d_var = torch.autograd.Variable(depth_mapping_3d.to(device, non_blocking = True).long())
 
+            start = time.time()
             output = model(input_var, depth_mapping_3d_var)
+            elapsed += time.time() - start
             output = softmax_layer(output) # HERE
-            predictions.append(output.cpu().data.numpy())
-        predictions = np.vstack(predictions)
-
-    fp = h5py.File(output_path, 'w')
-    result = fp.create_dataset('result', predictions.shape, dtype='f')
-    result[...] = predictions
-    fp.close()
+            writer.append(output.cpu().data.numpy())
+    writer.close()
+    print('model: {0:.0f} ms per sample'.format(1000*elapsed/max(len(dataset), 1)))
 
 if __name__ == '__main__':
 
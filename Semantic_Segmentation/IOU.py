@@ -3,6 +3,10 @@ import numpy as np
 
 # tensor size is (batchsize, ...)
 # channel0 is void and isn't counted.
+# The (label, prediction) pairs of every image are counted with one bincount on the device of
+# the output; labels outside [0, num_classes) get a row of their own, so they only add to the
+# union of the predicted class. A class that is neither predicted nor labelled in an image
+# gets -1.
 def computeIOU(output, label, num_classes = 12):
     output1, output2 = torch.max(output, 1)
 
@@ -15,18 +19,21 @@ def computeIOU(output, label, num_classes = 12):
             batchsize, output2.size(1), batchsize, label2.size(1))
         return -1
 
-    result = np.ones((batchsize, num_classes-1), dtype = np.float32)
-    for i in range(1, num_classes):
-        a = torch.eq(output2, i)
-        b = torch.eq(label2, i)
-        c = torch.add(a, 1, b)
-        d = torch.mul(a, b)
-        for j in xrange(batchsize):
-            union = torch.nonzero(c[j]).nelement()
-            intersection = torch.nonzero(d[j]).nelement()
-            if union == 0:
-                result[j, i-1] = -1
-            else:
-                result[j, i-1] = float(intersection) / float(union)
+    label2 = label2.long().to(output2.device)
+    label2 = label2.masked_fill((label2 < 0) | (label2 >= num_classes), num_classes)
+    image = torch.arange(batchsize, dtype = torch.long, device = output2.device).view(-1, 1)
+    index = (image*(num_classes + 1) + label2)*num_classes + output2
+    pairs = torch.bincount(index.view(-1), minlength = batchsize*(num_classes + 1)*num_classes)
+    pairs = pairs.view(batchsize, num_classes + 1, num_classes)
 
-    return result
\ No newline at end of file
+    classes = torch.arange(num_classes, dtype = torch.long, device = output2.device)
+    intersection = pairs[:, classes, classes]
+    union = pairs.sum(1) + pairs[:, :num_classes].sum(2) - intersection
+    intersection = intersection[:, 1:].cpu().numpy().astype(np.float32)
+    union = union[:, 1:].cpu().numpy().astype(np.float32)
+
+    result = -np.ones((batchsize, num_classes-1), dtype = np.float32)
+    present = union > 0
+    result[present] = intersection[present] / union[present]
+
+    return result
@@ -0,0 +1,38 @@
+import torch
+from torch.utils.data.dataloader import default_collate
+
+# Horizontal flip of the collated minibatch, so that the workers only load the original sample.
+#   'duplicate' adds the flipped copy of every sample, images along the channels and labels
+#               along the rows, which is the layout the loaders used to build per sample
+#   'random'    flips every sample with probability 0.5
+#   'off'       leaves the minibatch as it is
+FLIP_MODES = ('duplicate', 'random', 'off')
+
+
+class FlipCollate(object):
+    def __init__(self, images, labels, mode = 'duplicate', collate = default_collate):
+        if mode not in FLIP_MODES:
+            raise ValueError("flip mode should be one of {0}, got '{1}'".format(', '.join(FLIP_MODES), mode))
+
+        self.images = images
+        self.labels = labels
+        self.mode = mode
+        self.collate = collate
+
+    def __call__(self, batch):
+        batch = list(self.collate(batch))
+
+        if self.mode == 'duplicate':
+            for i in self.images:
+                batch[i] = torch.cat((batch[i], torch.flip(batch[i], [3])), 1)
+            for i in self.labels:
+                batch[i] = torch.cat((batch[i], torch.flip(batch[i], [2])), 1)
+        elif self.mode == 'random':
+            index = torch.nonzero(torch.rand(batch[self.images[0]].size(0)) < 0.5).view(-1)
+            if index.numel() > 0:
+                for i in self.images:
+                    batch[i][index] = torch.flip(batch[i][index], [3])
+                for i in self.labels:
+                    batch[i][index] = torch.flip(batch[i][index], [2])
+
+        return batch
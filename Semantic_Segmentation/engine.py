@@ -11,6 +11,7 @@ import torch.backends.cudnn as cudnn
 import torch.nn.parallel
 import torch.optim
 import torch.utils.data
+from torch.utils.data.dataloader import default_collate
 from torch.nn import Parameter
 import visdom
 
@@ -156,7 +157,7 @@ class Engine(object):
     def on_forward(self, training, model, criterion, data_loader, optimizer=None, display=True):
 
         input_var = torch.autograd.Variable(self.state['input'], requires_grad=True)
-        target_var = [torch.autograd.Variable(self.state['target'][i], requires_grad=False) for i in range(5)]
+        target_var = [torch.autograd.Variable(target, requires_grad=False) for target in self.state['target']]
 
         if training:
             self.state['output'] = model(input_var)
@@ -182,20 +183,22 @@ class Engine(object):
 
         # draw on visdom
         if self.state['image_visdom_iters'] != 0 and self.state['iteration'] != 0 and self.state['iteration'] % self.state['image_visdom_iters'] == 0:
-            self.draw_images = np.zeros((self.state['batch_size']*2*2, 3, 144, 192), dtype=float)
-            tout = np.zeros((self.state['batch_size']*2, 144, 192), dtype=float)
+            # with --flip random or off the batch holds no flipped copies
+            n = self.state['output'][0].size(0)
+            self.draw_images = np.zeros((n*2, 3, 144, 192), dtype=float)
+            tout = np.zeros((n, 144, 192), dtype=float)
             # ground truth
             aa = self.state['output'][0].data.cpu().numpy()
             toutput = np.argmax(aa, axis=1)
-            for i in range(self.state['batch_size']*2):
+            for i in range(n):
                 tout[i] = cv2.resize(toutput[i], dsize=(192,144), interpolation=cv2.INTER_NEAREST)
-            ttarget = self.state['target'][1].cpu().numpy()
+            ttarget = self.state['target'][0][:, ::2, ::2].cpu().numpy()
             for i in range(12):
                 tind = np.where(ttarget == i)
                 self.draw_images[tind[0], :, tind[1],tind[2]] = self.colormap[i]
                 tind = np.where(tout == i)
-                self.draw_images[tind[0]+self.state['batch_size']*2, :, tind[1],tind[2]] = self.colormap[i]
-            self.vis.images(self.draw_images, nrow=self.state['batch_size']*2, win=self.imagewin)
+                self.draw_images[tind[0]+n, :, tind[1],tind[2]] = self.colormap[i]
+            self.vis.images(self.draw_images, nrow=n, win=self.imagewin)
 
     def init_learning(self, model, criterion):
 
@@ -208,11 +211,13 @@ class Engine(object):
         # data loading code
         train_loader = torch.utils.data.DataLoader(train_dataset,
                                                    batch_size=self.state['batch_size'], shuffle=True,
-                                                   num_workers=self.state['workers'])
+                                                   num_workers=self.state['workers'],
+                                                   collate_fn=getattr(train_dataset, 'collate_fn', default_collate))
 
         val_loader = torch.utils.data.DataLoader(val_dataset,
                                                  batch_size=self.state['batch_size'], shuffle=False,
-                                                 num_workers=self.state['workers'])
+                                                 num_workers=self.state['workers'],
+                                                 collate_fn=getattr(val_dataset, 'collate_fn', default_collate))
 
         # optionally resume from a checkpoint
         if self._state('resume') is not None:
@@ -283,7 +288,9 @@ class Engine(object):
         self.on_start_epoch(True, model, criterion, data_loader, optimizer)
 
         end = time.time()
-        for i, (color, label1, label2, label4, label8, label16) in enumerate(data_loader):
+        for i, batch in enumerate(data_loader):
+            # the labels are uint8, at the scales the dataset was built with, and scale 1 comes first
+            color, labels = batch[0], batch[1:]
             bs, ch, hi, wi = color.size()
 
             # measure data loading time
@@ -292,15 +299,15 @@ class Engine(object):
             self.state['data_time_total'] = self.state['data_time_total'] + self.state['data_time_batch']
             self.state['data_time_num'] = self.state['data_time_num'] + 1
 
-            self.state['input'] = color.view(bs*2, -1, hi, wi)
-            self.state['target'] = [label1.view(bs*2, -1, wi),label2.view(bs*2, -1, wi/2),label4.view(bs*2, -1, wi/4),label8.view(bs*2, -1, wi/8),
-                                label16.view(bs*2, -1, wi/16)]
+            self.state['input'] = color.view(-1, 3, hi, wi)
+            self.state['target'] = [label.view(self.state['input'].size(0), -1, label.size(2)) for label in labels]
 
             self.on_start_batch(True, model, criterion, data_loader, optimizer)
 
             if self.state['use_gpu']:
                 self.state['input'] = self.state['input'].cuda(async=True)
-                self.state['target'] = [self.state['target'][i].cuda(async=True) for i in range(5)]
+                self.state['target'] = [target.cuda(async=True) for target in self.state['target']]
+            self.state['target'] = [target.long() for target in self.state['target']]
 
             self.on_forward(True, model, criterion, data_loader, optimizer)
 
@@ -331,7 +338,9 @@ class Engine(object):
         self.on_start_epoch(False, model, criterion, data_loader)
 
         end = time.time()
-        for i, (color, label1, label2, label4, label8, label16) in enumerate(data_loader):
+        for i, batch in enumerate(data_loader):
+            # the labels are uint8, at the scales the dataset was built with, and scale 1 comes first
+            color, labels = batch[0], batch[1:]
             bs, ch, hi, wi = color.size()
 
             # measure data loading time
@@ -340,15 +349,15 @@ class Engine(object):
             self.state['data_time_total'] = self.state['data_time_total'] + self.state['data_time_batch']
             self.state['data_time_num'] = self.state['data_time_num'] + 1
 
-            self.state['input'] = color.view(bs*2, -1, hi, wi)
-            self.state['target'] = [label1.view(bs*2, -1, wi),label2.view(bs*2, -1, wi/2),label4.view(bs*2, -1, wi/4),label8.view(bs*2, -1, wi/8),
-                                label16.view(bs*2, -1, wi/16)]
+            self.state['input'] = color.view(-1, 3, hi, wi)
+            self.state['target'] = [label.view(self.state['input'].size(0), -1, label.size(2)) for label in labels]
 
             self.on_start_batch(False, model, criterion, data_loader)
 
             if self.state['use_gpu']:
                 self.state['input'] = self.state['input'].cuda(async=True)
-                self.state['target'] = [self.state['target'][i].cuda(async=True) for i in range(5)]
+                self.state['target'] = [target.cuda(async=True) for target in self.state['target']]
+            self.state['target'] = [target.long() for target in self.state['target']]
 
             self.on_forward(False, model, criterion, data_loader)
 
@@ -11,6 +11,7 @@ import torch.backends.cudnn as cudnn
 import torch.nn.parallel
 import torch.optim
 import torch.utils.data
+from torch.utils.data.dataloader import default_collate
 from torch.nn import Parameter
 import visdom
 
@@ -209,11 +210,13 @@ class Engine(object):
         # data loading code
         train_loader = torch.utils.data.DataLoader(train_dataset,
                                                    batch_size=self.state['batch_size'], shuffle=True,
-                                                   num_workers=self.state['workers'])
+                                                   num_workers=self.state['workers'],
+                                                   collate_fn=getattr(train_dataset, 'collate_fn', default_collate))
 
         val_loader = torch.utils.data.DataLoader(val_dataset,
                                                  batch_size=self.state['batch_size'], shuffle=False,
-                                                 num_workers=self.state['workers'])
+                                                 num_workers=self.state['workers'],
+                                                 collate_fn=getattr(val_dataset, 'collate_fn', default_collate))
 
         # optionally resume from a checkpoint
         if self._state('resume') is not None:
@@ -293,9 +296,9 @@ class Engine(object):
             self.state['data_time_total'] = self.state['data_time_total'] + self.state['data_time_batch']
             self.state['data_time_num'] = self.state['data_time_num'] + 1
 
-            self.state['input'] = color.view(bs*2, -1, hi, wi)
-            self.state['depth'] = depth.view(bs*2, -1, hi, wi)
-            self.state['target'] = label.view(bs*2, -1, wi)
+            self.state['input'] = color.view(-1, 3, hi, wi)
+            self.state['depth'] = depth.view(-1, 3, hi, wi)
+            self.state['target'] = label.view(self.state['input'].size(0), -1, wi)
 
             self.on_start_batch(True, model, criterion, data_loader, optimizer)
 
@@ -303,6 +306,7 @@ class Engine(object):
                 self.state['input'] = self.state['input'].cuda(async=True)
                 self.state['depth'] = self.state['depth'].cuda(async=True)
                 self.state['target'] = self.state['target'].cuda(async=True)
+            self.state['target'] = self.state['target'].long()
 
             self.on_forward(True, model, criterion, data_loader, optimizer)
 
@@ -342,9 +346,9 @@ class Engine(object):
             self.state['data_time_total'] = self.state['data_time_total'] + self.state['data_time_batch']
             self.state['data_time_num'] = self.state['data_time_num'] + 1
 
-            self.state['input'] = color.view(bs*2, -1, hi, wi)
-            self.state['depth'] = depth.view(bs*2, -1, hi, wi)
-            self.state['target'] = label.view(bs*2, -1, wi)
+            self.state['input'] = color.view(-1, 3, hi, wi)
+            self.state['depth'] = depth.view(-1, 3, hi, wi)
+            self.state['target'] = label.view(self.state['input'].size(0), -1, wi)
 
             self.on_start_batch(False, model, criterion, data_loader)
 
@@ -352,6 +356,7 @@ class Engine(object):
                 self.state['input'] = self.state['input'].cuda(async=True)
                 self.state['depth'] = self.state['depth'].cuda(async=True)
                 self.state['target'] = self.state['target'].cuda(async=True)
+            self.state['target'] = self.state['target'].long()
 
             self.on_forward(False, model, criterion, data_loader)
 
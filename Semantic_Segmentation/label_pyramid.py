@@ -0,0 +1,10 @@
+import numpy as np
+import torch
+
+# The labels of a sample at the requested scales. Downscaling by an integer factor s with
+# cv2.INTER_NEAREST picks every s-th pixel, so a scale is a strided slice instead of
+# another cv2.resize. The labels stay uint8, the engines widen them to int64 after
+# moving them to the GPU.
+def label_pyramid(categ1, scales = (1, 2, 4, 8, 16)):
+
+    return [torch.from_numpy(np.ascontiguousarray(categ1[::s, ::s])) for s in scales]
@@ -14,6 +14,12 @@ import torch.optim as optim
 import torch.utils.data as torch_data
 
 from engine import Engine
+from label_pyramid import label_pyramid
+from batch_flip import FlipCollate, FLIP_MODES
+sys.path.append('../')
+import configs
+import image_cache
+import manifest
 
 
 parser = argparse.ArgumentParser(description='seg2D Training')
@@ -39,26 +45,32 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--flip', default='duplicate', choices=FLIP_MODES,
+                    help='horizontal flip of the training minibatches (default: duplicate)')
+parser.add_argument('--image-cache', default='', type=str, metavar='DIR',
+                    help='directory to cache the resized images in (default: none)')
+parser.add_argument('--manifest', default='', type=str, metavar='DIR',
+                    help='directory to keep the validated sample lists in, see manifest.py (default: none)')
+parser.add_argument('--revalidate-manifest', dest='revalidate_manifest', action='store_true',
+                    help='rescan the sample lists and rewrite their manifests')
 
 
 from seg_depth_suncg import Seg2DNet
 
 
 class TrainDataLoader(torch_data.Dataset):
-    def __init__(self, path, img_transform = None, label_transform = None, num_classes = 12, train = True):
+    def __init__(self, path, img_transform = None, label_transform = None, num_classes = 12, train = True, image_cache_path = None, scales = (1, 2, 4, 8, 16), flip = 'duplicate', manifest_file = None, revalidate_manifest = False):
 
         super(TrainDataLoader, self).__init__()
 
-        fid = open(path, "r")
+        entries = manifest.read(path, lambda line: (line, line[0:len(line)-9] + 'category_suncg.png'), manifest_file,
+                                revalidate = revalidate_manifest)
         self.colorlist = []
         self.categlist = []
-        for line in fid.readlines():
-            line = line.rstrip("\n")
-            line1 = line[0:len(line)-9] + 'category_suncg.png'
-            if os.path.exists(line) and os.path.exists(line1):
-                self.colorlist.append(line)
-                self.categlist.append(line1)
-        fid.close()
+        for i in range(len(entries)):
+            line, line1 = entries.paths[i]
+            self.colorlist.append(line)
+            self.categlist.append(line1)
 
         self.num_classes = num_classes
         self.img_transform = img_transform
@@ -67,11 +79,19 @@ class TrainDataLoader(torch_data.Dataset):
         self.train = train
 
         if train == True:
-            self.filelist = np.arange(795)
+            self.filelist = np.arange(configs.NYU_NUM_TRAIN)
         else:
-            self.filelist = np.arange(654)
+            self.filelist = np.arange(configs.NYU_NUM_TEST)
 
         self.resize_size = (384, 288) # 12:9
+        self.scales = scales
+
+        self.color_cache = None
+        if image_cache_path is not None:
+            HHA_path = configs.NYU_HHA_PATH_TRAIN if train else configs.NYU_HHA_PATH_TEST
+            self.color_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'HHA'), ['%s/%06d.png'%(HHA_path, i+1) for i in self.filelist], self.resize_size)
+
+        self.collate_fn = FlipCollate((0,), tuple(range(1, 1+len(scales))), flip)
 
     def __len__(self):
 
@@ -81,75 +101,29 @@ class TrainDataLoader(torch_data.Dataset):
 
         if self.train == True:
 
-            color = Image.open('%s/%06d.png'%('/media/jason/JetsonSSD/nyu_selected_HHA', self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
-            color = color.resize(self.resize_size, Image.ANTIALIAS)
-            color1 = color.transpose(Image.FLIP_LEFT_RIGHT)
-            color = self.img_transform(color)
-            color1 = self.img_transform(color1)
-            img = torch.cat((color, color1), 0)
+            if self.color_cache is not None:
+                color = self.color_cache.get(index)
+            else:
+                color = Image.open('%s/%06d.png'%(configs.NYU_HHA_PATH_TRAIN, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+                color = color.resize(self.resize_size, Image.ANTIALIAS)
+            img = self.img_transform(color)
 
-            categ1 = cv2.imread(self.categlist[index], -1).astype(int)
+            categ1 = cv2.imread(self.categlist[index], -1).astype(np.uint8)
             categ1 = cv2.resize(categ1, dsize=self.resize_size, interpolation=cv2.INTER_NEAREST)
-            categ11 = np.fliplr(categ1)
-            categ2 = cv2.resize(categ1, dsize=(self.resize_size[0]/2,self.resize_size[1]/2), interpolation=cv2.INTER_NEAREST)
-            categ21 = np.fliplr(categ2)
-            categ4 = cv2.resize(categ1, dsize=(self.resize_size[0]/4,self.resize_size[1]/4), interpolation=cv2.INTER_NEAREST)
-            categ41 = np.fliplr(categ4)
-            categ8 = cv2.resize(categ1, dsize=(self.resize_size[0]/8,self.resize_size[1]/8), interpolation=cv2.INTER_NEAREST)
-            categ81 = np.fliplr(categ8)
-            categ16 = cv2.resize(categ1, dsize=(self.resize_size[0]/16,self.resize_size[1]/16), interpolation=cv2.INTER_NEAREST)
-            categ161 = np.fliplr(categ16)
-            categ1 = torch.from_numpy(categ1.astype(np.int64))
-            categ11 = torch.from_numpy(categ11.astype(np.int64))
-            categ2 = torch.from_numpy(categ2.astype(np.int64))
-            categ21 = torch.from_numpy(categ21.astype(np.int64))
-            categ4 = torch.from_numpy(categ4.astype(np.int64))
-            categ41 = torch.from_numpy(categ41.astype(np.int64))
-            categ8 = torch.from_numpy(categ8.astype(np.int64))
-            categ81 = torch.from_numpy(categ81.astype(np.int64))
-            categ16 = torch.from_numpy(categ16.astype(np.int64))
-            categ161 = torch.from_numpy(categ161.astype(np.int64))
-            label1 = torch.cat((categ1, categ11), 0)
-            label2 = torch.cat((categ2, categ21), 0)
-            label4 = torch.cat((categ4, categ41), 0)
-            label8 = torch.cat((categ8, categ81), 0)
-            label16 = torch.cat((categ16, categ161), 0)
+            labels = label_pyramid(categ1, self.scales)
         else:
-            color = Image.open('%s/%06d.png'%('/media/jason/JetsonSSD/nyu_selected_val_HHA', self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
-            color = color.resize(self.resize_size, Image.ANTIALIAS)
-            color1 = color.transpose(Image.FLIP_LEFT_RIGHT)
-            color = self.img_transform(color)
-            color1 = self.img_transform(color1)
-            img = torch.cat((color, color1), 0)
-
-            categ1 = cv2.imread(self.categlist[index], -1).astype(int)
+            if self.color_cache is not None:
+                color = self.color_cache.get(index)
+            else:
+                color = Image.open('%s/%06d.png'%(configs.NYU_HHA_PATH_TEST, self.filelist[index]+1)).convert('RGB') # HHA begins with 1, not 0.
+                color = color.resize(self.resize_size, Image.ANTIALIAS)
+            img = self.img_transform(color)
+
+            categ1 = cv2.imread(self.categlist[index], -1).astype(np.uint8)
             categ1 = cv2.resize(categ1, dsize=self.resize_size, interpolation=cv2.INTER_NEAREST)
-            categ11 = np.fliplr(categ1)
-            categ2 = cv2.resize(categ1, dsize=(self.resize_size[0]/2,self.resize_size[1]/2), interpolation=cv2.INTER_NEAREST)
-            categ21 = np.fliplr(categ2)
-            categ4 = cv2.resize(categ1, dsize=(self.resize_size[0]/4,self.resize_size[1]/4), interpolation=cv2.INTER_NEAREST)
-            categ41 = np.fliplr(categ4)
-            categ8 = cv2.resize(categ1, dsize=(self.resize_size[0]/8,self.resize_size[1]/8), interpolation=cv2.INTER_NEAREST)
-            categ81 = np.fliplr(categ8)
-            categ16 = cv2.resize(categ1, dsize=(self.resize_size[0]/16,self.resize_size[1]/16), interpolation=cv2.INTER_NEAREST)
-            categ161 = np.fliplr(categ16)
-            categ1 = torch.from_numpy(categ1.astype(np.int64))
-            categ11 = torch.from_numpy(categ11.astype(np.int64))
-            categ2 = torch.from_numpy(categ2.astype(np.int64))
-            categ21 = torch.from_numpy(categ21.astype(np.int64))
-            categ4 = torch.from_numpy(categ4.astype(np.int64))
-            categ41 = torch.from_numpy(categ41.astype(np.int64))
-            categ8 = torch.from_numpy(categ8.astype(np.int64))
-            categ81 = torch.from_numpy(categ81.astype(np.int64))
-            categ16 = torch.from_numpy(categ16.astype(np.int64))
-            categ161 = torch.from_numpy(categ161.astype(np.int64))
-            label1 = torch.cat((categ1, categ11), 0)
-            label2 = torch.cat((categ2, categ21), 0)
-            label4 = torch.cat((categ4, categ41), 0)
-            label8 = torch.cat((categ8, categ81), 0)
-            label16 = torch.cat((categ16, categ161), 0)
-
-        return img, label1, label2, label4, label8, label16
+            labels = label_pyramid(categ1, self.scales)
+
+        return (img,) + tuple(labels)
 
 
 
@@ -163,8 +137,18 @@ def main():
         ToTensor(),
         Normalize([.485, .456, .406], [.229, .224, .225])
     ])
-    train_dataset = TrainDataLoader(os.path.join(args.data, 'nyu_train.txt'), img_transform = input_transform)
-    val_dataset = TrainDataLoader(os.path.join(args.data, 'nyu_test.txt'), img_transform = input_transform, train = False)
+    # engine.py only uses the full resolution labels
+    train_dataset = TrainDataLoader(os.path.join(args.data, 'nyu_train.txt'), img_transform = input_transform,
+                                    image_cache_path = os.path.join(args.image_cache, 'train') if args.image_cache else None,
+                                    scales = (1,),
+                                    flip = args.flip,
+                                    manifest_file = os.path.join(args.manifest, 'train.npz') if args.manifest else None,
+                                    revalidate_manifest = args.revalidate_manifest)
+    val_dataset = TrainDataLoader(os.path.join(args.data, 'nyu_test.txt'), img_transform = input_transform, train = False,
+                                  image_cache_path = os.path.join(args.image_cache, 'val') if args.image_cache else None,
+                                  scales = (1,),
+                                  manifest_file = os.path.join(args.manifest, 'val.npz') if args.manifest else None,
+                                  revalidate_manifest = args.revalidate_manifest)
 
     # load model
     model = Seg2DNet(model=models.resnet101(True), num_classes=12)
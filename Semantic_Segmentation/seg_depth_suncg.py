@@ -14,6 +14,12 @@ import torch.optim as optim
 import torch.utils.data as torch_data
 
 from engine import Engine
+from label_pyramid import label_pyramid
+from batch_flip import FlipCollate, FLIP_MODES
+sys.path.append('../')
+import configs
+import image_cache
+import manifest
 
 
 parser = argparse.ArgumentParser(description='seg2D Training')
@@ -39,6 +45,14 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--flip', default='duplicate', choices=FLIP_MODES,
+                    help='horizontal flip of the training minibatches (default: duplicate)')
+parser.add_argument('--image-cache', default='', type=str, metavar='DIR',
+                    help='directory to cache the resized images in (default: none)')
+parser.add_argument('--manifest', default='', type=str, metavar='DIR',
+                    help='directory to keep the validated sample lists in, see manifest.py (default: none)')
+parser.add_argument('--revalidate-manifest', dest='revalidate_manifest', action='store_true',
+                    help='rescan the sample lists and rewrite their manifests')
 
 
 class DUC(nn.Module):
@@ -148,33 +162,37 @@ class Seg2DNet(nn.Module):
 
 
 class TrainDataLoader(torch_data.Dataset):
-    def __init__(self, path, train, img_transform = None, label_transform = None, num_classes = 12):
+    def __init__(self, path, train, img_transform = None, label_transform = None, num_classes = 12, image_cache_path = None, scales = (1, 2, 4, 8, 16), flip = 'duplicate', manifest_file = None, revalidate_manifest = False):
 
         super(TrainDataLoader, self).__init__()
 
         if train == True:
-            HHA_path = '/media/jason/JetsonSSD/myselect_suncg_HHA'
+            HHA_path = configs.SUNCGRGBD_HHA_PATH_TRAIN
         else:
-            HHA_path = '/media/jason/JetsonSSD/myselect_suncg_val_HHA'
+            HHA_path = configs.SUNCGRGBD_HHA_PATH_TEST
 
-        fid = open(path, "r")
+        entries = manifest.read(path, lambda line: (line, line[0:len(line)-9] + 'category_uint8.png'), manifest_file,
+                                revalidate = revalidate_manifest)
         self.colorlist = []
         self.categlist = []
-        ind = 1 # HHA's index begins with 1, instead of 0.
-        for line in fid.readlines():
-            line = line.rstrip("\n")
-            line1 = line[0:len(line)-9] + 'category_uint8.png'
-            if os.path.exists(line) and os.path.exists(line1):
-                self.colorlist.append(HHA_path+'/%06d.png'%ind)
-                self.categlist.append(line1)
-            ind = ind + 1
-        fid.close()
+        for i in range(len(entries)):
+            line, line1 = entries.paths[i]
+            ind = entries.line[i] + 1 # HHA's index begins with 1, instead of 0.
+            self.colorlist.append(HHA_path+'/%06d.png'%ind)
+            self.categlist.append(line1)
 
         self.num_classes = num_classes
         self.img_transform = img_transform
         self.label_transform = label_transform
 
         self.resize_size = (384, 288) # 12:9
+        self.scales = scales
+
+        self.color_cache = None
+        if image_cache_path is not None:
+            self.color_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'HHA'), self.colorlist, self.resize_size)
+
+        self.collate_fn = FlipCollate((0,), tuple(range(1, 1+len(scales))), flip)
 
     def __len__(self):
 
@@ -182,41 +200,18 @@ class TrainDataLoader(torch_data.Dataset):
 
     def __getitem__(self, index):
 
-        color = Image.open(self.colorlist[index]).convert('RGB')
-        color = color.resize(self.resize_size, Image.ANTIALIAS)
-        color1 = color.transpose(Image.FLIP_LEFT_RIGHT)
-        color = self.img_transform(color)
-        color1 = self.img_transform(color1)
-        img = torch.cat((color, color1), 0)
+        if self.color_cache is not None:
+            color = self.color_cache.get(index)
+        else:
+            color = Image.open(self.colorlist[index]).convert('RGB')
+            color = color.resize(self.resize_size, Image.ANTIALIAS)
+        img = self.img_transform(color)
 
-        categ1 = cv2.imread(self.categlist[index], -1).astype(int)
+        categ1 = cv2.imread(self.categlist[index], -1).astype(np.uint8)
         categ1 = cv2.resize(categ1, dsize=self.resize_size, interpolation=cv2.INTER_NEAREST)
-        categ11 = np.fliplr(categ1)
-        categ2 = cv2.resize(categ1, dsize=(self.resize_size[0]/2,self.resize_size[1]/2), interpolation=cv2.INTER_NEAREST)
-        categ21 = np.fliplr(categ2)
-        categ4 = cv2.resize(categ1, dsize=(self.resize_size[0]/4,self.resize_size[1]/4), interpolation=cv2.INTER_NEAREST)
-        categ41 = np.fliplr(categ4)
-        categ8 = cv2.resize(categ1, dsize=(self.resize_size[0]/8,self.resize_size[1]/8), interpolation=cv2.INTER_NEAREST)
-        categ81 = np.fliplr(categ8)
-        categ16 = cv2.resize(categ1, dsize=(self.resize_size[0]/16,self.resize_size[1]/16), interpolation=cv2.INTER_NEAREST)
-        categ161 = np.fliplr(categ16)
-        categ1 = torch.from_numpy(categ1.astype(np.int64))
-        categ11 = torch.from_numpy(categ11.astype(np.int64))
-        categ2 = torch.from_numpy(categ2.astype(np.int64))
-        categ21 = torch.from_numpy(categ21.astype(np.int64))
-        categ4 = torch.from_numpy(categ4.astype(np.int64))
-        categ41 = torch.from_numpy(categ41.astype(np.int64))
-        categ8 = torch.from_numpy(categ8.astype(np.int64))
-        categ81 = torch.from_numpy(categ81.astype(np.int64))
-        categ16 = torch.from_numpy(categ16.astype(np.int64))
-        categ161 = torch.from_numpy(categ161.astype(np.int64))
-        label1 = torch.cat((categ1, categ11), 0)
-        label2 = torch.cat((categ2, categ21), 0)
-        label4 = torch.cat((categ4, categ41), 0)
-        label8 = torch.cat((categ8, categ81), 0)
-        label16 = torch.cat((categ16, categ161), 0)
-
-        return img, label1, label2, label4, label8, label16
+        labels = label_pyramid(categ1, self.scales)
+
+        return (img,) + tuple(labels)
 
 
 
@@ -230,8 +225,18 @@ def main():
         ToTensor(),
         Normalize([.5282, .3914, .4266], [.1945, .2480, .1506])
     ])
-    train_dataset = TrainDataLoader(os.path.join(args.data, 'image_list_train.txt'), train = True, img_transform = input_transform)
-    val_dataset = TrainDataLoader(os.path.join(args.data, 'image_list_val.txt'), train = False, img_transform = input_transform)
+    # engine.py only uses the full resolution labels
+    train_dataset = TrainDataLoader(os.path.join(args.data, 'image_list_train.txt'), train = True, img_transform = input_transform,
+                                    image_cache_path = os.path.join(args.image_cache, 'train') if args.image_cache else None,
+                                    scales = (1,),
+                                    flip = args.flip,
+                                    manifest_file = os.path.join(args.manifest, 'train.npz') if args.manifest else None,
+                                    revalidate_manifest = args.revalidate_manifest)
+    val_dataset = TrainDataLoader(os.path.join(args.data, 'image_list_val.txt'), train = False, img_transform = input_transform,
+                                  image_cache_path = os.path.join(args.image_cache, 'val') if args.image_cache else None,
+                                  scales = (1,),
+                                  manifest_file = os.path.join(args.manifest, 'val.npz') if args.manifest else None,
+                                  revalidate_manifest = args.revalidate_manifest)
 
     # load model
     model = Seg2DNet(model=models.resnet101(True), num_classes=12)
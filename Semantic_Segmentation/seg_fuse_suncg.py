@@ -14,6 +14,13 @@ import torch.optim as optim
 import torch.utils.data as torch_data
 
 from engine_fuse import Engine
+from label_pyramid import label_pyramid
+from batch_flip import FlipCollate, FLIP_MODES
+sys.path.append('../')
+import configs
+import image_cache
+import manifest
+import pca_jitter
 
 
 parser = argparse.ArgumentParser(description='seg2D Training')
@@ -39,6 +46,16 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--flip', default='duplicate', choices=FLIP_MODES,
+                    help='horizontal flip of the training minibatches (default: duplicate)')
+parser.add_argument('--image-cache', default='', type=str, metavar='DIR',
+                    help='directory to cache the resized images in (default: none)')
+parser.add_argument('--pca-cache', default='', type=str, metavar='DIR',
+                    help='directory to cache the colour eigenvectors in, jitters per minibatch (default: none)')
+parser.add_argument('--manifest', default='', type=str, metavar='DIR',
+                    help='directory to keep the validated sample lists in, see manifest.py (default: none)')
+parser.add_argument('--revalidate-manifest', dest='revalidate_manifest', action='store_true',
+                    help='rescan the sample lists and rewrite their manifests')
 
 
 class DUC(nn.Module):
@@ -280,29 +297,26 @@ def PCA_Jittering(img):
 
 
 class TrainDataLoader(torch_data.Dataset):
-    def __init__(self, path, train, img_transform = None, label_transform = None, num_classes = 12):
+    def __init__(self, path, train, img_transform = None, label_transform = None, num_classes = 12, image_cache_path = None, pca_cache_path = None, flip = 'duplicate', manifest_file = None, revalidate_manifest = False):
 
         super(TrainDataLoader, self).__init__()
 
         if train == True:
-            HHA_path = '/media/jason/JetsonSSD/myselect_suncg_HHA'
+            HHA_path = configs.SUNCGRGBD_HHA_PATH_TRAIN
         else:
-            HHA_path = '/media/jason/JetsonSSD/myselect_suncg_val_HHA'
+            HHA_path = configs.SUNCGRGBD_HHA_PATH_TEST
 
-        fid = open(path, "r")
+        entries = manifest.read(path, lambda line: (line, line[0:len(line)-9] + 'category_uint8.png'), manifest_file,
+                                revalidate = revalidate_manifest)
         self.colorlist = []
         self.categlist = []
         self.depthlist = []
-        ind = 1 # HHA's index begins with 1, instead of 0.
-        for line in fid.readlines():
-            line = line.rstrip("\n")
-            line1 = line[0:len(line)-9] + 'category_uint8.png'
-            if os.path.exists(line) and os.path.exists(line1):
-                self.depthlist.append(HHA_path+'/%06d.png'%ind)
-                self.colorlist.append(line)
-                self.categlist.append(line1)
-            ind = ind + 1
-        fid.close()
+        for i in range(len(entries)):
+            line, line1 = entries.paths[i]
+            ind = entries.line[i] + 1 # HHA's index begins with 1, instead of 0.
+            self.depthlist.append(HHA_path+'/%06d.png'%ind)
+            self.colorlist.append(line)
+            self.categlist.append(line1)
 
         self.num_classes = num_classes
         self.color_transform = Compose([
@@ -317,34 +331,50 @@ class TrainDataLoader(torch_data.Dataset):
 
         self.resize_size = (384, 288) # 12:9
 
+        self.depth_cache = None
+        self.color_cache = None
+        if image_cache_path is not None:
+            self.depth_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'HHA'), self.depthlist, self.resize_size)
+            self.color_cache = image_cache.ImageCache(os.path.join(image_cache_path, 'RGB'), self.colorlist, self.resize_size)
+
+        self.collate_fn = FlipCollate((0, 1), (2,), flip)
+
+        self.eigen_cache = None
+        if pca_cache_path is not None:
+            # the jitter is applied to the whole minibatch by collate_fn, see pca_jitter.py
+            self.eigen_cache = pca_jitter.EigenCache(pca_cache_path, self.colorlist)
+            self.collate_fn = pca_jitter.PCAJitterCollate([.485, .456, .406], [.229, .224, .225], collate = self.collate_fn)
+
     def __len__(self):
 
         return len(self.colorlist)
 
     def __getitem__(self, index):
 
-        depth = Image.open(self.depthlist[index]).convert('RGB')
-        depth = depth.resize(self.resize_size, Image.ANTIALIAS)
-        depth1 = depth.transpose(Image.FLIP_LEFT_RIGHT)
+        if self.depth_cache is not None:
+            depth = self.depth_cache.get(index)
+        else:
+            depth = Image.open(self.depthlist[index]).convert('RGB')
+            depth = depth.resize(self.resize_size, Image.ANTIALIAS)
         depth = self.depth_transform(depth)
-        depth1 = self.depth_transform(depth1)
-        depth = torch.cat((depth, depth1), 0)
-
-        color = Image.open(self.colorlist[index]).convert('RGB')
-        color = color.resize(self.resize_size, Image.ANTIALIAS)
-        color1 = color.transpose(Image.FLIP_LEFT_RIGHT)
-        color = PCA_Jittering(color)
-        color1 = PCA_Jittering(color1)
+
+        if self.color_cache is not None:
+            color = self.color_cache.get(index)
+        else:
+            color = Image.open(self.colorlist[index]).convert('RGB')
+            color = color.resize(self.resize_size, Image.ANTIALIAS)
+        if self.eigen_cache is not None:
+            eigen = self.eigen_cache.get(index, color)
+        else:
+            color = PCA_Jittering(color)
         color = self.color_transform(color)
-        color1 = self.color_transform(color1)
-        color = torch.cat((color, color1), 0)
 
-        categ1 = cv2.imread(self.categlist[index], -1).astype(int)
+        categ1 = cv2.imread(self.categlist[index], -1).astype(np.uint8)
         categ1 = cv2.resize(categ1, dsize=self.resize_size, interpolation=cv2.INTER_NEAREST)
-        categ11 = np.fliplr(categ1)
-        categ1 = torch.from_numpy(categ1.astype(np.int64))
-        categ11 = torch.from_numpy(categ11.astype(np.int64))
-        label1 = torch.cat((categ1, categ11), 0)
+        label1 = label_pyramid(categ1, (1,))[0]
+
+        if self.eigen_cache is not None:
+            return color, depth, label1, eigen
 
         return color, depth, label1
 
@@ -356,8 +386,17 @@ def main():
     use_gpu = torch.cuda.is_available()
 
     # define dataset
-    train_dataset = TrainDataLoader(os.path.join(args.data, 'image_list_train.txt'), train = True)
-    val_dataset = TrainDataLoader(os.path.join(args.data, 'image_list_val.txt'), train = False)
+    train_dataset = TrainDataLoader(os.path.join(args.data, 'image_list_train.txt'), train = True,
+                                    image_cache_path = os.path.join(args.image_cache, 'train') if args.image_cache else None,
+                                    pca_cache_path = os.path.join(args.pca_cache, 'train') if args.pca_cache else None,
+                                    flip = args.flip,
+                                    manifest_file = os.path.join(args.manifest, 'train.npz') if args.manifest else None,
+                                    revalidate_manifest = args.revalidate_manifest)
+    val_dataset = TrainDataLoader(os.path.join(args.data, 'image_list_val.txt'), train = False,
+                                  image_cache_path = os.path.join(args.image_cache, 'val') if args.image_cache else None,
+                                  pca_cache_path = os.path.join(args.pca_cache, 'val') if args.pca_cache else None,
+                                  manifest_file = os.path.join(args.manifest, 'val.npz') if args.manifest else None,
+                                  revalidate_manifest = args.revalidate_manifest)
 
     # load model
     model = Seg2DNet('./save_models/seg_RGB_suncg/checkpoint.pth.tar',
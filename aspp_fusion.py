@@ -0,0 +1,209 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Inference-time fusion of the ASPP blocks of the SATNet scripts (ASPP, ASPP3D and the
+# ASPP3D_FUSE/ASPP3DS_FUSE of the fusion heads). Every branch is a conv followed by a
+# BatchNorm; with the running statistics the BatchNorm folds into the weights and a bias of
+# the conv, and the biases of the branches that are summed add up to one. A branch then
+# costs its convolution(s) and an in-place add instead of conv, BN and a new sum tensor:
+#   ASPP([1, 3, 5, 7])    4 conv + 4 BN + 3 add + ReLU       -> 4 conv + 3 add_ + ReLU
+#   ASPP3D([1, 2, 3])     6 conv + 6 BN + 3 ReLU + 3 add + ReLU -> 6 conv + 3 ReLU + 3 add_ + ReLU
+# The branches differ in dilation, so they cannot be stacked into one grouped convolution:
+# a common kernel would have the extent of the largest dilation (15x15 for dilation 7) and
+# be mostly zeros, which costs far more than the separate branches.
+# FusedASPP keeps the conv and BatchNorm modules of the block it replaces under the same
+# names, so the state dict is the one of today's checkpoints, before or after fuse(). The
+# folded weights are computed once when the block is fused and kept outside the state dict;
+# loading a state dict or moving the block to another device folds them again on the next
+# forward. Call refold() after changing the weights of a fused block by hand.
+
+# class name -> (two convolutions per branch, residual add of the input)
+KINDS = {
+    'ASPP': (False, False),
+    'ASPP3DS_FUSE': (False, False),
+    'ASPP3D': (True, True),
+    'ASPP3D_FUSE': (True, False),
+}
+
+
+def fold(conv, bn):
+    # (weight, bias) of conv followed by bn with its running statistics
+    scale = bn.weight/torch.sqrt(bn.running_var + bn.eps)
+    weight = conv.weight*scale.view((-1,) + (1,)*(conv.weight.dim() - 1))
+    bias = bn.bias - bn.running_mean*scale
+    if conv.bias is not None:
+        bias = bias + conv.bias*scale
+
+    return weight, bias
+
+
+class FusedASPP(nn.Module):
+    def __init__(self, aspp, two_stage, residual):
+        super(FusedASPP, self).__init__()
+        self.conv_list = aspp.conv_list
+        self.two_stage = two_stage
+        self.residual = residual
+        if two_stage:
+            self.conv1 = aspp.conv1
+            self.bn1 = aspp.bn1
+            self.conv2 = aspp.conv2
+            self.bn2 = aspp.bn2
+        else:
+            self.conv = aspp.conv
+            self.bn = aspp.bn
+        self.refold()
+
+    def refold(self):
+        # (first stage [(weight, bias)] or None, last stage [weight], summed bias of the last stage)
+        with torch.no_grad():
+            first = [fold(c, b) for c, b in zip(self.conv1, self.bn1)] if self.two_stage else None
+            last = [fold(c, b) for c, b in zip(*((self.conv2, self.bn2) if self.two_stage else (self.conv, self.bn)))]
+            bias = last[0][1]
+            for _, b in last[1:]:
+                bias = bias + b
+        self.folded = (first, [w for w, _ in last], bias)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # the weights are loaded after this, fold them on the next forward
+        super(FusedASPP, self)._load_from_state_dict(*args, **kwargs)
+        self.folded = None
+
+    def _apply(self, fn):
+        super(FusedASPP, self)._apply(fn)
+        self.folded = None
+
+        return self
+
+    def forward(self, x):
+        if self.training:
+            raise ValueError('aspp_fusion: the fused blocks only evaluate, call model.eval() first')
+        if self.folded is None:
+            self.refold()
+        first, weights, bias = self.folded
+        conv = F.conv2d if x.dim() == 4 else F.conv3d
+
+        y = None
+        for i, dil in enumerate(self.conv_list):
+            h = x
+            if self.two_stage:
+                h = F.relu(conv(h, first[i][0], first[i][1], padding = dil, dilation = dil), inplace = True)
+            out = conv(h, weights[i], bias if i == 0 else None, padding = dil, dilation = dil)
+            y = out if y is None else y.add_(out)
+        if self.residual:
+            y.add_(x)
+
+        return F.relu(y, inplace = True)
+
+
+def fuse(model):
+    # Replaces the ASPP blocks of an evaluating model by FusedASPP, returns how many
+    if model.training:
+        raise ValueError('aspp_fusion: fuse the blocks of an evaluating model, call model.eval() first')
+
+    count = 0
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            kind = KINDS.get(type(child).__name__)
+            if kind is not None:
+                fused = FusedASPP(child, *kind)
+                fused.train(False)
+                setattr(parent, name, fused)
+                count += 1
+
+    return count
+
+
+class ASPP(nn.Module):
+    # the ASPP of the SATNet_*.py scripts
+    def __init__(self, inplanes, planes, conv_list):
+        super(ASPP, self).__init__()
+        self.conv_list = conv_list
+        self.conv = nn.ModuleList([nn.Conv2d(inplanes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
+        self.bn = nn.ModuleList([nn.BatchNorm2d(planes) for dil in conv_list])
+        self.relu = nn.ReLU(inplace=True)
+
+    def forward(self, x):
+        y = self.bn[0](self.conv[0](x))
+        for i in range(1, len(self.conv_list)):
+            y += self.bn[i](self.conv[i](x))
+
+        return self.relu(y)
+
+
+class ASPP3D(nn.Module):
+    # the ASPP3D of the SATNet_*.py scripts
+    def __init__(self, inplanes, planes, conv_list):
+        super(ASPP3D, self).__init__()
+        self.conv_list = conv_list
+        self.conv1 = nn.ModuleList([nn.Conv3d(inplanes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
+        self.bn1 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
+        self.conv2 = nn.ModuleList([nn.Conv3d(planes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
+        self.bn2 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
+        self.relu = nn.ReLU(inplace=True)
+
+    def forward(self, x):
+        y = self.bn2[0](self.conv2[0](self.relu(self.bn1[0](self.conv1[0](x)))))
+        for i in range(1, len(self.conv_list)):
+            y += self.bn2[i](self.conv2[i](self.relu(self.bn1[i](self.conv1[i](x)))))
+
+        return self.relu(y+x)
+
+
+def _randomize(model):
+    # BatchNorm statistics that are not the identity, as in a trained model
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.running_mean.uniform_(-0.2, 0.2)
+            m.running_var.uniform_(0.5, 1.5)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.2, 0.2)
+
+    return model
+
+
+# python aspp_fusion.py --batch-size 1
+def main():
+    parser = argparse.ArgumentParser(description='Time the fused ASPP blocks against the original ones on the CPU')
+    parser.add_argument('--batch-size', default=1, type=int, metavar='N')
+    parser.add_argument('--repeat', default=15, type=int, metavar='N', help='the median of N runs is reported')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    blocks = [('ASPP(32, 64, [1, 3, 5, 7]) on 32x288x384', ASPP(32, 64, [1, 3, 5, 7]), (32, 288, 384)),
+              ('ASPP3D(64, 64, [1, 2, 3]) on 64x60x36x60', ASPP3D(64, 64, [1, 2, 3]), (64, 60, 36, 60))]
+    for title, block, size in blocks:
+        block = _randomize(block).eval()
+        model = nn.Sequential(block).eval()
+        reference = nn.Sequential(block).eval()
+        fuse(model)
+        x = torch.randn((args.batch_size,) + size)
+        # the fused model loads the state dict of the original one unchanged
+        model.load_state_dict(reference.state_dict())
+
+        # the two alternate, so that both see the same load of the machine; the first run of
+        # each is a warm-up
+        times = {'original': [], 'fused': []}
+        outs = {}
+        with torch.no_grad():
+            for _ in range(args.repeat + 1):
+                for name, m in (('original', reference), ('fused', model)):
+                    start = time.time()
+                    outs[name] = m(x)
+                    times[name].append(time.time() - start)
+        # the median and the quartiles of the runs, and the median of the per-pair ratios
+        quartiles = dict((name, np.percentile(t[1:], [25, 50, 75])*1000) for name, t in times.items())
+        ratio = np.median(np.array(times['fused'][1:])/np.array(times['original'][1:]))
+        diff = (outs['original'] - outs['fused']).abs().max().item()
+        print('{0}: original {1[1]:.0f} ms ({1[0]:.0f}-{1[2]:.0f}), fused {2[1]:.0f} ms ({2[0]:.0f}-{2[2]:.0f}), '
+              'fused/original {3:.3f}, max difference {4:.2e}'.format(
+              title, quartiles['original'], quartiles['fused'], ratio, diff))
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.utils.checkpoint as torch_checkpoint
+
+# Activation checkpointing of the blocks that hold most of the training memory: the DUC
+# upsampling of Seg2DNet (3x3 convolutions with up to 4096 channels) and the ASPP3D blocks
+# (three dilation branches of two conv+BN each on 64x60x36x60 volumes). A block whose
+# 'checkpointed' is set keeps only its input in forward and runs again in backward, which
+# trades one more forward of the block for its activations. The training scripts set it
+# with '--checkpoint ASPP3D'; `python checkpointing.py` reports the peak memory and step
+# time of a block with and without it. DUC is not recommended: the recomputed chain keeps
+# its inputs and skip connections, which at batch sizes 1 and 4 weigh more than what it
+# saves, so the peak goes up. Checkpointing the whole chain as one block raises it as well:
+# at these sizes its weights and gradients weigh far more than its activations, which is
+# why the Semantic_Segmentation scripts do not take '--checkpoint'.
+# The running statistics of the BatchNorm layers are not updated a second time when a
+# block runs again in backward.
+
+MODULES = ('DUC', 'ASPP3D')
+
+# since PyTorch 1.11 checkpoint() asks which implementation to use, the reentrant one is
+# the only one of 0.4
+_VERSION = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+_CHECKPOINT_KWARGS = {'use_reentrant': True} if _VERSION >= (1, 11) else {}
+
+
+def enable(model, names):
+    # names: comma-separated class names of the blocks of 'model' to checkpoint, e.g. 'ASPP3D'
+    names = [name for name in names.split(',') if name]
+    for name in names:
+        if name not in MODULES:
+            raise ValueError('checkpointing: cannot checkpoint {0}, only {1}'.format(name, ', '.join(MODULES)))
+
+    count = 0
+    for module in model.modules():
+        if type(module).__name__ in names:
+            module.checkpointed = True
+            count += 1
+
+    return count
+
+
+class _Recompute(object):
+    def __init__(self, module, fn):
+        self.module = module
+        self.fn = fn
+
+    def __call__(self, *inputs):
+        if not torch.is_grad_enabled():
+            return self.fn(*inputs)
+
+        # running again in backward: the BatchNorm statistics have seen this batch already
+        norms = [m for m in self.module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        momenta = [m.momentum for m in norms]
+        tracked = [getattr(m, 'num_batches_tracked', None) for m in norms]
+        tracked = [t.clone() if t is not None else None for t in tracked]
+        for m in norms:
+            m.momentum = 0.
+        try:
+            return self.fn(*inputs)
+        finally:
+            for m, momentum, t in zip(norms, momenta, tracked):
+                m.momentum = momentum
+                if t is not None:
+                    m.num_batches_tracked.copy_(t)
+
+
+def run(module, fn, *inputs):
+    # fn(*inputs), the forward of 'module', without keeping its activations when it is checkpointed
+    if not (module.checkpointed and module.training and torch.is_grad_enabled()) or \
+       not any(t.requires_grad for t in inputs):
+        return fn(*inputs)
+
+    return torch_checkpoint.checkpoint(_Recompute(module, fn), *inputs, **_CHECKPOINT_KWARGS)
+
+
+class _DUC(nn.Module):
+    # the DUC of the SATNet_*.py scripts
+    def __init__(self, inplanes, planes, upscale_factor=2):
+        super(_DUC, self).__init__()
+        self.relu = nn.ReLU()
+        self.conv = nn.Conv2d(inplanes, planes, kernel_size=3, padding=1, bias = False)
+        self.bn = nn.BatchNorm2d(planes)
+        self.pixel_shuffle = nn.PixelShuffle(upscale_factor)
+        self.checkpointed = False
+
+    def forward(self, x):
+
+        return run(self, self.block, x)
+
+    def block(self, x):
+
+        return self.pixel_shuffle(self.relu(self.bn(self.conv(x))))
+
+
+class _ASPP3D(nn.Module):
+    # the ASPP3D of the SATNet_*.py scripts
+    def __init__(self, inplanes, planes, conv_list):
+        super(_ASPP3D, self).__init__()
+        self.conv_list = conv_list
+        self.conv1 = nn.ModuleList([nn.Conv3d(inplanes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
+        self.bn1 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
+        self.conv2 = nn.ModuleList([nn.Conv3d(planes, planes, kernel_size=3, padding=dil, dilation=dil, bias = False) for dil in conv_list])
+        self.bn2 = nn.ModuleList([nn.BatchNorm3d(planes) for dil in conv_list])
+        self.relu = nn.ReLU(inplace=True)
+        self.checkpointed = False
+
+    def forward(self, x):
+
+        return run(self, self.block, x)
+
+    def block(self, x):
+        y = self.bn2[0](self.conv2[0](self.relu(self.bn1[0](self.conv1[0](x)))))
+        for i in range(1, len(self.conv_list)):
+            y += self.bn2[i](self.conv2[i](self.relu(self.bn1[i](self.conv1[i](x)))))
+
+        return self.relu(y+x)
+
+
+class _DUCs(nn.Module):
+    # the DUC upsampling of Seg2DNet.forward, with its skip connections as fixed inputs
+    def __init__(self, batch_size):
+        super(_DUCs, self).__init__()
+        self.duc1 = _DUC(2048, 2048*2)
+        self.duc2 = _DUC(1024, 1024*2)
+        self.duc3 = _DUC(512, 512*2)
+        self.duc4 = _DUC(128, 128*2)
+        self.duc5 = _DUC(64, 64*2)
+        self.transformer = nn.Conv2d(320, 128, kernel_size=1)
+        # fm3, fm2, fm1, pool_x and conv_x of a 384x288 image
+        for name, size in (('fm3', (1024, 18, 24)), ('fm2', (512, 36, 48)), ('fm1', (256, 72, 96)),
+                           ('pool_x', (64, 72, 96)), ('conv_x', (64, 144, 192))):
+            self.register_buffer(name, torch.randn((batch_size,) + size))
+
+    def forward(self, fm4):
+        dfm1 = self.fm3 + self.duc1(fm4)
+        dfm2 = self.fm2 + self.duc2(dfm1)
+        dfm3 = self.fm1 + self.duc3(dfm2)
+        dfm3_t = self.transformer(torch.cat((dfm3, self.pool_x), 1))
+        dfm4 = self.conv_x + self.duc4(dfm3_t)
+
+        return self.duc5(dfm4)
+
+
+def _blocks(name, batch_size, dilations):
+    # the blocks as Seg2DNet and ImageGen3DNet use them, and an input of the size they see
+    # there: layer4 of the ResNet on a 384x288 image, the 60x36x60 volume
+    if name == 'DUC':
+        model = _DUCs(batch_size)
+        x = torch.randn(batch_size, 2048, 9, 12)
+    else:
+        model = nn.Sequential(_ASPP3D(64, 64, dilations), _ASPP3D(64, 64, dilations))
+        x = torch.randn(batch_size, 64, 60, 36, 60)
+
+    return model, x
+
+
+def _peak_mb(device, baseline):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)/2.**20
+
+    # ru_maxrss is in kB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)/2.**10
+
+
+def _measure(args):
+    # one configuration per process, so that the peaks do not mix
+    device = torch.device('cuda', 0) if torch.cuda.is_available() else torch.device('cpu')
+    model, x = _blocks(args.block, args.batch_size, [int(d) for d in args.dilations.split(',')])
+    for block in model.modules():
+        if hasattr(block, 'checkpointed'):
+            block.checkpointed = args.policy != 'none'
+    model.to(device).train()
+    x = x.to(device).requires_grad_()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    model(x).sum().backward()
+    start = time.time()
+    for _ in range(args.repeat):
+        model(x).sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    print('{0} {1}'.format(_peak_mb(device, baseline), (time.time() - start)/args.repeat*1000))
+
+
+# python checkpointing.py --block ASPP3D --batch-size 1
+def main():
+    parser = argparse.ArgumentParser(description='Peak memory and step time of the DUC or ASPP3D blocks with and without checkpointing')
+    parser.add_argument('--block', default='ASPP3D', choices=MODULES)
+    parser.add_argument('--batch-size', default=1, type=int, metavar='N')
+    parser.add_argument('--repeat', default=2, type=int, metavar='N')
+    parser.add_argument('--dilations', default='1,3,5', metavar='D,D,D',
+                        help='of the ASPP3D blocks: 1,3,5 in the NYU RGB/SeeNetFuse/ThinkNetFuse models, 1,2,3 in the others')
+    parser.add_argument('--policy', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.policy is not None:
+        _measure(args)
+        return
+
+    for policy in ('none', args.block):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--block', args.block,
+                                       '--batch-size', str(args.batch_size), '--repeat', str(args.repeat),
+                                       '--dilations', args.dilations, '--policy', policy])
+        peak, step = [float(v) for v in out.decode('utf-8').split()[-2:]]
+        print('{0} checkpointing {1}: peak {2:.0f} MB above the weights and input, {3:.0f} ms per step'.format(
+              args.block, 'on' if policy != 'none' else 'off', peak, step))
+
+
+if __name__ == '__main__':
+
+    main()
@@ -1,15 +1,49 @@
+import os
+
 SUNCGD_HHA_PATH_TRAIN = '/home/jason/lscMATLABcode/HHA_image_gen-master/shurans_selected_HHA'
 SUNCGD_HHA_PATH_TEST = '/home/jason/lscMATLABcode/HHA_image_gen-master/shurans_selected_val_HHA'
 
+SUNCGD_NUM_TRAIN = 139368
+SUNCGD_NUM_TEST = 470
+
 SUNCGD_NPZ_PATH_TRAIN = '/media/jason/JetsonSSD/shurans_selected'
 SUNCGD_NPZ_PATH_TEST = '/media/jason/JetsonSSD/shurans_selected_val'
 
+SUNCGD_MAPPING_PATH_TRAIN = '/media/jason/JetsonSSD/shurans_selected_mapping'
+SUNCGD_MAPPING_PATH_TEST = '/media/jason/JetsonSSD/shurans_selected_val_mapping'
+
+SUNCGD_SHARD_PATH_TRAIN = '/media/jason/JetsonSSD/shurans_selected_shards'
+SUNCGD_SHARD_PATH_TEST = '/media/jason/JetsonSSD/shurans_selected_val_shards'
+
+SUNCGD_IMAGE_CACHE_PATH_TRAIN = '/media/jason/JetsonSSD/shurans_selected_image_cache'
+SUNCGD_IMAGE_CACHE_PATH_TEST = '/media/jason/JetsonSSD/shurans_selected_val_image_cache'
+
+SUNCGD_FEATURE_PATH_TRAIN = '/media/jason/JetsonSSD/shurans_selected_features'
+SUNCGD_FEATURE_PATH_TEST = '/media/jason/JetsonSSD/shurans_selected_val_features'
+
 SUNCGRGBD_HHA_PATH_TRAIN = '/media/jason/JetsonSSD/myselect_suncg_HHA'
 SUNCGRGBD_HHA_PATH_TEST = '/media/jason/JetsonSSD/myselect_suncg_val_HHA'
 
 SUNCGRGBD_NPZ_PATH_TRAIN = '/media/jason/JetsonSSD/myselect_suncg'
 SUNCGRGBD_NPZ_PATH_TEST = '/media/jason/JetsonSSD/myselect_suncg_val'
 
+SUNCGRGBD_MAPPING_PATH_TRAIN = '/media/jason/JetsonSSD/myselect_suncg_mapping'
+SUNCGRGBD_MAPPING_PATH_TEST = '/media/jason/JetsonSSD/myselect_suncg_val_mapping'
+
+SUNCGRGBD_SHARD_PATH_TRAIN = '/media/jason/JetsonSSD/myselect_suncg_shards'
+SUNCGRGBD_SHARD_PATH_TEST = '/media/jason/JetsonSSD/myselect_suncg_val_shards'
+
+SUNCGRGBD_IMAGE_CACHE_PATH_TRAIN = '/media/jason/JetsonSSD/myselect_suncg_image_cache'
+SUNCGRGBD_IMAGE_CACHE_PATH_TEST = '/media/jason/JetsonSSD/myselect_suncg_val_image_cache'
+
+SUNCGRGBD_FEATURE_PATH_TRAIN = '/media/jason/JetsonSSD/myselect_suncg_features'
+SUNCGRGBD_FEATURE_PATH_TEST = '/media/jason/JetsonSSD/myselect_suncg_val_features'
+
+SUNCGRGBD_PCA_CACHE_PATH_TRAIN = '/media/jason/JetsonSSD/myselect_suncg_pca_cache'
+
+SUNCGRGBD_MANIFEST_PATH_TRAIN = '/media/jason/JetsonSSD/myselect_suncg_manifest_train.npz'
+SUNCGRGBD_MANIFEST_PATH_TEST = '/media/jason/JetsonSSD/myselect_suncg_manifest_val.npz'
+
 SUNCGRGBD_SAMPLE_TXT_TRAIN = '/home/jason/lscCcode/selectImageFromRawSUNCG/selectedImage/image_list_train.txt'
 SUNCGRGBD_SAMPLE_TXT_TEST = '/home/jason/lscCcode/selectImageFromRawSUNCG/selectedImage/image_list_val.txt'
 
@@ -19,5 +53,30 @@ NYU_HHA_PATH_TEST = '/media/jason/JetsonSSD/nyu_selected_val_HHA'
 NYU_NPZ_PATH_TRAIN = '/media/jason/JetsonSSD/nyu_selected'
 NYU_NPZ_PATH_TEST = '/media/jason/JetsonSSD/nyu_selected_val'
 
+NYU_MAPPING_PATH_TRAIN = '/media/jason/JetsonSSD/nyu_selected_mapping'
+NYU_MAPPING_PATH_TEST = '/media/jason/JetsonSSD/nyu_selected_val_mapping'
+
+NYU_SHARD_PATH_TRAIN = '/media/jason/JetsonSSD/nyu_selected_shards'
+NYU_SHARD_PATH_TEST = '/media/jason/JetsonSSD/nyu_selected_val_shards'
+
+NYU_IMAGE_CACHE_PATH_TRAIN = '/media/jason/JetsonSSD/nyu_selected_image_cache'
+NYU_IMAGE_CACHE_PATH_TEST = '/media/jason/JetsonSSD/nyu_selected_val_image_cache'
+
+NYU_FEATURE_PATH_TRAIN = '/media/jason/JetsonSSD/nyu_selected_features'
+NYU_FEATURE_PATH_TEST = '/media/jason/JetsonSSD/nyu_selected_val_features'
+
+NYU_PCA_CACHE_PATH_TRAIN = '/media/jason/JetsonSSD/nyu_selected_pca_cache'
+
+NYU_MANIFEST_PATH_TRAIN = '/media/jason/JetsonSSD/nyu_selected_manifest_train.npz'
+NYU_MANIFEST_PATH_TEST = '/media/jason/JetsonSSD/nyu_selected_manifest_val.npz'
+
+NYU_NUM_TRAIN = 795
+NYU_NUM_TEST = 654
+
 NYU_SAMPLE_TXT_TRAIN = '/home/jason/NYUv2/NYU_images/nyu_train.txt'
-NYU_SAMPLE_TXT_TEST = '/home/jason/NYUv2/NYU_images/nyu_test.txt'
\ No newline at end of file
+NYU_SAMPLE_TXT_TEST = '/home/jason/NYUv2/NYU_images/nyu_test.txt'
+
+# SATNET_CONFIGS names a python file whose assignments replace the entries above,
+# e.g. the configs_synthetic.py written by synthetic_data.py.
+if os.environ.get('SATNET_CONFIGS'):
+    exec(compile(open(os.environ['SATNET_CONFIGS']).read(), os.environ['SATNET_CONFIGS'], 'exec'))
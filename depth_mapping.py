@@ -0,0 +1,157 @@
+import argparse
+import os
+import time
+import numpy as np
+
+import torch
+
+# 'depth_mapping_3d' points every 60x36x60 voxel at a pixel of the 640*480 image.
+# Voxels that no pixel falls into point at the zero vector appended after the image.
+EMPTY = 307200
+
+
+def compute(mapping):
+    # 'mapping' is arr_3 of shurans' npz: the 240x144x240 voxel of each pixel, -1 if invalid.
+    # Each 60x36x60 voxel takes the largest pixel index among the 4x4x4 voxels it pools,
+    # which is what MaxPool3d(4,4) over the dense grid gives, see _compute_maxpool.
+    mapping = mapping.astype(np.int64)
+    ind, = np.where(mapping>=0)
+    voxel = mapping[ind]
+    x = voxel // (144*240)
+    y = voxel // 240 % 144
+    z = voxel % 240
+    coarse = ((x//4)*36 + y//4)*60 + z//4
+    mapping2 = np.ones((129600), dtype = np.int64)
+    mapping2[:] = -1
+    np.maximum.at(mapping2, coarse, ind)
+    mapping2[mapping2<0] = EMPTY
+
+    return mapping2.astype(np.int32)
+
+
+def _compute_maxpool(mapping):
+    # The original dense version that was copied into every TrainDataLoader, kept as the reference.
+    mapping = mapping.astype(np.int64)
+    mapping1 = np.ones((8294400), dtype = np.int64)
+    mapping1[:] = -1
+    ind, = np.where(mapping>=0)
+    mapping1[mapping[ind]] = ind
+    mapping2 = torch.autograd.Variable(torch.FloatTensor(mapping1.reshape((1,1,240,144,240)).astype(np.float32)))
+    mapping2 = torch.nn.MaxPool3d(4,4)(mapping2).data.view(-1).numpy()
+    mapping2[mapping2<0] = EMPTY
+
+    return mapping2.astype(np.int32)
+
+
+def check(npz_path, count = 100, repeat = 5):
+    # Compares compute with the MaxPool3d reference on the first 'count' npz files and times both.
+    namelist = sorted([name for name in os.listdir(npz_path) if name.endswith('.npz')])[:count]
+    time_compute = 0.
+    time_maxpool = 0.
+    for name in namelist:
+        mapping = np.load(os.path.join(npz_path, name))['arr_3']
+        start = time.time()
+        for _ in range(repeat):
+            mapping_compute = compute(mapping)
+        time_compute += time.time() - start
+        start = time.time()
+        for _ in range(repeat):
+            mapping_maxpool = _compute_maxpool(mapping)
+        time_maxpool += time.time() - start
+        if not np.array_equal(mapping_compute, mapping_maxpool):
+            raise ValueError('depth_mapping_3d of {0} differs from the MaxPool3d reference'.format(name))
+
+    num = max(len(namelist)*repeat, 1)
+    print('{0} npz files match the MaxPool3d reference'.format(len(namelist)))
+    print('compute: {0:.2f} ms, maxpool: {1:.2f} ms'.format(1000*time_compute/num, 1000*time_maxpool/num))
+
+
+def synthetic(rng, invalid = 0.3, region = 40):
+    # An arr_3 for self_test: a share 'invalid' of the pixels is -1, the others fall into a
+    # region^3 corner of the 240x144x240 grid, so that many pixels share a voxel and many
+    # voxels share a 60x36x60 voxel, and the rest of the grid stays EMPTY; a few pixels hit
+    # the last voxel of each axis.
+    mapping = rng.randint(0, region, size = (EMPTY, 3))
+    mapping[:8] = [239, 143, 239]
+    mapping = (mapping[:, 0]*144 + mapping[:, 1])*240 + mapping[:, 2]
+    mapping[rng.rand(EMPTY) < invalid] = -1
+
+    return mapping.astype(np.int32)
+
+
+def self_test(count = 3, seed = 0):
+    # Compares compute with the MaxPool3d reference on synthetic arr_3 without any npz file:
+    # all pixels invalid, and 'count' mappings with -1 pixels, shared voxels and EMPTY voxels.
+    rng = np.random.RandomState(seed)
+    mappings = [-np.ones(EMPTY, dtype = np.int32)] + [synthetic(rng) for _ in range(count)]
+    for i, mapping in enumerate(mappings):
+        mapping_compute = compute(mapping)
+        mapping_maxpool = _compute_maxpool(mapping)
+        if not np.array_equal(mapping_compute, mapping_maxpool):
+            raise ValueError('depth_mapping_3d of synthetic mapping {0} differs from the MaxPool3d reference'.format(i))
+        if i > 0 and (np.all(mapping_compute == EMPTY) or not np.any(mapping_compute == EMPTY)):
+            raise ValueError('synthetic mapping {0} does not have both EMPTY and filled voxels'.format(i))
+
+    print('{0} synthetic mappings match the MaxPool3d reference'.format(len(mappings)))
+
+
+def cache_file(mapping_path, index):
+
+    return os.path.join(mapping_path, '%06d.npy'%index)
+
+
+def load(mapping_path, index):
+
+    return np.load(cache_file(mapping_path, index))
+
+
+def build(npz_path, mapping_path, overwrite = False):
+    if not os.path.exists(mapping_path):
+        os.makedirs(mapping_path)
+
+    namelist = sorted([name for name in os.listdir(npz_path) if name.endswith('.npz')])
+    for i, name in enumerate(namelist):
+        index = int(name[:-4])
+        filename = cache_file(mapping_path, index)
+        if not overwrite and os.path.isfile(filename):
+            continue
+        loaddata = np.load(os.path.join(npz_path, name))
+        np.save(filename, compute(loaddata['arr_3']))
+        if i % 100 == 0:
+            print('{0}/{1}'.format(i, len(namelist)))
+
+
+# python depth_mapping.py /media/jason/JetsonSSD/nyu_selected /media/jason/JetsonSSD/nyu_selected_mapping
+# python depth_mapping.py /media/jason/JetsonSSD/nyu_selected --check
+# python depth_mapping.py --self-test
+def main():
+    parser = argparse.ArgumentParser(description='Cache the pooled depth_mapping_3d of every npz')
+    parser.add_argument('npz_path', metavar='DIR', nargs='?',
+                        help='directory of %%06d.npz files')
+    parser.add_argument('mapping_path', metavar='DIR', nargs='?',
+                        help='directory to write the %%06d.npy mappings to')
+    parser.add_argument('--overwrite', dest='overwrite', action='store_true',
+                        help='recompute mappings that are already cached')
+    parser.add_argument('--check', dest='check', action='store_true',
+                        help='compare with the MaxPool3d reference and time both instead of caching')
+    parser.add_argument('--check-count', default=100, type=int, metavar='N',
+                        help='number of npz files to check (default: 100)')
+    parser.add_argument('--self-test', dest='self_test', action='store_true',
+                        help='compare with the MaxPool3d reference on synthetic mappings, without npz files')
+    args = parser.parse_args()
+
+    if args.self_test:
+        self_test()
+    elif args.npz_path is None:
+        parser.error('npz_path is required unless --self-test is given')
+    elif args.check:
+        check(args.npz_path, args.check_count)
+    elif args.mapping_path is None:
+        parser.error('mapping_path is required unless --check is given')
+    else:
+        build(args.npz_path, args.mapping_path, args.overwrite)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,31 @@
+import torch
+
+# Placement of the SSC models, so that they are built and run the same way with two GPUs,
+# one GPU or none. A device map names the device of every part of a model that is split
+# over devices, e.g. {'image': 0, 'depth': 1, 'fuse': 0} for SATNet_ThinkNetFuse. A GPU
+# ordinal wraps around the GPUs there are and falls back to the CPU without a GPU, any
+# other entry is taken as a torch.device.
+
+
+def resolve(device_map):
+    count = torch.cuda.device_count() if torch.cuda.is_available() else 0
+    resolved = {}
+    for part, device in device_map.items():
+        if isinstance(device, int):
+            resolved[part] = torch.device('cuda', device % count) if count > 0 else torch.device('cpu')
+        else:
+            resolved[part] = torch.device(device)
+
+    return resolved
+
+
+def default_device():
+
+    return torch.device('cuda', 0) if torch.cuda.is_available() else torch.device('cpu')
+
+
+def map_location(storage, location):
+    # torch.load(path, map_location = devices.map_location) reads checkpoints saved on any GPU
+    # into host memory, the model moves them to its own devices afterwards
+
+    return storage
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import numpy as np
+
+import torch
+import torch.utils.data as torch_data
+from torch.utils.data.dataloader import default_collate
+
+import devices
+import manifest
+
+# The output of a frozen 2D network for every sample of a dataset, so that training only
+# the 3D part of an SSC model (seq1/seq2/ASPP3D*/ASPP3Dout) does not run the ResNet-101
+# Seg2DNet again every epoch. The features are float16 in a memory-mapped array, one
+# (64, 288, 384) row per sample, 14 MB each: about 11 GB for the NYU training set, so
+# this is for NYU-sized sets and not the full SUNCG lists. The store is rebuilt when the
+# weights of the 2D network or the sample list change.
+# The store file is sparse until it is written, so before filling, fill() checks that the
+# file system has room for the samples that are missing (14 MB times their number) and
+# raises otherwise, instead of failing midway with a full disk; a SUNCG list stops there
+# unless the disk really holds it.
+# The features are those of the unaugmented images: fill() turns the pca_jitter of the
+# dataset off while it runs (the jitter of a pca_cache is applied by a collate_fn that it
+# does not use). The 3D-only epochs then read the features, labels, weights and mappings
+# (dataset.targets()) and never open an image.
+
+
+def fingerprint(module, num, sample_list = None):
+    digest = hashlib.sha1()
+    for name, value in sorted(module.state_dict().items()):
+        digest.update(name.encode('utf-8'))
+        digest.update(value.cpu().numpy().tobytes())
+    digest.update(str(num).encode('utf-8'))
+    if sample_list is not None:
+        digest.update(manifest.list_stat(sample_list).tobytes())
+
+    return digest.hexdigest()
+
+
+class FeatureStore(object):
+    def __init__(self, path, num, row_shape, key):
+        self.path = path
+        self.shape = (num,) + tuple(row_shape)
+        self.key = key
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if self.load_key() != key or not self.check_size():
+            self.reset()
+
+        # mapped lazily, so that every dataloader worker maps its own
+        self.features = None
+        self.filled = None
+
+    def key_file(self):
+
+        return os.path.join(self.path, 'key.txt')
+
+    def features_file(self):
+
+        return os.path.join(self.path, 'features.bin')
+
+    def filled_file(self):
+
+        return os.path.join(self.path, 'filled.bin')
+
+    def load_key(self):
+        if not os.path.isfile(self.key_file()):
+            return None
+        fid = open(self.key_file(), "r")
+        key = fid.read().strip()
+        fid.close()
+
+        return key
+
+    def check_size(self):
+        if not os.path.isfile(self.features_file()) or not os.path.isfile(self.filled_file()):
+            return False
+
+        return os.path.getsize(self.features_file()) == int(np.prod(self.shape))*2 and \
+               os.path.getsize(self.filled_file()) == self.shape[0]
+
+    def reset(self):
+        np.memmap(self.features_file(), dtype = np.float16, mode = 'w+', shape = self.shape).flush()
+        np.memmap(self.filled_file(), dtype = np.uint8, mode = 'w+', shape = (self.shape[0],)).flush()
+        fid = open(self.key_file(), "w")
+        fid.write(self.key + "\n")
+        fid.close()
+
+    def open(self):
+        if self.features is None:
+            self.features = np.memmap(self.features_file(), dtype = np.float16, mode = 'r+', shape = self.shape)
+            self.filled = np.memmap(self.filled_file(), dtype = np.uint8, mode = 'r+', shape = (self.shape[0],))
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    def check_space(self, count):
+        # raises unless the file system of the store has room for 'count' more rows
+        needed = count*int(np.prod(self.shape[1:]))*2
+        stat = os.statvfs(self.path)
+        free = stat.f_bavail*stat.f_frsize
+        if needed > free:
+            raise ValueError('feature_store: {0} samples need {1:.1f} GB in {2}, but only {3:.1f} GB are free'.format(
+                count, needed/2.**30, self.path, free/2.**30))
+
+    def fill(self, features, dataset, fields = 1, batch_size = 4, workers = 1):
+        # features(*sample[:fields]) for the samples of 'dataset' that are not in the store yet
+        self.open()
+        missing = np.flatnonzero(self.filled == 0).tolist()
+        if len(missing) == 0:
+            return
+        self.check_space(len(missing))
+        data_loader = torch_data.DataLoader(dataset, batch_size = batch_size, sampler = missing,
+                                            num_workers = workers, collate_fn = default_collate)
+        device = devices.default_device()
+
+        jitter = getattr(dataset, 'pca_jitter', None)
+        if jitter is not None:
+            dataset.pca_jitter = False
+        done = 0
+        try:
+            with torch.no_grad():
+                for i, batch in enumerate(data_loader):
+                    out = features(*[t.to(device) for t in batch[:fields]])
+                    index = missing[done:done + out.size(0)]
+                    self.features[index] = out.cpu().numpy().astype(np.float16)
+                    self.filled[index] = 1
+                    done += out.size(0)
+                    if i % 100 == 0:
+                        print('features {0}/{1}'.format(done, len(missing)))
+        finally:
+            if jitter is not None:
+                dataset.pca_jitter = jitter
+        self.features.flush()
+        self.filled.flush()
+
+    def get(self, index):
+        self.open()
+
+        return torch.from_numpy(np.array(self.features[index]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['features'] = None
+        state['filled'] = None
+
+        return state
+
+
+class FeatureDataset(torch_data.Dataset):
+    # (features, label, label_weight, depth_mapping_3d) for every sample of 'dataset', whose
+    # targets(index) gives the last three without reading the image. The features stay
+    # float16, the engines widen them on the compute device.
+    def __init__(self, dataset, store):
+        self.dataset = dataset
+        self.store = store
+
+    def __len__(self):
+
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+
+        return (self.store.get(index),) + tuple(self.dataset.targets(index))
+
+
+def cache_features(model, dataset, path, sample_list = None, batch_size = 4, workers = 1):
+    # Fills the store at 'path' with model.features() of every sample of 'dataset' and returns
+    # the dataset that reads them, for a model whose cached_features is then set.
+    store = FeatureStore(path, len(dataset), (model.dim_inc_dim, model.img_size[1], model.img_size[0]),
+                         fingerprint(model.seg2d, len(dataset), sample_list))
+    training = model.training
+    model.to(devices.default_device()).eval()
+    store.fill(model.features, dataset, batch_size = batch_size, workers = workers)
+    model.train(training)
+
+    return FeatureDataset(dataset, store)
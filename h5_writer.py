@@ -0,0 +1,99 @@
+import argparse
+import os
+import resource
+import time
+import numpy as np
+import h5py
+
+# Writes the predictions of the gen_result_*.py scripts batch by batch. The 'result' dataset
+# is created resizable along the samples, chunked one sample at a time (what ssc_eval.py
+# reads), when the writer is made if sample_shape is given and with the first batch if not;
+# every append() grows it, writes the batch and flushes the file. A writer closed without
+# any batch and without sample_shape raises, as it could not create the dataset. A run
+# holds one batch of predictions instead of all of them twice (the list and its np.vstack),
+# and a run that stops midway leaves a file with the samples written so far.
+# compression is passed to h5py, e.g. 'gzip' (with compression_opts, the level) or 'lzf';
+# the softmax scores do not compress much, so it is off by default. The gen_result scripts
+# take it as --compression gzip|lzf and --compression-level N.
+
+
+class ResultWriter(object):
+    def __init__(self, path, sample_shape = None, name = 'result', dtype = 'f', compression = None, compression_opts = None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = h5py.File(path, 'w')
+        self.name = name
+        self.dtype = dtype
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.dataset = None
+        if sample_shape is not None:
+            self.create(tuple(sample_shape))
+
+    def create(self, sample_shape):
+        self.dataset = self.file.create_dataset(self.name, (0,) + sample_shape, dtype = self.dtype,
+                                                maxshape = (None,) + sample_shape,
+                                                chunks = (1,) + sample_shape,
+                                                compression = self.compression,
+                                                compression_opts = self.compression_opts)
+
+    def __len__(self):
+
+        return 0 if self.dataset is None else self.dataset.shape[0]
+
+    def append(self, batch):
+        # batch: (n, ...) array of n samples
+        batch = np.asarray(batch)
+        if self.dataset is None:
+            self.create(batch.shape[1:])
+        elif batch.shape[1:] != self.dataset.shape[1:]:
+            raise ValueError('h5_writer: the samples of {0} are {1}, got a batch of {2}'.format(
+                self.name, self.dataset.shape[1:], batch.shape[1:]))
+
+        start = self.dataset.shape[0]
+        self.dataset.resize(start + batch.shape[0], axis = 0)
+        self.dataset[start:] = batch
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.dataset is None:
+            raise ValueError('h5_writer: no batch was written and the sample shape is unknown, so the file has no {0} dataset'.format(self.name))
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# python h5_writer.py /tmp/result.hdf5 --samples 40
+def main():
+    parser = argparse.ArgumentParser(description='Write random 12x60x36x60 predictions batch by batch and report the peak memory')
+    parser.add_argument('path')
+    parser.add_argument('--samples', default=40, type=int, metavar='N')
+    parser.add_argument('--batch-size', default=4, type=int, metavar='N')
+    parser.add_argument('--compression', default=None, choices=['gzip', 'lzf'])
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    start = time.time()
+    with ResultWriter(args.path, (12, 60, 36, 60), compression = args.compression) as writer:
+        for begin in range(0, args.samples, args.batch_size):
+            n = min(args.batch_size, args.samples - begin)
+            writer.append(rng.rand(n, 12, 60, 36, 60).astype(np.float32))
+        count = len(writer)
+    # ru_maxrss is in kB on Linux
+    print('{0} samples in {1:.1f} s, {2:.0f} MB on disk, peak {3:.0f} MB'.format(
+          count, time.time() - start, os.path.getsize(args.path)/2.**20,
+          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2.**10))
+
+
+if __name__ == '__main__':
+
+    main()
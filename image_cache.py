@@ -0,0 +1,119 @@
+import os
+import numpy as np
+from PIL import Image
+
+# Per-image data kept in a memory-mapped array on disk, one row per entry of a loader's
+# image list. A row is recomputed whenever the modification time of its source image
+# changes, and the whole cache is reset when the image list is not the one it was built for.
+
+
+class RowCache(object):
+    def __init__(self, cache_path, filelist, row_shape, dtype):
+        self.cache_path = cache_path
+        self.filelist = list(filelist)
+        self.shape = (len(self.filelist),) + tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+        if self.load_list() != self.filelist or not self.check_size():
+            self.reset()
+
+        # the arrays are mapped lazily, so that every dataloader worker maps its own
+        self.rows = None
+        self.mtimes = None
+
+    def list_file(self):
+
+        return os.path.join(self.cache_path, 'list.txt')
+
+    def rows_file(self):
+
+        return os.path.join(self.cache_path, 'rows.bin')
+
+    def mtimes_file(self):
+
+        return os.path.join(self.cache_path, 'mtimes.bin')
+
+    def load_list(self):
+        if not os.path.isfile(self.list_file()):
+            return None
+        fid = open(self.list_file(), "r")
+        filelist = [line.rstrip("\n") for line in fid.readlines()]
+        fid.close()
+
+        return filelist
+
+    def check_size(self):
+        if not os.path.isfile(self.rows_file()) or not os.path.isfile(self.mtimes_file()):
+            return False
+
+        return os.path.getsize(self.rows_file()) == int(np.prod(self.shape))*self.dtype.itemsize and \
+               os.path.getsize(self.mtimes_file()) == 8*self.shape[0]
+
+    def reset(self):
+        # every row starts with an mtime of -1, so it is filled on first access
+        np.memmap(self.rows_file(), dtype = self.dtype, mode = 'w+', shape = self.shape).flush()
+        mtimes = np.memmap(self.mtimes_file(), dtype = np.float64, mode = 'w+', shape = (self.shape[0],))
+        mtimes[:] = -1
+        mtimes.flush()
+        fid = open(self.list_file(), "w")
+        for line in self.filelist:
+            fid.write(line + "\n")
+        fid.close()
+
+    def open(self):
+        if self.rows is None:
+            self.rows = np.memmap(self.rows_file(), dtype = self.dtype, mode = 'r+', shape = self.shape)
+            self.mtimes = np.memmap(self.mtimes_file(), dtype = np.float64, mode = 'r+', shape = (self.shape[0],))
+
+    def __len__(self):
+
+        return len(self.filelist)
+
+    def get_row(self, index, compute):
+        # 'compute' is only called when the row is missing or older than its source image
+        self.open()
+        mtime = os.path.getmtime(self.filelist[index])
+        if self.mtimes[index] != mtime:
+            row = compute()
+            self.rows[index] = row
+            self.mtimes[index] = mtime
+            return row
+
+        return self.rows[index]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['rows'] = None
+        state['mtimes'] = None
+
+        return state
+
+
+class ImageCache(RowCache):
+    # The RGB and HHA inputs, decoded and resized to 384x288 with Image.LANCZOS once.
+    def __init__(self, cache_path, filelist, resize_size = (384, 288)):
+
+        super(ImageCache, self).__init__(cache_path, filelist, (resize_size[1], resize_size[0], 3), np.uint8)
+
+        self.resize_size = resize_size
+
+    def load(self, index):
+        image = Image.open(self.filelist[index]).convert('RGB')
+        image = image.resize(self.resize_size, Image.LANCZOS)
+
+        return np.asarray(image)
+
+    def get(self, index):
+        # returns the same PIL image as Image.open(...).convert('RGB').resize(resize_size, Image.LANCZOS)
+
+        return Image.fromarray(np.asarray(self.get_row(index, lambda: self.load(index))))
+
+    def fill(self):
+        for i in range(len(self.filelist)):
+            self.get(i)
+            if i % 100 == 0:
+                print('{0}/{1}'.format(i, len(self.filelist)))
+        self.rows.flush()
+        self.mtimes.flush()
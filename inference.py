@@ -0,0 +1,209 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+import aspp_fusion
+
+# freeze_for_inference(model) turns a trained SATNet model into one that only evaluates:
+#  - every BatchNorm that directly follows a convolution is folded into the weights and a
+#    bias of that convolution and replaced by an identity. The pairs are the neighbours of
+#    an nn.Sequential (ASPP3Dout, seq1/seq2, _classifier, the ResNet downsample) and the
+#    convN/bnN attributes of one module (ResNet Bottleneck conv1..3/bn1..3, DUC conv/bn,
+#    the Seg2DNet stem conv1/bn0);
+#  - the ASPP blocks are fused by aspp_fusion.fuse;
+#  - Dropout layers are replaced by an identity;
+#  - the parameters stop requiring gradients and the model stays in eval mode.
+# The folding changes the weights, so save the checkpoints of the model before freezing it.
+
+# (conv, BatchNorm) attribute names of the modules that apply bn(conv(x))
+PAIRS = [('conv', 'bn'), ('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'), ('conv1', 'bn0')]
+
+CONVS = (nn.Conv2d, nn.Conv3d)
+NORMS = (nn.BatchNorm2d, nn.BatchNorm3d)
+
+
+class Identity(nn.Module):
+    # stands in for the removed layers, nn.Identity is not in PyTorch 0.4
+
+    def forward(self, x):
+
+        return x
+
+
+def fold(conv, bn):
+    # a convolution with a bias that computes bn(conv(x)) with the running statistics of bn
+    folded = type(conv)(conv.in_channels, conv.out_channels, conv.kernel_size, stride = conv.stride,
+                        padding = conv.padding, dilation = conv.dilation, groups = conv.groups, bias = True)
+    weight, bias = aspp_fusion.fold(conv, bn)
+    folded.weight.data.copy_(weight.data)
+    folded.bias.data.copy_(bias.data)
+
+    return folded.to(conv.weight.device)
+
+
+def _fold_sequential(seq):
+    count = 0
+    names = list(seq._modules.keys())
+    for first, second in zip(names[:-1], names[1:]):
+        conv, bn = seq._modules[first], seq._modules[second]
+        if isinstance(conv, CONVS) and isinstance(bn, NORMS):
+            seq._modules[first] = fold(conv, bn)
+            seq._modules[second] = Identity()
+            count += 1
+
+    return count
+
+
+def _fold_attributes(module):
+    count = 0
+    for conv_name, bn_name in PAIRS:
+        conv, bn = module._modules.get(conv_name), module._modules.get(bn_name)
+        if isinstance(conv, CONVS) and isinstance(bn, NORMS):
+            setattr(module, conv_name, fold(conv, bn))
+            setattr(module, bn_name, Identity())
+            count += 1
+
+    return count
+
+
+def freeze_for_inference(model):
+    # returns the model, frozen in place
+    model.eval()
+    aspp_fusion.fuse(model)
+
+    for module in list(model.modules()):
+        if isinstance(module, aspp_fusion.FusedASPP):
+            continue
+        if isinstance(module, nn.Sequential):
+            _fold_sequential(module)
+        else:
+            _fold_attributes(module)
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.modules.dropout._DropoutNd):
+                setattr(module, name, Identity())
+
+    for param in model.parameters():
+        param.requires_grad = False
+
+    return model.eval()
+
+
+class _Bottleneck(nn.Module):
+    # torchvision's ResNet Bottleneck
+    def __init__(self, inplanes, planes, stride = 1):
+        super(_Bottleneck, self).__init__()
+        self.conv1 = nn.Conv2d(inplanes, planes, kernel_size=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(planes)
+        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(planes)
+        self.conv3 = nn.Conv2d(planes, planes*4, kernel_size=1, bias=False)
+        self.bn3 = nn.BatchNorm2d(planes*4)
+        self.relu = nn.ReLU(inplace=True)
+        self.downsample = nn.Sequential(nn.Conv2d(inplanes, planes*4, kernel_size=1, stride=stride, bias=False),
+                                        nn.BatchNorm2d(planes*4))
+
+    def forward(self, x):
+        out = self.relu(self.bn1(self.conv1(x)))
+        out = self.relu(self.bn2(self.conv2(out)))
+        out = self.bn3(self.conv3(out))
+
+        return self.relu(out + self.downsample(x))
+
+
+class _DUC(nn.Module):
+    def __init__(self, inplanes, planes, upscale_factor=2):
+        super(_DUC, self).__init__()
+        self.relu = nn.ReLU()
+        self.conv = nn.Conv2d(inplanes, planes, kernel_size=3, padding=1, bias = False)
+        self.bn = nn.BatchNorm2d(planes)
+        self.pixel_shuffle = nn.PixelShuffle(upscale_factor)
+
+    def forward(self, x):
+
+        return self.pixel_shuffle(self.relu(self.bn(self.conv(x))))
+
+
+class _Seg2D(nn.Module):
+    # the tail of Seg2DNet at its resolutions: stem, a Bottleneck, DUC, ASPP and a classifier
+    def __init__(self):
+        super(_Seg2D, self).__init__()
+        self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3, bias=False)
+        self.bn0 = nn.BatchNorm2d(64)
+        self.relu = nn.ReLU(inplace=True)
+        self.layer = _Bottleneck(64, 32)
+        self.duc = _DUC(128, 128)
+        self.ASPP = aspp_fusion.ASPP(32, 64, [1, 3, 5, 7])
+        self.classifier = nn.Sequential(nn.Conv2d(64, 32, 3, padding=1, bias=False), nn.BatchNorm2d(32, momentum=.95),
+                                        nn.ReLU(inplace=True), nn.Dropout(.1), nn.Conv2d(32, 12, 1))
+
+    def forward(self, x):
+        x = self.relu(self.bn0(self.conv1(x)))
+
+        return self.classifier(self.ASPP(self.duc(self.layer(x))))
+
+
+class _Head3D(nn.Module):
+    # the 3D part of ImageGen3DNet
+    def __init__(self):
+        super(_Head3D, self).__init__()
+        def block():
+            return nn.Sequential(nn.Conv3d(64, 64, 3, padding = 1, bias = False), nn.BatchNorm3d(64),
+                                 nn.ReLU(inplace = True), nn.Conv3d(64, 64, 3, padding = 1, bias = False),
+                                 nn.BatchNorm3d(64))
+        self.seq1 = block()
+        self.seq2 = block()
+        self.relu = nn.ReLU(inplace = True)
+        self.ASPP3D1 = aspp_fusion.ASPP3D(64, 64, [1, 2, 3])
+        self.ASPP3D2 = aspp_fusion.ASPP3D(64, 64, [1, 2, 3])
+        self.ASPP3Dout = nn.Sequential(
+            nn.Conv3d(256, 128, 1, bias = False), nn.BatchNorm3d(128), nn.ReLU(inplace = True),
+            nn.Conv3d(128, 128, 1, bias = False), nn.BatchNorm3d(128), nn.ReLU(inplace = True),
+            nn.Conv3d(128, 12, 1), nn.Conv3d(12, 12, 3, padding = 1))
+
+    def forward(self, segres):
+        x1 = self.relu(self.seq1(segres) + segres)
+        x2 = self.relu(self.seq2(x1) + x1)
+        x3 = self.ASPP3D1(x2)
+        x4 = self.ASPP3D2(x3)
+
+        return self.ASPP3Dout(torch.cat((x1,x2,x3,x4), dim = 1))
+
+
+# python inference.py
+def main():
+    parser = argparse.ArgumentParser(description='Time frozen against unfrozen SATNet blocks on the CPU')
+    parser.add_argument('--batch-size', default=1, type=int, metavar='N')
+    parser.add_argument('--repeat', default=3, type=int, metavar='N', help='the best of N runs is reported')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    models = [('2D: stem, Bottleneck, DUC, ASPP, classifier on 3x288x384', _Seg2D, (3, 288, 384)),
+              ('3D: seq1, seq2, ASPP3D x2, ASPP3Dout on 64x60x36x60', _Head3D, (64, 60, 36, 60))]
+    for title, cls, size in models:
+        model = aspp_fusion._randomize(cls()).eval()
+        frozen = cls()
+        frozen.load_state_dict(model.state_dict())
+        freeze_for_inference(frozen)
+        x = torch.randn((args.batch_size,) + size)
+
+        times = {}
+        with torch.no_grad():
+            for name, m in (('original', model), ('frozen', frozen)):
+                m(x)
+                best = None
+                for _ in range(args.repeat):
+                    start = time.time()
+                    out = m(x)
+                    elapsed = time.time() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                times[name] = (out, best)
+        diff = (times['original'][0] - times['frozen'][0]).abs().max().item()
+        print('{0}: original {1:.0f} ms, frozen {2:.0f} ms, max difference {3:.2e}'.format(
+              title, times['original'][1]*1000, times['frozen'][1]*1000, diff))
+
+
+if __name__ == '__main__':
+
+    main()
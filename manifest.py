@@ -0,0 +1,164 @@
+import argparse
+import os
+import numpy as np
+
+# The result of validating a sample list, so that constructing a loader does not stat
+# every line of the list again (minutes for the SUNCG lists over NFS).
+# The manifest is an uncompressed .npz of
+#   list       float64 (2,)    size and mtime of the sample list it was built from
+#   npz_path   the npz directory that was checked, '' if none
+#   line       int64 (n,)      line number (from 0) of every line that passed
+#   paths      S (n, k)        the k paths checked for the line, utf-8
+#   sizes      int64 (n, k)    their sizes in bytes
+#   npz_index  int64 (n,)      the %06d.npz of the line, i.e. its position among the lines that passed
+#   npz_exists bool (n,)       whether npz_path holds that npz, True if npz_path was not checked
+#   rule       S (k,)          the paths derive() gives for RULE_LINE, utf-8
+# It is rebuilt when the sample list or the derive rule changes (the seg_* scripts of one
+# list derive different category images), and revalidated against the files only on request.
+
+# a line that no list holds; what derive() makes of it tells the derive rules apart
+RULE_LINE = 'manifest_rule_line_0123456789_abcdefghij.png'
+
+
+def _str(path):
+
+    return path if isinstance(path, str) else path.decode('utf-8')
+
+
+def _bytes(path):
+
+    return path if isinstance(path, bytes) else path.encode('utf-8')
+
+
+def rule(derive):
+
+    return [_str(p) for p in derive(RULE_LINE)]
+
+
+def list_stat(path):
+    stat = os.stat(path)
+
+    return np.array([stat.st_size, stat.st_mtime], dtype = np.float64)
+
+
+class Manifest(object):
+    def __init__(self, line, paths, sizes, npz_index, npz_exists):
+        self.line = line
+        self.paths = paths
+        self.sizes = sizes
+        self.npz_index = npz_index
+        self.npz_exists = npz_exists
+
+    def __len__(self):
+
+        return len(self.line)
+
+
+def scan(path, derive, npz_path = None):
+    # derive(line) gives the paths that must all exist for the line to be kept
+    fid = open(path, "r")
+    lines = [line.rstrip("\n") for line in fid.readlines()]
+    fid.close()
+
+    line_ind = []
+    paths = []
+    sizes = []
+    for ind, line in enumerate(lines):
+        checked = tuple(derive(line))
+        if all(os.path.exists(p) for p in checked):
+            line_ind.append(ind)
+            paths.append(checked)
+            sizes.append([os.path.getsize(p) for p in checked])
+
+    npz_index = list(range(len(line_ind)))
+    if npz_path is not None:
+        npz_exists = [os.path.isfile(os.path.join(npz_path, '%06d.npz'%i)) for i in npz_index]
+    else:
+        npz_exists = [True]*len(line_ind)
+
+    return Manifest(line_ind, paths, sizes, npz_index, npz_exists)
+
+
+def save(manifest_file, manifest, path, npz_path = None, derive = None):
+    directory = os.path.dirname(manifest_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    if len(manifest) > 0:
+        paths = np.array([[_bytes(p) for p in row] for row in manifest.paths], dtype = np.bytes_)
+        sizes = np.array(manifest.sizes, dtype = np.int64)
+    else:
+        # no line passed, and reshape(-1, 0) of nothing has no answer
+        paths = np.zeros((0, 0), dtype = np.bytes_)
+        sizes = np.zeros((0, 0), dtype = np.int64)
+    derived = [_bytes(p) for p in rule(derive)] if derive is not None else []
+    fid = open(manifest_file, 'wb')
+    np.savez(fid, list = list_stat(path), npz_path = np.array(_bytes(npz_path or ''), dtype = np.bytes_),
+             rule = np.array(derived, dtype = np.bytes_),
+             line = np.array(manifest.line, dtype = np.int64), paths = paths,
+             sizes = sizes,
+             npz_index = np.array(manifest.npz_index, dtype = np.int64),
+             npz_exists = np.array(manifest.npz_exists, dtype = np.bool_))
+    fid.close()
+
+
+def load(manifest_file, path = None, npz_path = None, derive = None):
+    # None if there is no manifest, or it was built from another version of 'path', another
+    # npz_path or another derive rule
+    if not os.path.isfile(manifest_file):
+        return None
+    data = np.load(manifest_file)
+    if path is not None and not np.array_equal(data['list'], list_stat(path)):
+        return None
+    if _str(data['npz_path'].item()) != (npz_path or ''):
+        return None
+    if derive is not None and ('rule' not in data.files or [_str(p) for p in data['rule']] != rule(derive)):
+        return None
+
+    return Manifest(data['line'].tolist(), [[_str(p) for p in row] for row in data['paths']],
+                    data['sizes'].tolist(), data['npz_index'].tolist(), data['npz_exists'].tolist())
+
+
+def read(path, derive, manifest_file = None, npz_path = None, revalidate = False):
+    # The validated lines of 'path', from the manifest when there is an up-to-date one.
+    # Without manifest_file this is the plain scan every loader used to do.
+    if manifest_file is not None and not revalidate:
+        manifest = load(manifest_file, path, npz_path, derive)
+        if manifest is not None:
+            return manifest
+
+    manifest = scan(path, derive, npz_path)
+    if manifest_file is not None:
+        save(manifest_file, manifest, path, npz_path, derive)
+
+    return manifest
+
+
+def check(manifest_file):
+    # Reports the files of a manifest that disappeared or changed size since it was built.
+    manifest = load(manifest_file)
+    changed = 0
+    for paths, sizes in zip(manifest.paths, manifest.sizes):
+        for p, size in zip(paths, sizes):
+            if not os.path.exists(p):
+                print('missing: {0}'.format(p))
+                changed += 1
+            elif os.path.getsize(p) != size:
+                print('size changed: {0}'.format(p))
+                changed += 1
+    print('{0} lines, {1} files missing or changed'.format(len(manifest), changed))
+
+
+# python manifest.py /media/jason/JetsonSSD/myselect_suncg_manifest_train.npz
+def main():
+    parser = argparse.ArgumentParser(description='Check the files recorded in a sample list manifest')
+    parser.add_argument('manifest_file', metavar='FILE',
+                        help='manifest written by a loader, see manifest.read')
+    args = parser.parse_args()
+
+    check(args.manifest_file)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import os
+import numpy as np
+
+import torch.utils.data as torch_data
+
+import depth_mapping
+
+# A split of %06d.npz files packed into fixed-stride records, so that a sample is a
+# slice of a memory-mapped shard instead of a zip-open and inflate of its own file.
+#   label   uint8, 129600   arr_1 (0..11, 255 for unknown)
+#   weight  uint8, 16200    arr_2 bit-packed with np.packbits
+#   mapping int32, 129600   pooled depth_mapping_3d, see depth_mapping.compute
+# 'index.npy' holds one (npz index, shard, row) line per record.
+NUM_VOXELS = 129600
+RECORD = np.dtype([('label', np.uint8, (NUM_VOXELS,)),
+                   ('weight', np.uint8, (NUM_VOXELS//8,)),
+                   ('mapping', np.int32, (NUM_VOXELS,))])
+
+
+def shard_file(shard_path, shard):
+
+    return os.path.join(shard_path, 'shard_%04d.bin'%shard)
+
+
+def index_file(shard_path):
+
+    return os.path.join(shard_path, 'index.npy')
+
+
+def pack(loaddata):
+    label = loaddata['arr_1'].reshape(-1)
+    weight = loaddata['arr_2'].reshape(-1)
+    if label.size != NUM_VOXELS or weight.size != NUM_VOXELS:
+        raise ValueError('expected {0} voxels, got {1} labels and {2} weights'.format(NUM_VOXELS, label.size, weight.size))
+    if label.min() < 0 or label.max() > 255:
+        raise ValueError('labels do not fit in uint8')
+    if not np.all((weight == 0) | (weight == 1)):
+        raise ValueError('weights are not a 0/1 mask and cannot be bit-packed')
+
+    record = np.zeros((), dtype = RECORD)
+    record['label'] = label
+    record['weight'] = np.packbits(weight.astype(np.uint8))
+    record['mapping'] = depth_mapping.compute(loaddata['arr_3'])
+
+    return record
+
+
+def build(npz_path, shard_path, shard_size = 1024):
+    if not os.path.exists(shard_path):
+        os.makedirs(shard_path)
+
+    namelist = sorted([name for name in os.listdir(npz_path) if name.endswith('.npz')])
+    index = np.zeros((len(namelist), 3), dtype = np.int64)
+    shard = None
+    for i, name in enumerate(namelist):
+        if i % shard_size == 0:
+            if shard is not None:
+                shard.flush()
+            shard = np.memmap(shard_file(shard_path, i//shard_size), dtype = RECORD, mode = 'w+',
+                              shape = (min(shard_size, len(namelist) - i),))
+        shard[i % shard_size] = pack(np.load(os.path.join(npz_path, name)))
+        index[i] = [int(name[:-4]), i//shard_size, i % shard_size]
+        if i % 100 == 0:
+            print('{0}/{1}'.format(i, len(namelist)))
+    if shard is not None:
+        shard.flush()
+
+    np.save(index_file(shard_path), index)
+
+
+class ShardReader(object):
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        index = np.load(index_file(shard_path))
+        self.npz_index = index[:, 0]
+        self.location = dict((int(row[0]), (int(row[1]), int(row[2]))) for row in index)
+        # shards are mapped lazily, so that every dataloader worker maps its own
+        self.shards = {}
+
+    def __len__(self):
+
+        return len(self.npz_index)
+
+    def __contains__(self, npz_index):
+
+        return npz_index in self.location
+
+    def record(self, npz_index):
+        shard, row = self.location[npz_index]
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(shard_file(self.shard_path, shard), dtype = RECORD, mode = 'r')
+
+        return self.shards[shard][row]
+
+    def get(self, npz_index):
+        # label and mapping are views into the page cache, only the weight mask is unpacked
+        record = self.record(npz_index)
+        weight = np.unpackbits(record['weight'])
+
+        return record['label'], weight, record['mapping']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+
+        return state
+
+
+class ShardDataset(torch_data.Dataset):
+    def __init__(self, shard_path):
+
+        super(ShardDataset, self).__init__()
+
+        self.reader = ShardReader(shard_path)
+
+    def __len__(self):
+
+        return len(self.reader)
+
+    def __getitem__(self, index):
+        # default_collate stacks the views straight from the mapped pages into the batch
+
+        return self.reader.get(int(self.reader.npz_index[index]))
+
+
+# python npz_shards.py /media/jason/JetsonSSD/nyu_selected /media/jason/JetsonSSD/nyu_selected_shards
+def main():
+    parser = argparse.ArgumentParser(description='Pack the npz files of a split into memory-mapped shards')
+    parser.add_argument('npz_path', metavar='DIR',
+                        help='directory of %%06d.npz files')
+    parser.add_argument('shard_path', metavar='DIR',
+                        help='directory to write the shards and index.npy to')
+    parser.add_argument('--shard-size', default=1024, type=int, metavar='N',
+                        help='records per shard (default: 1024)')
+    args = parser.parse_args()
+
+    build(args.npz_path, args.shard_path, args.shard_size)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,70 @@
+import numpy as np
+
+import torch
+from torch.utils.data.dataloader import default_collate
+
+import image_cache
+
+# PCA colour jitter of PCA_Jittering, moved from the PIL image onto the normalized tensor.
+# PCA_Jittering adds p^T (alpha*lamda) to the [0, 1] image, where lamda and p come from
+# np.linalg.eig of the 3x3 colour covariance of the resized image and alpha ~ N(0, 1).
+# On the normalized tensor this is an add of add_num/std, clamped to the normalized
+# [0, 1] range. Only the truncation to uint8 levels of the jittered image is dropped.
+
+
+def eigen(img):
+    # the 3 eigenvalues followed by the 3x3 eigenvectors, exactly as PCA_Jittering computes them
+    img = np.asanyarray(img, dtype = 'float32')
+    img = img / 255.0
+    img1 = np.transpose(img.reshape(-1, 3))
+    img_cov = np.cov([img1[0], img1[1], img1[2]])
+    lamda, p = np.linalg.eig(img_cov)
+
+    return np.concatenate((lamda, p.reshape(-1))).astype(np.float32)
+
+
+class EigenCache(image_cache.RowCache):
+    def __init__(self, cache_path, filelist):
+
+        super(EigenCache, self).__init__(cache_path, filelist, (12,), np.float32)
+
+    def get(self, index, img):
+        # 'img' is the resized image of filelist[index], it is only used when the row is stale
+
+        return torch.from_numpy(np.array(self.get_row(index, lambda: eigen(img))))
+
+
+def jitter(tensor, eigen, mean, std):
+    # tensor: (bs, 3*k, h, w) normalized images, each group of 3 channels jittered on its own.
+    # eigen: (bs, 12) rows of eigen().
+    bs = tensor.size(0)
+    k = tensor.size(1) // 3
+    lamda = eigen[:, :3].contiguous().view(bs, 1, 3)
+    p = eigen[:, 3:].contiguous().view(bs, 3, 3)
+    alpha = torch.randn(bs, k, 3)
+    add_num = torch.matmul(alpha*lamda, p) # (alpha*lamda)^T p = (p^T (alpha*lamda))^T
+
+    mean = torch.FloatTensor(mean).repeat(k).view(1, 3*k, 1, 1)
+    std = torch.FloatTensor(std).repeat(k).view(1, 3*k, 1, 1)
+    tensor = tensor + add_num.view(bs, 3*k, 1, 1)/std
+    tensor = torch.max(torch.min(tensor, (1 - mean)/std), -mean/std)
+
+    return tensor
+
+
+class PCAJitterCollate(object):
+    # collate_fn for datasets that append the eigen() row of their colour image to every sample.
+    # 'collate' builds the minibatch first, e.g. with the flipped copies the jitter should also see.
+    def __init__(self, mean, std, field = 0, collate = default_collate):
+        self.mean = mean
+        self.std = std
+        self.field = field
+        self.collate = collate
+
+    def __call__(self, batch):
+        batch = self.collate(batch)
+        eigen = batch[-1]
+        batch = list(batch[:-1])
+        batch[self.field] = jitter(batch[self.field], eigen, self.mean, self.std)
+
+        return batch
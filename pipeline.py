@@ -0,0 +1,122 @@
+import argparse
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import torch
+import torch.nn as nn
+
+# Pipelined execution of a model made of parallel branches followed by a merge, such as
+# SATNet_ThinkNetFuse (image branch, depth branch, ASPP3Dout). The batch is split into
+# micro-batches; every branch runs on its own thread through the micro-batches in order,
+# and the merge runs on the calling thread as soon as all branches have produced a
+# micro-batch. With the branches and the merge on different devices (see devices.py) the
+# branches overlap each other and the merge of micro-batch k overlaps the branches of
+# micro-batch k+1. The threads are what makes this work on CPU "devices" too: PyTorch
+# releases the GIL inside its operators.
+# The outputs are concatenated, so the result is the one of the whole batch, except that
+# BatchNorm layers in training mode see the statistics of a micro-batch.
+
+
+def _branch(fn, chunks, results, stop, grad_enabled):
+    try:
+        with torch.set_grad_enabled(grad_enabled):
+            for inputs in chunks:
+                if stop.is_set():
+                    return
+                results.put((True, fn(*inputs)))
+    except Exception as e:
+        results.put((False, e))
+
+
+def run(branches, merge, inputs, micro_batches):
+    # branches: callables, branches[i](*inputs[i]) is the output of branch i.
+    # merge: callable, merge(*outputs) of the branch outputs of a micro-batch.
+    # inputs: tuple of tensors for every branch, all with the batch in dim 0.
+    chunks = [list(zip(*[torch.chunk(t, micro_batches, 0) for t in branch_inputs])) for branch_inputs in inputs]
+    num = len(chunks[0])
+    stop = threading.Event()
+    grad_enabled = torch.is_grad_enabled()
+
+    results = [queue.Queue() for _ in branches]
+    threads = [threading.Thread(target = _branch, args = (fn, c, r, stop, grad_enabled))
+               for fn, c, r in zip(branches, chunks, results)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    outputs = []
+    try:
+        for _ in range(num):
+            branch_outputs = []
+            for r in results:
+                ok, value = r.get()
+                if not ok:
+                    raise value
+                branch_outputs.append(value)
+            outputs.append(merge(*branch_outputs))
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    return torch.cat(outputs, 0)
+
+
+class _Toy(nn.Module):
+    # two 2D branches and a merge, roughly the shape of the ThinkNetFuse stages
+    def __init__(self, width, depth):
+        super(_Toy, self).__init__()
+        def stack(ch):
+            layers = [nn.Conv2d(ch, width, 3, padding = 1)]
+            for _ in range(depth - 1):
+                layers += [nn.ReLU(inplace = True), nn.Conv2d(width, width, 3, padding = 1)]
+            return nn.Sequential(*layers)
+        self.image = stack(3)
+        self.depth = stack(3)
+        self.fuse = nn.Sequential(nn.Conv2d(2*width, width, 3, padding = 1), nn.ReLU(inplace = True),
+                                  nn.Conv2d(width, 12, 1))
+
+    def merge(self, img, depth):
+
+        return self.fuse(torch.cat((img, depth), dim = 1))
+
+
+# python pipeline.py --batch-size 8 --micro-batches 4
+def main():
+    parser = argparse.ArgumentParser(description='Time pipelined against sequential execution of two branches and a merge on the CPU')
+    parser.add_argument('--batch-size', default=8, type=int, metavar='N')
+    parser.add_argument('--micro-batches', default=4, type=int, metavar='N')
+    parser.add_argument('--size', default=96, type=int, metavar='N', help='height and width of the input')
+    parser.add_argument('--width', default=32, type=int, metavar='N', help='channels of the branches')
+    parser.add_argument('--layers', default=6, type=int, metavar='N', help='convolutions per branch')
+    parser.add_argument('--repeat', default=5, type=int, metavar='N')
+    args = parser.parse_args()
+
+    model = _Toy(args.width, args.layers).eval()
+    img = torch.randn(args.batch_size, 3, args.size, args.size)
+    depth = torch.randn(args.batch_size, 3, args.size, args.size)
+
+    def sequential():
+        return model.merge(model.image(img), model.depth(depth))
+
+    def pipelined():
+        return run([model.image, model.depth], model.merge, [(img,), (depth,)], args.micro_batches)
+
+    with torch.no_grad():
+        diff = (sequential() - pipelined()).abs().max().item()
+        for name, fn in (('sequential', sequential), ('pipelined', pipelined)):
+            fn()
+            start = time.time()
+            for _ in range(args.repeat):
+                fn()
+            print('{0}: {1:.1f} ms'.format(name, (time.time() - start)/args.repeat*1000))
+    print('max difference: {0}'.format(diff))
+
+
+if __name__ == '__main__':
+
+    main()
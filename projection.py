@@ -0,0 +1,66 @@
+import torch
+
+# Projection of the 2D features onto the voxel grid. Every voxel takes the feature of the
+# pixel 'depth_mapping_3d' points it at, or zeros when it points past the last pixel
+# (depth_mapping.EMPTY for the 640*480 features).
+#   feature  (bs, C, N) features of N pixels
+#   index    (bs, V) LongTensor of pixels in [0, N], N for an empty voxel
+#   returns  (bs, C, V), the layout the 3D network expects after a view
+# The gather over dim 2 handles the whole batch at once, so there is no per-sample loop,
+# no appended zero row and no permute/contiguous copy of the volume. The backward
+# scatter-adds the gradient of the voxels back onto their pixels.
+#
+# compose() folds the upsampling of the features to 640*480 (ImageGen3DNet.image_mapping)
+# into 'depth_mapping_3d', so the voxels gather straight from the features at the network's
+# resolution and the upsampled (bs, C, 640*480) tensor is never built.
+
+
+class Project(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, feature, index):
+        bs, ch, num = feature.size()
+        # only (bs, 1, V) index and mask tensors, expanded over the channels without a copy
+        empty = (index >= num).unsqueeze(1)
+        index = index.unsqueeze(1).masked_fill(empty, 0)
+        output = feature.gather(2, index.expand(bs, ch, index.size(2)))
+        output.masked_fill_(empty.expand_as(output), 0)
+
+        ctx.num = num
+        ctx.save_for_backward(index, empty)
+
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        index, empty = ctx.saved_tensors
+        grad_output = grad_output.masked_fill(empty.expand_as(grad_output), 0)
+        grad_feature = grad_output.new_zeros((grad_output.size(0), grad_output.size(1), ctx.num))
+        grad_feature.scatter_add_(2, index.expand_as(grad_output), grad_output)
+
+        return grad_feature, None
+
+
+def project(feature, index):
+
+    return Project.apply(feature, index)
+
+
+def compose(image_mapping, index, num):
+    # index (bs, V) into the N = image_mapping.size(0) upsampled pixels, N for an empty voxel;
+    # returns (bs, V) into the 'num' pixels image_mapping points at, num for an empty voxel
+    required = image_mapping.size(0)
+    empty = index >= required
+    composed = torch.index_select(image_mapping, 0, index.view(-1).clamp(max = required - 1)).view_as(index)
+
+    return composed.masked_fill(empty, num)
+
+
+def with_image_mapping(module, state_dict):
+    # Checkpoints saved while image_mapping was a plain attribute of the model do not have the
+    # buffer. It only depends on the image size, so the one the model computed is used.
+    state_dict = state_dict.copy()
+    for name, buf in module.state_dict().items():
+        if name.split('.')[-1] == 'image_mapping' and name not in state_dict:
+            state_dict[name] = buf
+
+    return state_dict
@@ -0,0 +1,152 @@
+import copy
+import time
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.data as torch_data
+from torch.utils.data.dataloader import default_collate
+
+import aspp_fusion
+
+# INT8 post-training static quantization of the 2D network of the SSC models (Seg2DNet,
+# or the ColorSeg/DepthSeg pair of the fusion models), which takes most of the FLOPs of a
+# CPU forward. quantize_2d() traces the network with FX, observes its activations on a few
+# hundred samples of a TrainDataLoader and converts it to fbgemm (x86) or qnnpack (ARM)
+# kernels. The result takes and returns float tensors, so quantize_model() puts it in
+# place of model.seg2d and the 3D part runs in float as before. The calibration sees the
+# unaugmented images: quantize_2d() turns the pca_jitter of the dataset off while it runs,
+# like feature_store.py. The ASPP blocks fused by inference.freeze_for_inference cannot be
+# traced, so they go back to separate conv and BatchNorm modules in the quantized copy. report() times the models given to it and accumulates the SSC IoU
+# with the IOU.computeIOU of the calling script, against the labels and against the
+# predictions of the first model. The single-branch gen_result scripts run both with
+# '--quantize fbgemm'. The quantized network runs on the CPU only. This needs
+# torch.ao.quantization (PyTorch 1.13 or later); with older versions the functions raise
+# a RuntimeError.
+
+try:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError:
+    get_default_qconfig_mapping = None
+
+
+def _require():
+    if get_default_qconfig_mapping is None:
+        raise RuntimeError('quantize: INT8 quantization needs torch.ao.quantization (PyTorch 1.13 or later), this is {0}'.format(torch.__version__))
+
+
+def _loader(dataset, num_samples, batch_size, seed = 0):
+    # a fixed random subset of the dataset
+    index = np.random.RandomState(seed).permutation(len(dataset))[:num_samples].tolist()
+
+    return torch_data.DataLoader(dataset, batch_size = batch_size, sampler = index, collate_fn = default_collate)
+
+
+class _ASPP(nn.Module):
+    # the branches of a FusedASPP with its conv and BatchNorm modules, which FX can trace
+    def __init__(self, fused):
+        super(_ASPP, self).__init__()
+        self.conv_list = fused.conv_list
+        self.two_stage = fused.two_stage
+        self.residual = fused.residual
+        if self.two_stage:
+            self.conv1 = fused.conv1
+            self.bn1 = fused.bn1
+            self.conv2 = fused.conv2
+            self.bn2 = fused.bn2
+        else:
+            self.conv = fused.conv
+            self.bn = fused.bn
+
+    def forward(self, x):
+        y = None
+        for i in range(len(self.conv_list)):
+            if self.two_stage:
+                out = self.bn2[i](self.conv2[i](F.relu(self.bn1[i](self.conv1[i](x)))))
+            else:
+                out = self.bn[i](self.conv[i](x))
+            y = out if y is None else y + out
+        if self.residual:
+            y = y + x
+
+        return F.relu(y)
+
+
+def _unfuse(module):
+    for parent in list(module.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, aspp_fusion.FusedASPP):
+                setattr(parent, name, _ASPP(child).eval())
+
+
+def quantize_2d(seg2d, dataset, fields = 1, num_samples = 200, batch_size = 4, backend = 'fbgemm'):
+    # A quantized copy of 'seg2d', calibrated on seg2d(*sample[:fields]) of 'num_samples'
+    # samples of 'dataset' (1 field for the RGB/Depth models, 2 for SeeNetFuse)
+    _require()
+    torch.backends.quantized.engine = backend
+    seg2d = copy.deepcopy(seg2d).cpu().eval()
+    _unfuse(seg2d)
+
+    jitter = getattr(dataset, 'pca_jitter', None)
+    if jitter is not None:
+        dataset.pca_jitter = False
+    prepared = None
+    try:
+        with torch.no_grad():
+            for i, batch in enumerate(_loader(dataset, num_samples, batch_size)):
+                inputs = tuple(t.float() for t in batch[:fields])
+                if prepared is None:
+                    prepared = prepare_fx(seg2d, get_default_qconfig_mapping(backend), inputs)
+                prepared(*inputs)
+                if i % 10 == 0:
+                    print('calibration {0}/{1}'.format(min((i + 1)*batch_size, num_samples), num_samples))
+    finally:
+        if jitter is not None:
+            dataset.pca_jitter = jitter
+    if prepared is None:
+        raise ValueError('quantize: no sample to calibrate on, the dataset is empty')
+
+    return convert_fx(prepared)
+
+
+def quantize_model(model, dataset, fields = 1, **kwargs):
+    # model with its 2D network quantized in place, on the CPU and evaluating
+    model.seg2d = quantize_2d(model.seg2d, dataset, fields, **kwargs)
+
+    return model.cpu().eval()
+
+
+def report(models, dataset, compute_iou, fields = 1, num_samples = 100, batch_size = 1, num_classes = 12):
+    # models: [(name, model)] of SSC models taking (*sample[:fields], depth_mapping_3d) on the
+    # CPU; prints the time per sample and the mean IoU over the classes but the empty one,
+    # and for the models after the first the mean IoU of their predictions against those of
+    # the first one
+    references = []
+    for k, (name, model) in enumerate(models):
+        model.eval()
+        accuracy_total = np.zeros((3, num_classes - 1), dtype = np.float32)
+        agreement_total = np.zeros((3, num_classes - 1), dtype = np.float32)
+        elapsed = 0.
+        count = 0
+        with torch.no_grad():
+            for i, batch in enumerate(_loader(dataset, num_samples, batch_size)):
+                inputs = [t.float() for t in batch[:fields]] + [batch[fields + 2].long()]
+                start = time.time()
+                output = model(*inputs)
+                elapsed += time.time() - start
+                count += output.size(0)
+                accuracy_total += compute_iou(output, batch[fields], num_classes)
+                prediction = torch.max(output, 1)[1].byte()
+                if k == 0:
+                    references.append(prediction)
+                else:
+                    agreement_total += compute_iou(output, references[i], num_classes)
+        iou = np.mean(accuracy_total[0]/(np.sum(accuracy_total, 0) + 0.00001))
+        if k == 0:
+            print('{0}: {1:.0f} ms per sample, mean IoU {2:.4f}'.format(name, elapsed/count*1000, iou))
+        else:
+            agreement = np.mean(agreement_total[0]/(np.sum(agreement_total, 0) + 0.00001))
+            print('{0}: {1:.0f} ms per sample, mean IoU {2:.4f}, mean IoU against {3} {4:.4f}'.format(
+                  name, elapsed/count*1000, iou, models[0][0], agreement))
@@ -0,0 +1,219 @@
+import argparse
+import multiprocessing
+import os
+import numpy as np
+import cv2
+import h5py
+
+# Streaming evaluation of the semantic scene completion results of the gen_result_*.py
+# scripts: an HDF5 'result' dataset of N x 12 x 60 x 36 x 60 class scores and the N label
+# volumes in the same order. The scores are read 'chunk' samples at a time and argmaxed,
+# and the labels one sample at a time, so the memory does not grow with N (a chunk of 8
+# SUNCG samples is 50 MB of scores). Per chunk:
+#  - Semantic Scene Completion: one bincount of (label, prediction) over the voxels whose
+#    label is not 255 adds to a 13x12 confusion matrix (labels above 11 get the last row);
+#  - Scene Completion: the empty/occupied tp, fp and fn of every sample, over the same
+#    voxels; as in eval_results.py the IoU, precision and recall are averaged over samples.
+# The labels come from the labels/%06d.png of SUNCG_RGBD, the %06d.npz of a split (arr_1,
+# the NYU and SUNCG_D test sets) or the shards of npz_shards.py.
+# With workers > 1 the rows are split into one contiguous range per process, every process
+# opens the file and sums its range into an Evaluation of its own, and the Evaluations are
+# merged. The counts are integers and the sums over samples float64, so the table is the
+# one of a single process; every process holds a chunk, so the memory grows with workers.
+
+NUM_CLASSES = 12
+CLASSNAME = ['ceiling','floor','wall','window','chair','bed','sofa','table','tvs','furn','objs']
+
+
+# The label sources are called with a result row and are sent to the worker processes.
+class PngLabels(object):
+    # label of result row i from label_path/%06d.png of names[i]
+    def __init__(self, label_path, names):
+        self.label_path = label_path
+        self.names = list(names)
+
+    def __call__(self, i):
+        image = cv2.imread('%s/%06d.png'%(self.label_path, self.names[i]), -1)
+        if image is None:
+            raise ValueError('ssc_eval: cannot read %s/%06d.png'%(self.label_path, self.names[i]))
+
+        return image.reshape(-1)
+
+
+class NpzLabels(object):
+    # label of result row i from arr_1 of npz_path/%06d.npz of names[i]
+    def __init__(self, npz_path, names):
+        self.npz_path = npz_path
+        self.names = list(names)
+
+    def __call__(self, i):
+
+        return np.load(os.path.join(self.npz_path, '%06d.npz'%self.names[i]))['arr_1'].reshape(-1)
+
+
+class ShardLabels(object):
+    # label of result row i from the record of npz names[i] in the shards of npz_shards.py
+    def __init__(self, shard_path, names):
+        # imported here, it needs torch
+        import npz_shards
+
+        self.shards = npz_shards.ShardReader(shard_path)
+        self.names = list(names)
+
+    def __call__(self, i):
+
+        return np.asarray(self.shards.get(self.names[i])[0]).reshape(-1)
+
+
+class Evaluation(object):
+    # the sums of one evaluation, add() takes the scores and labels of a chunk of samples
+    def __init__(self, num_classes = NUM_CLASSES):
+        self.num_classes = num_classes
+        self.confusion = np.zeros((num_classes + 1, num_classes), dtype = np.int64)
+        self.completion = np.zeros(3, dtype = np.float64) # sums of the IoU, prec, recall of samples
+        self.count = 0
+
+    def add(self, scores, labels):
+        # scores: (n, num_classes, ...) float, labels: (n, voxels) with 255 for unknown
+        n = scores.shape[0]
+        pred = np.argmax(scores.reshape(n, self.num_classes, -1), axis = 1)
+        labels = np.asarray(labels).reshape(n, -1).astype(np.int64)
+        if pred.shape != labels.shape:
+            raise ValueError('ssc_eval: the results have %d voxels per sample, but the labels have %d'%(
+                pred.shape[1], labels.shape[1]))
+        mask = labels != 255
+
+        label = np.minimum(labels[mask], self.num_classes)
+        self.confusion += np.bincount(label*self.num_classes + pred[mask],
+                                      minlength = self.confusion.size).reshape(self.confusion.shape)
+
+        labeled = labels > 0
+        predicted = pred > 0
+        tp = np.sum(mask & labeled & predicted, axis = 1).astype(np.float64)
+        fp = np.sum(mask & ~labeled & predicted, axis = 1).astype(np.float64)
+        fn = np.sum(mask & labeled & ~predicted, axis = 1).astype(np.float64)
+        self.completion[0] += np.sum(_ratio(tp, tp + fp + fn))
+        self.completion[1] += np.sum(_ratio(tp, tp + fp))
+        self.completion[2] += np.sum(_ratio(tp, tp + fn))
+        self.count += n
+
+    def merge(self, other):
+        # adds the sums of another Evaluation of other samples, returns self
+        if other.num_classes != self.num_classes:
+            raise ValueError('ssc_eval: cannot merge the evaluations of %d and %d classes'%(
+                self.num_classes, other.num_classes))
+        self.confusion += other.confusion
+        self.completion += other.completion
+        self.count += other.count
+
+        return self
+
+    def segmentation(self):
+        # (tp, fp, fn) of the classes 1.., one row per class
+        tp = np.diag(self.confusion[:self.num_classes])
+        fp = self.confusion.sum(0) - tp
+        fn = self.confusion[:self.num_classes].sum(1) - tp
+
+        return np.stack([tp, fp, fn], axis = 1)[1:]
+
+    def report(self, classname = CLASSNAME):
+        # the text of eval_results.py
+        seg = self.segmentation().astype(np.float32)
+        precision = seg[:, 0]/(seg[:, 0] + seg[:, 1])
+        recall = seg[:, 0]/(seg[:, 0] + seg[:, 2])
+        iou = seg[:, 0]/np.sum(seg, axis = 1)
+        com = self.completion/max(self.count, 1)
+
+        lines = ['Semantic Scene Completion:\nprec ,recall ,IoU\n mean: %f,%f,%f'%(np.mean(precision), np.mean(recall), np.mean(iou))]
+        for i in range(len(classname)):
+            lines.append(' %s %f %f %f'%(classname[i], precision[i], recall[i], iou[i]))
+        lines.append('Scene Completion:\nprec ,recall , IoU\n %f,%f,%f'%(com[1], com[2], com[0]))
+
+        return '\n'.join(lines)
+
+
+def _ratio(a, b):
+    # a/b, 0 where b is 0
+
+    return np.where(b > 0, a/np.maximum(b, 1), 0.)
+
+
+def _evaluate_rows(args):
+    # Evaluation of the rows [begin, end) of the 'result' dataset, in a worker process or not
+    result_path, label, begin, end, chunk, num_classes = args
+    evaluation = Evaluation(num_classes)
+    f = h5py.File(result_path, 'r')
+    try:
+        result = f['result']
+        end = result.shape[0] if end is None else end
+        for start in range(begin, end, chunk):
+            stop = min(start + chunk, end)
+            labels = np.stack([label(i) for i in range(start, stop)], axis = 0)
+            evaluation.add(result[start:stop], labels)
+    finally:
+        f.close()
+
+    return evaluation
+
+
+def evaluate(result_path, label, chunk = 8, num_classes = NUM_CLASSES, workers = 1):
+    # Evaluation of the 'result' dataset of result_path against label(i) of every row i,
+    # on 'workers' processes
+    if workers <= 1:
+        return _evaluate_rows((result_path, label, 0, None, chunk, num_classes))
+
+    f = h5py.File(result_path, 'r')
+    count = f['result'].shape[0]
+    f.close()
+    bounds = np.linspace(0, count, workers + 1).astype(np.int64).tolist()
+    ranges = [(result_path, label, begin, end, chunk, num_classes)
+              for begin, end in zip(bounds[:-1], bounds[1:]) if end > begin]
+    if not ranges:
+        return Evaluation(num_classes)
+
+    pool = multiprocessing.Pool(len(ranges))
+    try:
+        evaluations = pool.map(_evaluate_rows, ranges)
+    finally:
+        pool.close()
+        pool.join()
+
+    evaluation = Evaluation(num_classes)
+    for part in evaluations:
+        evaluation.merge(part)
+
+    return evaluation
+
+
+# python ssc_eval.py RESULT --png LABELS --skip 9      (SUNCG_RGBD, as eval_results.py)
+# python ssc_eval.py RESULT --npz NPZ_PATH_TEST        (NYU, SUNCG_D)
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the results of a gen_result_*.py script chunk by chunk')
+    parser.add_argument('result', help='HDF5 file with the N x 12 x 60 x 36 x 60 "result" dataset')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--png', metavar='DIR', help='labels in DIR/%%06d.png')
+    source.add_argument('--npz', metavar='DIR', help='labels in arr_1 of DIR/%%06d.npz')
+    source.add_argument('--shards', metavar='DIR', help='labels in the shards of npz_shards.py')
+    parser.add_argument('--skip', default='', help='comma-separated label numbers the results leave out, e.g. 9 for SUNCG_RGBD')
+    parser.add_argument('--chunk', default=8, type=int, metavar='N', help='samples read at a time by a process')
+    parser.add_argument('--workers', default=multiprocessing.cpu_count(), type=int, metavar='N', help='processes (default: one per core)')
+    args = parser.parse_args()
+
+    f = h5py.File(args.result, 'r')
+    count = f['result'].shape[0]
+    f.close()
+    skip = set(int(i) for i in args.skip.split(',') if i)
+    names = [i for i in range(count + len(skip)) if i not in skip]
+
+    if args.png is not None:
+        label = PngLabels(args.png, names)
+    elif args.npz is not None:
+        label = NpzLabels(args.npz, names)
+    else:
+        label = ShardLabels(args.shards, names)
+    print(evaluate(args.result, label, args.chunk, workers = args.workers).report())
+
+
+if __name__ == '__main__':
+
+    main()
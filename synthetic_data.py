@@ -0,0 +1,221 @@
+import argparse
+import os
+import numpy as np
+import cv2
+
+# Writes a small dataset in the layout of configs.py, so that the loaders, models and
+# eval_results.py run without the real datasets:
+#   %06d.npz    arr_1 60x36x60 labels (255 outside the room), arr_2 weights,
+#               arr_3 240x144x240 voxel of every 640x480 pixel (-1 for missing depth),
+#               arr_0 is left empty as no loader reads it
+#   %06d.png    HHA images (numbered from 1), RGB images with their category pngs
+#   sample lists and a configs_synthetic.py that points configs.py at all of it, see
+#   SATNET_CONFIGS in configs.py.
+# Every scene is a box room seen from a camera near one wall, with a few boxes of furniture.
+# The voxels are 0.02m (0.08m for the labels), the camera has the NYU intrinsics.
+WIDTH = 640
+HEIGHT = 480
+FOCAL = 518.8579
+ROOM = (4.8, 2.88, 4.8) # 240x144x240 voxels of 0.02m
+VOXEL = 0.02
+LABEL_SHAPE = (60, 36, 60)
+LABEL_VOXEL = 0.08
+
+# ceiling, floor and wall, then window, chair, bed, sofa, table, tvs, furn and objs
+CEILING = 1
+FLOOR = 2
+WALL = 3
+COLORS = np.array([[0, 0, 0], [200, 200, 190], [120, 90, 60], [180, 170, 150], [140, 190, 230],
+                   [150, 60, 50], [90, 110, 170], [60, 130, 80], [170, 120, 50],
+                   [40, 40, 40], [130, 80, 140], [200, 160, 60]], dtype = np.float32)
+
+
+def scene(rng):
+    # furniture boxes standing on the floor, (class, min corner, max corner)
+    boxes = []
+    for _ in range(rng.randint(2, 6)):
+        size = rng.uniform([0.4, 0.3, 0.4], [1.6, 1.5, 1.6])
+        corner = rng.uniform([0., 0., 1.], [ROOM[0] - size[0], 0., ROOM[2] - size[2]])
+        boxes.append((rng.randint(4, 12), corner, corner + size))
+
+    return boxes
+
+
+def labels(boxes, rng):
+    # class of every 0.08m voxel, with a 0/1 weight over the voxels of the room
+    ind = np.indices(LABEL_SHAPE).reshape(3, -1).T
+    center = (ind + 0.5)*LABEL_VOXEL
+    label = np.zeros(len(ind), dtype = np.uint8)
+    last = np.array(LABEL_SHAPE) - 1
+    label[(ind[:, 0] == 0) | (ind[:, 0] == last[0]) | (ind[:, 2] == 0) | (ind[:, 2] == last[2])] = WALL
+    label[ind[:, 1] == last[1]] = CEILING
+    label[ind[:, 1] == 0] = FLOOR
+    for categ, lo, hi in boxes:
+        label[np.all((center >= lo) & (center <= hi), axis = 1)] = categ
+
+    # the corner behind the camera is outside every view, as the unlabelled voxels of SUNCG
+    label[ind[:, 2] < 2] = 255
+    weight = ((label != 255) & ((label > 0) | (rng.uniform(size = len(label)) < 0.3))).astype(np.float32)
+
+    return label, weight
+
+
+def render(boxes, camera, rng):
+    # distance, class and voxel of every pixel, by intersecting its ray with the room and the boxes
+    v, u = np.mgrid[0:HEIGHT, 0:WIDTH]
+    ray = np.stack([(u - WIDTH/2.)/FOCAL, -(v - HEIGHT/2.)/FOCAL, np.ones((HEIGHT, WIDTH))], axis = -1).reshape(-1, 3)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        # leaving the room
+        t_exit = np.where(ray > 0, (np.array(ROOM) - camera)/ray, -camera/ray)
+        t_exit[~np.isfinite(t_exit)] = np.inf
+        axis = np.argmin(t_exit, axis = 1)
+        t = t_exit[np.arange(len(ray)), axis]
+        categ = np.where(axis == 1, np.where(ray[:, 1] > 0, CEILING, FLOOR), WALL).astype(np.uint8)
+        # entering a box
+        for box_categ, lo, hi in boxes:
+            t0 = (lo - camera)/ray
+            t1 = (hi - camera)/ray
+            t_near = np.nanmax(np.minimum(t0, t1), axis = 1)
+            t_far = np.nanmin(np.maximum(t0, t1), axis = 1)
+            hit = (t_near <= t_far) & (t_near > 0) & (t_near < t)
+            t[hit] = t_near[hit]
+            categ[hit] = box_categ
+
+    point = camera + t[:, None]*ray
+    voxel = np.clip((point/VOXEL).astype(np.int64), 0, np.array(ROOM)/VOXEL - 1).astype(np.int64)
+    mapping = (voxel[:, 0]*144 + voxel[:, 1])*240 + voxel[:, 2]
+    missing = rng.uniform(size = len(ray)) < 0.05
+    mapping[missing] = -1
+
+    return t.reshape(HEIGHT, WIDTH), categ.reshape(HEIGHT, WIDTH), point[:, 1].reshape(HEIGHT, WIDTH), mapping
+
+
+def images(distance, categ, height, rng):
+    shade = np.clip(1.2 - distance/8., 0.3, 1.)[..., None]
+    color = COLORS[categ]*shade + rng.normal(0, 6, (HEIGHT, WIDTH, 3))
+    # HHA: disparity, height above the floor, and the class standing in for the angle with gravity
+    hha = np.stack([np.clip(255./np.maximum(distance, 0.1), 0, 255),
+                    np.clip(height/ROOM[1]*255, 0, 255),
+                    categ.astype(np.float32)*20], axis = -1)
+
+    return np.clip(color, 0, 255).astype(np.uint8), hha.astype(np.uint8)
+
+
+def sample(rng):
+    boxes = scene(rng)
+    camera = np.array([rng.uniform(1.8, 3.), rng.uniform(1.2, 1.7), 0.2])
+    label, weight = labels(boxes, rng)
+    distance, categ, height, mapping = render(boxes, camera, rng)
+    color, hha = images(distance, categ, height, rng)
+
+    return label, weight, mapping, color, hha, categ
+
+
+def write_split(out_path, name, count, category, rng, skip = ()):
+    # %06d.npz from 0, HHA %06d.png from 1, RGB %06d_color.png with its category png
+    npz_path = os.path.join(out_path, name)
+    hha_path = os.path.join(out_path, name + '_HHA')
+    image_path = os.path.join(out_path, name + '_images')
+    for path in (npz_path, hha_path, image_path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    lines = []
+    label_list = []
+    for i in range(count):
+        label, weight, mapping, color, hha, categ = sample(rng)
+        if i not in skip:
+            np.savez_compressed(os.path.join(npz_path, '%06d.npz'%i), np.zeros(0, dtype = np.float32), label, weight, mapping)
+        cv2.imwrite(os.path.join(hha_path, '%06d.png'%(i+1)), hha[:, :, ::-1])
+        line = os.path.join(image_path, '%06d_color.png'%i)
+        cv2.imwrite(line, color[:, :, ::-1])
+        cv2.imwrite(line[0:len(line)-9] + category, categ)
+        lines.append(line)
+        label_list.append(label)
+        if i % 100 == 0:
+            print('{0}: {1}/{2}'.format(name, i, count))
+
+    return npz_path, hha_path, lines, label_list
+
+
+def write_list(filename, lines):
+    fid = open(filename, "w")
+    for line in lines:
+        fid.write(line + "\n")
+    fid.close()
+
+
+def build(out_path, nyu = (16, 16), suncgd = (16, 16), suncgrgbd = (16, 500), seed = 0):
+    rng = np.random.RandomState(seed)
+    out_path = os.path.abspath(out_path)
+    configs = []
+
+    nyu_path = os.path.join(out_path, 'nyu')
+    for split, name, list_name, count in (('TRAIN', 'nyu_selected', 'nyu_train.txt', nyu[0]),
+                                          ('TEST', 'nyu_selected_val', 'nyu_test.txt', nyu[1])):
+        npz_path, hha_path, lines, _ = write_split(nyu_path, name, count, 'category_suncg.png', rng)
+        write_list(os.path.join(nyu_path, list_name), lines)
+        configs += [('NYU_NPZ_PATH_' + split, npz_path), ('NYU_HHA_PATH_' + split, hha_path),
+                    ('NYU_SAMPLE_TXT_' + split, os.path.join(nyu_path, list_name)), ('NYU_NUM_' + split, count)]
+
+    suncgd_path = os.path.join(out_path, 'suncg_d')
+    for split, name, count in (('TRAIN', 'shurans_selected', suncgd[0]), ('TEST', 'shurans_selected_val', suncgd[1])):
+        npz_path, hha_path, _, _ = write_split(suncgd_path, name, count, 'category_uint8.png', rng)
+        configs += [('SUNCGD_NPZ_PATH_' + split, npz_path), ('SUNCGD_HHA_PATH_' + split, hha_path),
+                    ('SUNCGD_NUM_' + split, count)]
+
+    # the labels of eval_results.py leave out the 10th test scene, which has no npz either
+    suncgrgbd_path = os.path.join(out_path, 'suncg_rgbd')
+    for split, name, list_name, count in (('TRAIN', 'myselect_suncg', 'image_list_train.txt', suncgrgbd[0]),
+                                          ('TEST', 'myselect_suncg_val', 'image_list_val.txt', suncgrgbd[1])):
+        skip = (9,) if split == 'TEST' else ()
+        npz_path, hha_path, lines, label_list = write_split(suncgrgbd_path, name, count, 'category_uint8.png', rng, skip)
+        write_list(os.path.join(suncgrgbd_path, list_name), lines)
+        configs += [('SUNCGRGBD_NPZ_PATH_' + split, npz_path), ('SUNCGRGBD_HHA_PATH_' + split, hha_path),
+                    ('SUNCGRGBD_SAMPLE_TXT_' + split, os.path.join(suncgrgbd_path, list_name))]
+    label_path = os.path.join(suncgrgbd_path, 'labels')
+    if not os.path.exists(label_path):
+        os.makedirs(label_path)
+    for i, label in enumerate(label_list):
+        if i not in skip:
+            cv2.imwrite(os.path.join(label_path, '%06d.png'%i), label.reshape(60*36, 60))
+
+    # the caches next to the data, so that nothing is written to the paths of configs.py
+    for prefix, path in (('NYU', nyu_path), ('SUNCGD', suncgd_path), ('SUNCGRGBD', suncgrgbd_path)):
+        for cache in ('MAPPING', 'SHARD', 'IMAGE_CACHE', 'FEATURE'):
+            configs += [('%s_%s_PATH_TRAIN'%(prefix, cache), os.path.join(path, cache.lower() + '_train')),
+                        ('%s_%s_PATH_TEST'%(prefix, cache), os.path.join(path, cache.lower() + '_test'))]
+    for prefix, path in (('NYU', nyu_path), ('SUNCGRGBD', suncgrgbd_path)):
+        configs += [('%s_PCA_CACHE_PATH_TRAIN'%prefix, os.path.join(path, 'pca_cache_train')),
+                    ('%s_MANIFEST_PATH_TRAIN'%prefix, os.path.join(path, 'manifest_train.npz')),
+                    ('%s_MANIFEST_PATH_TEST'%prefix, os.path.join(path, 'manifest_test.npz'))]
+
+    fid = open(os.path.join(out_path, 'configs_synthetic.py'), "w")
+    for name, value in configs:
+        fid.write('%s = %r\n'%(name, value))
+    fid.close()
+
+
+# python synthetic_data.py /tmp/satnet_synthetic
+# SATNET_CONFIGS=/tmp/satnet_synthetic/configs_synthetic.py python SATNet_RGB.py
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic dataset in the layout of configs.py')
+    parser.add_argument('out_path', metavar='DIR',
+                        help='directory to write the datasets and configs_synthetic.py to')
+    parser.add_argument('--nyu', default=[16, 16], type=int, nargs=2, metavar='N',
+                        help='NYU train and test scenes (default: 16 16)')
+    parser.add_argument('--suncgd', default=[16, 16], type=int, nargs=2, metavar='N',
+                        help='SUNCG_D train and test scenes (default: 16 16)')
+    parser.add_argument('--suncgrgbd', default=[16, 500], type=int, nargs=2, metavar='N',
+                        help='SUNCG_RGBD train and test scenes, eval_results.py expects 500 test scenes (default: 16 500)')
+    parser.add_argument('--seed', default=0, type=int, metavar='N',
+                        help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    build(args.out_path, args.nyu, args.suncgd, args.suncgrgbd, args.seed)
+
+
+if __name__ == '__main__':
+
+    main()